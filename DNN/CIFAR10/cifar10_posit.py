@@ -19,20 +19,114 @@ In this notebook, we present a quick example of how to simulate training a deep
 # import useful modules
 import argparse
 import os
+import sys
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
 import torchvision.transforms as transforms
-from qtorch_plus.quant import Quantizer, quantizer
 from qtorch_plus.optim import OptimLP
 from torch.optim import SGD
-from qtorch_plus import FloatingPoint, Posit
 from tqdm import tqdm
 import math
 import numpy as np
 import matplotlib.pyplot as plt
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from annsim import distributed
+from annsim.augment import BatchAugment
+from annsim.backend import (DEVICES, MEMORY_FORMATS, configure, describe, memory_format,
+                            select_device)
+from annsim.checkpoint import Checkpointer
+from annsim.data import CachedDataset
+from annsim.evalcache import QuantizedTestSet
+from annsim.formats import NAMES, policy, result_dir
+from annsim.graphopt import optimize, trace
+from annsim.layerpolicy import LayerPolicy
+from annsim.models import PreResNet
+from annsim.monitor import Monitor, stopped
+from annsim.optim import FusedOptimLP, LayerwiseOptimLP, PackedOptimLP
+from annsim.packing import PackedActivations
+from annsim.philox import CounterRNG
+from annsim.quant import Quantizer, quantizer
+from annsim.telemetry import Telemetry
+from annsim.train import run_epoch
+from annsim.weightfile import save as save_weights
+
+parser = argparse.ArgumentParser(description="CIFAR10 low precision training")
+parser.add_argument("--format", nargs="+", default=None, choices=NAMES,
+                    help="number formats of the run (see annsim/formats.py); "
+                         "several formats are trained together on the same batches; default bfloat16")
+parser.add_argument("--policy", nargs="+", default=[], metavar="JSON",
+                    help="per-layer format policies to train as well (annsim/layerpolicy.py), "
+                         "e.g. written by python -m annsim.search; named after the file")
+parser.add_argument("--outdir", default=".",
+                    help="histories are written to <outdir>/<format dir>/")
+parser.add_argument("--epochs", type=int, default=100)
+parser.add_argument("--data-cache", action="store_true",
+                    help="read the dataset from the memory-mapped uint8 cache (annsim/data.py)")
+parser.add_argument("--batch-augment", action="store_true",
+                    help="augment and normalize whole uint8 batches on the device "
+                         "(annsim/augment.py); implies --data-cache")
+parser.add_argument("--workers", type=int, default=None,
+                    help="DataLoader workers; by default 8 on a GPU, on the CPU one with the data "
+                         "cache and else a quarter of the cores (annsim/backend.py)")
+parser.add_argument("--device", choices=DEVICES, default="auto",
+                    help="auto picks CUDA when available, else the CPU")
+parser.add_argument("--memory-format", choices=MEMORY_FORMATS, default="auto",
+                    help="memory format of the model; auto is channels_last on the CPU (not for LeNet)")
+parser.add_argument("--eval-cache", choices=["memory", "mmap"], default=None,
+                    help="quantize the test inputs once and reuse them in every eval phase, "
+                         "kept on the device or in a memory-mapped file next to the data")
+parser.add_argument("--download-only", action="store_true",
+                    help="download the dataset (and build its cache with --data-cache) and exit")
+parser.add_argument("--checkpoint-every", type=int, default=1,
+                    help="save the run every N epochs (0 disables checkpoints)")
+parser.add_argument("--resume", action="store_true",
+                    help="continue from the checkpoint of the run in <outdir>")
+parser.add_argument("--monitor", action="store_true",
+                    help="end the formats that diverge or stall early (annsim/monitor.py)")
+parser.add_argument("--patience", type=int, default=10,
+                    help="epochs without progress before --monitor declares a run stalled")
+parser.add_argument("--telemetry", type=int, default=0, metavar="EVERY",
+                    help="sample the quantizers every EVERY training steps and write per call site "
+                         "statistics to <format dir>/telemetry.jsonl (annsim/telemetry.py)")
+parser.add_argument("--pack-activations", action="store_true",
+                    help="keep the quantized activations saved for backward as 8/16-bit codes "
+                         "(annsim/packing.py)")
+parser.add_argument("--packed-optimizer", action="store_true",
+                    help="keep the momentum buffers and accumulators as 8/16-bit codes "
+                         "(PackedOptimLP in annsim/optim.py)")
+parser.add_argument("--fused-optimizer", action="store_true",
+                    help="step the parameters of a group as one flat tensor, in buckets "
+                         "(FusedOptimLP in annsim/optim.py)")
+parser.add_argument("--rounding-seed", type=int, default=None, metavar="SEED",
+                    help="round stochastically with counter-based random numbers keyed by SEED, "
+                         "the step and the parameter (annsim/philox.py), the same on any device")
+parser.add_argument("--save-weights", action="store_true",
+                    help="write the final weights to <format dir>/weights.bin as codes of their "
+                         "weight format (annsim/weightfile.py)")
+parser.add_argument("--optimize-graph", action="store_true",
+                    help="trace the models with torch.fx and remove their redundant quantizers "
+                         "and ReLU passes (annsim/graphopt.py)")
+args = parser.parse_args()
+if args.packed_optimizer and args.fused_optimizer:
+    parser.error("--packed-optimizer and --fused-optimizer are exclusive")
+if (args.packed_optimizer or args.fused_optimizer) and args.policy:
+    # the per-layer policies step with LayerwiseOptimLP
+    parser.error("--packed-optimizer and --fused-optimizer do not apply to the runs of --policy")
+# one process per replica under torchrun (annsim/distributed.py)
+if distributed.init() > 1:
+    if args.monitor:
+        parser.error("--monitor stops formats on the results of a single process")
+    if args.rounding_seed is None:
+        # the replicas round alike only with counter-based random numbers
+        args.rounding_seed = 0
+
+# runs of the process: uniform formats and per-layer policies
+layer_policies = {os.path.splitext(os.path.basename(f))[0]: LayerPolicy.load(f) for f in args.policy}
+runs = list(args.format or ([] if layer_policies else ["bfloat16"])) + list(layer_policies)
+
 """We first load the data. In this example, we will experiment with CIFAR10."""
 
 # loading data
@@ -48,237 +142,209 @@ transform_test = transforms.Compose([
     transforms.ToTensor(),
     transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
 ])
-train_set = ds(path, train=True, download=True, transform=transform_train)
-test_set = ds(path, train=False, download=True, transform=transform_test)
+batch_transforms = {'train': None, 'test': None}
+with distributed.main_first():
+    if args.batch_augment:
+        train_set = CachedDataset("CIFAR10", path, "train")
+        test_set = CachedDataset("CIFAR10", path, "test")
+        batch_transforms = {'train': BatchAugment.from_transform(transform_train, seed=distributed.rank()),
+                            'test': BatchAugment.from_transform(transform_test)}
+    elif args.data_cache:
+        train_set = CachedDataset("CIFAR10", path, "train", transform=transform_train)
+        test_set = CachedDataset("CIFAR10", path, "test", transform=transform_test, preprocess=True)
+    else:
+        train_set = ds(path, train=True, download=True, transform=transform_train)
+        test_set = ds(path, train=False, download=True, transform=transform_test)
+if args.download_only:
+    sys.exit(0)
+# device, threads and DataLoader workers of the run
+device = select_device(args.device)
+loader_kwargs = configure(device, args.workers, cached=args.data_cache or args.batch_augment)
+model_format = memory_format("CIFAR10", device, args.memory_format)
+print(describe(device, loader_kwargs, model_format))
 loaders = {
-        'train': torch.utils.data.DataLoader(
-            train_set,
-            batch_size=128,
-            shuffle=True,
-            num_workers=8,
-            pin_memory=True
-        ),
+        # the batch is split between the processes of a distributed run
+        'train': distributed.train_loader(train_set, 128, **loader_kwargs),
         'test': torch.utils.data.DataLoader(
             test_set,
             batch_size=128,
-            num_workers=8,
-            pin_memory=True
+            **loader_kwargs
         )
 }
 
 """We then define the quantization setting we are going to use. In particular, here we follow the setting reported in the paper "Training Deep Neural Networks with 8-bit Floating Point Numbers", where the authors propose to use specialized 8-bit and 16-bit floating point format."""
 
-# define two floating point formats
-bit_8  = Posit(nsize=8,  es=2)
-bit_10 = Posit(nsize=10, es=2)
-bit_12 = Posit(nsize=12, es=2)
-bit_14 = Posit(nsize=14, es=2)
-bit_16 = Posit(nsize=16, es=2)
-IEEE_Half = FloatingPoint(exp=5, man=10)
-bfloat16  = FloatingPoint(exp=8, man=7 )
-# Not supported formats
-# # bit_20 = Posit(nsize=20, es=2)
-# # bit_24 = Posit(nsize=24, es=2)
-# # bit_28 = Posit(nsize=28, es=2)
-# # bit_32 = Posit(nsize=32, es=2)
-
-num_format = bfloat16
-
-# define quantization functions
-weight_quant = quantizer(forward_number=num_format,
-                        forward_rounding="nearest")
-grad_quant = quantizer(forward_number=num_format,
-                        forward_rounding="nearest")
-momentum_quant = quantizer(forward_number=num_format,
-                        forward_rounding="stochastic")
-acc_quant = quantizer(forward_number=num_format,
-                        forward_rounding="stochastic")
-
-# define a lambda function so that the Quantizer module can be duplicated easily
-act_error_quant = lambda : Quantizer(forward_number=num_format, backward_number=num_format,
-                        forward_rounding="nearest", backward_rounding="nearest")
+# every format of the run gets its own set of quantizers
+def make_quantizers(num_format, generator=None):
+    # define quantization functions
+    weight_quant = quantizer(forward_number=num_format['weight'],
+                            forward_rounding="nearest")
+    grad_quant = quantizer(forward_number=num_format['grad'],
+                            forward_rounding="nearest")
+    momentum_quant = quantizer(forward_number=num_format['momentum'],
+                            forward_rounding="stochastic", generator=generator)
+    acc_quant = quantizer(forward_number=num_format['acc'],
+                            forward_rounding="stochastic", generator=generator)
+
+    # define a lambda function so that the Quantizer module can be duplicated easily
+    act_error_quant = lambda site=None: Quantizer(forward_number=num_format['activation'], backward_number=num_format['error'],
+                            forward_rounding="nearest", backward_rounding="nearest", generator=generator)
+    return weight_quant, grad_quant, momentum_quant, acc_quant, act_error_quant
 
 
 torch.manual_seed(0)
 np.random.seed(0)
 
-"""Next, we define a low-precision ResNet. In the definition, we recursively insert quantization module after every convolution layer. Note that the quantization of weight, gradient, momentum, and gradient accumulator are not handled here."""
-
-def conv3x3(in_planes, out_planes, stride=1):
-    return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride,
-                     padding=1, bias=False)
-
-class BasicBlock(nn.Module):
-    expansion = 1
-
-    def __init__(self, inplanes, planes, quant, stride=1, downsample=None):
-        super(BasicBlock, self).__init__()
-        self.bn1 = nn.BatchNorm2d(inplanes)
-        self.relu = nn.ReLU(inplace=True)
-        self.conv1 = conv3x3(inplanes, planes, stride)
-        self.bn2 = nn.BatchNorm2d(planes)
-        self.conv2 = conv3x3(planes, planes)
-        self.downsample = downsample
-        self.stride = stride
-        self.quant = quant()
-
-    def forward(self, x):
-        residual = x
-
-        out = self.bn1(x)
-        out = self.relu(out)
-        out = self.quant(out)
-        out = self.conv1(out)
-        out = self.quant(out)
-
-        out = self.bn2(out)
-        out = self.relu(out)
-        out = self.quant(out)
-        out = self.conv2(out)
-        out = self.quant(out)
-
-        if self.downsample is not None:
-            residual = self.downsample(x)
-
-        out += residual
-
-        return out
-    
-class PreResNet(nn.Module):
-
-    def __init__(self,quant, num_classes=10, depth=20):
-
-        super(PreResNet, self).__init__()
-        assert (depth - 2) % 6 == 0, 'depth should be 6n+2'
-        n = (depth - 2) // 6
-
-        block = BasicBlock
-
-        self.inplanes = 16
-        self.conv1 = nn.Conv2d(3, 16, kernel_size=3, padding=1,
-                               bias=False)
-        self.layer1 = self._make_layer(block, 16, n, quant)
-        self.layer2 = self._make_layer(block, 32, n, quant, stride=2)
-        self.layer3 = self._make_layer(block, 64, n, quant, stride=2)
-        self.bn = nn.BatchNorm2d(64 * block.expansion)
-        self.relu = nn.ReLU(inplace=True)
-        self.avgpool = nn.AvgPool2d(8)
-        self.fc = nn.Linear(64 * block.expansion, num_classes)
-        self.quant = quant()
-        IBM_half = FloatingPoint(exp=6, man=9)
-        self.quant_half = Quantizer(IBM_half, IBM_half, "nearest", "nearest")
-        for m in self.modules():
-            if isinstance(m, nn.Conv2d):
-                n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-                m.weight.data.normal_(0, math.sqrt(2. / n))
-            elif isinstance(m, nn.BatchNorm2d):
-                m.weight.data.fill_(1)
-                m.bias.data.zero_()
-
-    def _make_layer(self, block, planes, blocks, quant, stride=1):
-        downsample = None
-        if stride != 1 or self.inplanes != planes * block.expansion:
-            downsample = nn.Sequential(
-                nn.Conv2d(self.inplanes, planes * block.expansion,
-                          kernel_size=1, stride=stride, bias=False),
-            )
-
-        layers = list()
-        layers.append(block(self.inplanes, planes, quant , stride, downsample))
-        self.inplanes = planes * block.expansion
-        for i in range(1, blocks):
-            layers.append(block(self.inplanes, planes, quant))
-
-        return nn.Sequential(*layers)
-
-    def forward(self, x):
-        x = self.quant_half(x)
-        x = self.conv1(x)
-        x = self.quant(x)
-
-        x = self.layer1(x)  # 32x32
-        x = self.layer2(x)  # 16x16
-        x = self.layer3(x)  # 8x8
-        x = self.bn(x)
-        x = self.relu(x)
-        x = self.quant(x)
-
-        x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
-        x = self.fc(x)
-        x = self.quant_half(x)
-
-        return x
-
-model = PreResNet(act_error_quant)
-
-device = 'cuda' # change device to 'cpu' if you want to run this example on cpu
-model = model.to(device=device)
+"""The low-precision ResNet (`PreResNet`) is defined in annsim/models.py: it recursively inserts a quantization module after every convolution layer. Note that the quantization of weight, gradient, momentum, and gradient accumulator are not handled here."""
 
 """We now use the low-precision optimizer wrapper to help define the quantization of weight, gradient, momentum, and gradient accumulator."""
 
-optimizer = SGD(model.parameters(), lr=0.05, momentum=0.9, weight_decay=5e-4)
-optimizer = OptimLP(optimizer,
-                    weight_quant=weight_quant,
-                    grad_quant=grad_quant,
-                    momentum_quant=momentum_quant,
-                    acc_quant=acc_quant,
-                    grad_scaling=1/1000 # do gradient scaling
-)
-
-"""We can reuse common training scripts without any extra codes to handle quantization."""
-
-def run_epoch(loader, model, criterion, optimizer=None, phase="train"):
-    assert phase in ["train", "eval"], "invalid running phase"
-    loss_sum = 0.0
-    correct = 0.0
-
-    if phase=="train": model.train()
-    elif phase=="eval": model.eval()
-
-    ttl = 0
-    with torch.autograd.set_grad_enabled(phase=="train"):
-        for i, (input, target) in tqdm(enumerate(loader), total=len(loader)):
-            input = input.to(device=device)
-            target = target.to(device=device)
-            output = model(input)
-            loss = criterion(output, target)
-            loss_sum += loss.cpu().item() * input.size(0)
-            pred = output.data.max(1, keepdim=True)[1]
-            correct += pred.eq(target.data.view_as(pred)).sum()
-            ttl += input.size()[0]
-
-            if phase=="train":
-                loss = loss * 1000 # do gradient scaling
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-
-    correct = correct.cpu().item()
-    return {
-        'loss': loss_sum / float(ttl),
-        'accuracy': correct / float(ttl) * 100.0,
-    }
+# one model and optimizer per format, all starting from the same weights
+models, optimizers, generators = [], [], []
+for name in runs:
+    # counter-based stochastic rounding, advanced by every optimizer step
+    generator = None if args.rounding_seed is None else CounterRNG(args.rounding_seed)
+    if generator is not None:
+        generators.append(generator)
+    if name in layer_policies:
+        # formats per layer: the policy builds the quantizers of the model and optimizer
+        layer_policy = layer_policies[name]
+        layer_policy.generator = generator
+        torch.manual_seed(0)
+        model = PreResNet(layer_policy)
+        if args.optimize_graph:
+            model = optimize(trace(model))[0]
+        model = model.to(device=device, memory_format=model_format)
+        distributed.broadcast(model)
+
+        optimizer = SGD(model.parameters(), lr=0.05, momentum=0.9, weight_decay=5e-4)
+        optimizer = LayerwiseOptimLP(optimizer, layer_policy.param_quants(model),
+                                     grad_scaling=1/1000 # do gradient scaling
+        )
+        if distributed.world_size() > 1:
+            distributed.GradientReducer(optimizer)
+        if generator is not None:
+            generator.attach(optimizer)
+        models.append(model)
+        optimizers.append(optimizer)
+        continue
+
+    weight_quant, grad_quant, momentum_quant, acc_quant, act_error_quant = make_quantizers(policy(name), generator)
+    torch.manual_seed(0)
+    model = PreResNet(act_error_quant)
+    if args.optimize_graph:
+        model = optimize(trace(model))[0]
+    model = model.to(device=device, memory_format=model_format)
+    distributed.broadcast(model)
+
+    optimizer = SGD(model.parameters(), lr=0.05, momentum=0.9, weight_decay=5e-4)
+    # PackedOptimLP keeps momentum and accumulators as 8/16-bit codes,
+    # FusedOptimLP steps them as flat tensors
+    optimizer_cls = (PackedOptimLP if args.packed_optimizer
+                     else FusedOptimLP if args.fused_optimizer else OptimLP)
+    optimizer = optimizer_cls(optimizer,
+                        weight_quant=weight_quant,
+                        grad_quant=grad_quant,
+                        momentum_quant=momentum_quant,
+                        acc_quant=acc_quant,
+                        grad_scaling=1/1000 # do gradient scaling
+    )
+    if distributed.world_size() > 1:
+        # gradients averaged over the processes as codes of their format
+        distributed.GradientReducer(optimizer)
+    if generator is not None:
+        generator.attach(optimizer)
+    models.append(model)
+    optimizers.append(optimizer)
+
+# the test inputs of every model, quantized once by its input quantizer
+eval_sets = None
+if args.eval_cache and distributed.is_main():
+    cache_dir = path if args.eval_cache == "mmap" else None
+    eval_sets = [QuantizedTestSet(loaders['test'], model.quant_half, device=device,
+                                  transform=batch_transforms['test'], cache_dir=cache_dir)
+                 for model in models]
+
+"""We can reuse common training scripts without any extra codes to handle quantization: `run_epoch` (annsim/train.py) steps every model on the same batches."""
 
 """Begin the training process just as usual. Enjoy!"""
 
 # history = {}
-train_hist = []
-test_hist = []
-
-EPOCHS=100
-for epoch in range(EPOCHS):
+train_hist = {name: [] for name in runs}
+test_hist = {name: [] for name in runs}
+
+# models, optimizers, RNG states and histories, saved in the background
+# (one file per process of a distributed run)
+checkpoint_path = distributed.rank_path(os.path.join(args.outdir, result_dir(runs[0]), 'checkpoint.pt'))
+checkpointer = Checkpointer(checkpoint_path,
+                            models, optimizers, runs,
+                            augmenters=[t for t in batch_transforms.values() if t is not None],
+                            generators=generators, every=args.checkpoint_every)
+start_epoch = 0
+if args.resume:
+    start_epoch, train_hist, test_hist = checkpointer.load()
+
+# diverged and stalled formats stop training; the process ends with the last one
+monitor = None
+if args.monitor:
+    monitor = Monitor(num_classes=10, patience=args.patience)
+    for model in models:
+        monitor.watch(model)
+active = [k for k, name in enumerate(runs) if not stopped(train_hist[name])]
+
+# saturation, underflow, rounding error and exponents of every quantizer call site
+telemetry = {}
+if args.telemetry and distributed.is_main():
+    for k, name in enumerate(runs):
+        os.makedirs(os.path.join(args.outdir, result_dir(name)), exist_ok=True)
+        telemetry[k] = Telemetry(models[k], os.path.join(args.outdir, result_dir(name), 'telemetry.jsonl'),
+                                 every=args.telemetry)
+
+# activations saved for backward as codes of their format, decoded exactly
+if args.pack_activations:
+    packers = [PackedActivations(model) for model in models]
+
+EPOCHS=args.epochs
+for epoch in range(start_epoch, EPOCHS):
+    if not active:
+        break
     print(f"Epoch {epoch+1}/{EPOCHS}")
-    train_res = run_epoch(loaders['train'], model, F.cross_entropy,
-                                optimizer=optimizer, phase="train")
-    train_hist += [train_res]
-    print(train_res)
-    test_res = run_epoch(loaders['test'], model, F.cross_entropy,
-                                optimizer=optimizer, phase="eval")
-    test_hist += [test_res]
-    print(test_res)
-
-train_res, test_res
+    active_models = [models[k] for k in active]
+    distributed.set_epoch(loaders['train'], epoch)
+    train_res = run_epoch(loaders['train'], active_models, F.cross_entropy,
+                                optimizers=[optimizers[k] for k in active], phase="train", device=device,
+                                transform=batch_transforms['train'], monitor=monitor)
+    # results and batch norm statistics over the processes; rank 0 evaluates
+    train_res = distributed.reduce_results(train_res)
+    for model in active_models:
+        distributed.average_buffers(model)
+    test_res = None
+    if distributed.is_main() and eval_sets is None:
+        test_res = run_epoch(loaders['test'], active_models, F.cross_entropy,
+                                    phase="eval", device=device,
+                                    transform=batch_transforms['test'])
+    elif distributed.is_main():
+        test_res = [run_epoch(eval_sets[k], [models[k]], F.cross_entropy, phase="eval", device=device)[0]
+                    for k in active]
+    test_res = distributed.broadcast_object(test_res)
+    for k, train_r, test_r in zip(active, train_res, test_res):
+        name = runs[k]
+        train_hist[name] += [train_r]
+        test_hist[name] += [test_r]
+        if distributed.is_main():
+            print(name, {'train_loss': train_r['loss'], 'train_accuracy': train_r['accuracy'],
+                   'test_loss': test_r['loss'], 'test_accuracy': test_r['accuracy']})
+        if monitor is not None and monitor.check(models[k], train_hist[name], test_hist[name]):
+            print(name, train_hist[name][-1]['status'], "-", train_hist[name][-1]['reason'])
+    for k in active:
+        if k in telemetry:
+            telemetry[k].flush(epoch)
+    active = [k for k in active if not stopped(train_hist[runs[k]])]
+    checkpointer.step(epoch, train_hist, test_hist)
+checkpointer.wait()
+# the other processes of a distributed run hold the same models and histories
+if not distributed.is_main():
+    sys.exit(0)
 
 # Plotted the accuracy Graph
 def plot_accuracies(train, test=None):
@@ -310,11 +376,20 @@ def plot_losses(train, test=None):
 
 import json
 
-with open('train.hist', 'w') as fout:
-    json.dump(train_hist, fout)
+for name in runs:
+    outdir = os.path.join(args.outdir, result_dir(name))
+    os.makedirs(outdir, exist_ok=True)
+
+    with open(os.path.join(outdir, 'train.hist'), 'w') as fout:
+        json.dump(train_hist[name], fout)
+
+    with open(os.path.join(outdir, 'test.hist'), 'w') as fout:
+        json.dump(test_hist[name], fout)
 
-with open('test.hist', 'w') as fout:
-    json.dump(test_hist, fout)
+    if args.save_weights:
+        numbers = layer_policies[name] if name in layer_policies else policy(name)['weight']
+        save_weights(os.path.join(outdir, 'weights.bin'), models[runs.index(name)].state_dict(),
+                     numbers, format=name)
 
 
 # with open('train.hist', 'r') as f_in:
@@ -56,13 +56,13 @@ loaders = {
             batch_size=128,
             shuffle=True,
             num_workers=8,
-            pin_memory=True
+            pin_memory=torch.cuda.is_available()
         ),
         'test': torch.utils.data.DataLoader(
             test_set,
             batch_size=128,
             num_workers=8,
-            pin_memory=True
+            pin_memory=torch.cuda.is_available()
         )
 }
 
@@ -244,7 +244,7 @@ class LeNet(nn.Module):
 model = LeNet()
 # print(model)
 
-device = 'cuda' # change device to 'cpu' if you want to run this example on cpu
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
 model = model.to(device=device)
 
 """We now use the low-precision optimizer wrapper to help define the quantization of weight, gradient, momentum, and gradient accumulator."""
@@ -348,6 +348,9 @@ with open('FP32/train.hist', 'w') as fout:
 with open('FP32/test.hist', 'w') as fout:
     json.dump(test_hist, fout)
 
+# trained weights, for the post-training quantization sweep (python -m annsim.ptq)
+torch.save(model.state_dict(), 'FP32/model.pt')
+
 
 # with open('train.hist', 'r') as f_in:
 #     train_hist = json.load(f_in)
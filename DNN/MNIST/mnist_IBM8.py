@@ -56,13 +56,13 @@ loaders = {
             batch_size=128,
             shuffle=True,
             num_workers=8,
-            pin_memory=True
+            pin_memory=torch.cuda.is_available()
         ),
         'test': torch.utils.data.DataLoader(
             test_set,
             batch_size=128,
             num_workers=8,
-            pin_memory=True
+            pin_memory=torch.cuda.is_available()
         )
 }
 
@@ -141,7 +141,7 @@ class LeNet(nn.Module):
 model = LeNet(act_error_quant)
 # print(model)
 
-device = 'cuda' # change device to 'cpu' if you want to run this example on cpu
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
 model = model.to(device=device)
 
 """We now use the low-precision optimizer wrapper to help define the quantization of weight, gradient, momentum, and gradient accumulator."""
@@ -1,71 +1,8 @@
 #!/bin/bash
+# Train every number format concurrently, one pinned worker per format.
+# Extra arguments are forwarded to annsim.sweep (e.g. --cores-per-job 16).
 
-mkdir -p P8
-
-sed -i "s/num_format = .*/num_format = bit_8/g" mnist_posit.py
-
-python mnist_posit.py
-
-mv train.hist P8
-mv test.hist P8
-
-#######
-mkdir -p P10
-
-sed -i "s/num_format = .*/num_format = bit_10/g" mnist_posit.py
-
-python mnist_posit.py
-
-mv train.hist P10
-mv test.hist P10
-
-#######
-mkdir -p P12
-
-sed -i "s/num_format = .*/num_format = bit_12/g" mnist_posit.py
-
-python mnist_posit.py
-
-mv train.hist P12
-mv test.hist P12
-
-#######
-mkdir -p P14
-
-sed -i "s/num_format = .*/num_format = bit_14/g" mnist_posit.py
-
-python mnist_posit.py
-
-mv train.hist P14
-mv test.hist P14
-
-#######
-mkdir -p P16
-
-sed -i "s/num_format = .*/num_format = bit_16/g" mnist_posit.py
-
-python mnist_posit.py
-
-mv train.hist P16
-mv test.hist P16
-
-#######
-mkdir -p FP16
-
-sed -i "s/num_format = .*/num_format = IEEE_Half/g" mnist_posit.py
-
-python mnist_posit.py
-
-mv train.hist FP16
-mv test.hist FP16
-
-#######
-mkdir -p bfloat16
-
-sed -i "s/num_format = .*/num_format = bfloat16/g" mnist_posit.py
-
-python mnist_posit.py
-
-mv train.hist bfloat16
-mv test.hist bfloat16
+cd "$(dirname "$0")/.."
 
+python -m annsim.sweep MNIST/mnist_posit.py --outdir MNIST \
+    --formats bit_8 bit_10 bit_12 bit_14 bit_16 bit_20 bit_24 bit_28 bit_32 IEEE_Half bfloat16 "$@"
@@ -0,0 +1,6 @@
+"""Helpers shared by the low precision training scripts in DNN/.
+
+The dataset scripts (MNIST/, SVHN/, CIFAR10/) add the DNN/ directory to
+``sys.path`` and import from here, so the package is used in place and
+does not need to be installed.
+"""
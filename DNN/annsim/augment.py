@@ -0,0 +1,98 @@
+"""Batch-level data augmentation on uint8 image tensors.
+
+``BatchAugment`` does the work of the per-sample torchvision pipelines
+(``RandomCrop(size, padding)``, ``RandomHorizontalFlip``, ``CenterCrop``,
+``ToTensor`` and ``Normalize``) on a whole ``(B, C, H, W)`` uint8 batch
+after it has been moved to the device: the crops (and flips) of all
+images are a single gather into the zero-padded batch, and ``ToTensor`` +
+``Normalize`` are fused into one scale and shift. The fused
+normalization matches torchvision up to float32 rounding.
+
+The random offsets come from a generator owned by the augmenter, so a
+run is reproducible from its seed independently of the DataLoader
+workers.
+"""
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+
+class BatchAugment:
+    """Crop, flip and normalize uint8 batches; see the module documentation."""
+
+    def __init__(self, size=None, padding=0, random=False, flip=False, center=False,
+                 mean=(0.0,), std=(1.0,), seed=0):
+        self.size = size
+        self.padding = padding
+        self.random = random
+        self.flip = flip
+        self.center = center
+        self.mean = tuple(mean)
+        self.std = tuple(std)
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+    @classmethod
+    def from_transform(cls, transform, seed=0):
+        """Build the batch equivalent of a torchvision ``Compose``."""
+        kwargs = {}
+        for t in transform.transforms:
+            if isinstance(t, transforms.RandomCrop):
+                kwargs.update(size=t.size[0], padding=t.padding, random=True)
+            elif isinstance(t, transforms.CenterCrop):
+                kwargs.update(size=t.size[0], center=True)
+            elif isinstance(t, transforms.RandomHorizontalFlip):
+                kwargs.update(flip=True)
+            elif isinstance(t, transforms.Normalize):
+                kwargs.update(mean=t.mean, std=t.std)
+            elif not isinstance(t, transforms.ToTensor):
+                raise ValueError(f"no batch version of {t}")
+        return cls(seed=seed, **kwargs)
+
+    def state_dict(self):
+        return {"generator": self.generator.get_state()}
+
+    def load_state_dict(self, state):
+        self.generator.set_state(state["generator"])
+
+    def _crop(self, x):
+        B, C, H, W = x.shape
+        pad = self.padding
+        if self.center and self.size > H:
+            pad = (self.size - H) // 2
+        if pad:
+            x = F.pad(x, (pad, pad, pad, pad))
+        Hp, Wp = H + 2*pad, W + 2*pad
+        if self.random:
+            oy = torch.randint(0, Hp - self.size + 1, (B,), generator=self.generator)
+            ox = torch.randint(0, Wp - self.size + 1, (B,), generator=self.generator)
+        else:
+            oy = torch.full((B,), (Hp - self.size) // 2, dtype=torch.long)
+            ox = torch.full((B,), (Wp - self.size) // 2, dtype=torch.long)
+        ar = torch.arange(self.size)
+        rows = oy[:, None] + ar
+        cols = ox[:, None] + ar
+        if self.flip:
+            flip = torch.rand(B, generator=self.generator) < 0.5
+            cols = torch.where(flip[:, None], cols.flip(1), cols)
+        rows, cols = rows.to(x.device), cols.to(x.device)
+        batch = torch.arange(B, device=x.device)[:, None, None, None]
+        channel = torch.arange(C, device=x.device)[None, :, None, None]
+        # Indexing every dimension gives a B, C, size, size result in NCHW
+        # order; a slice for the channels would give it channels_last
+        # strides, which the quantizers would keep.
+        return x[batch, channel, rows[:, None, :, None], cols[:, None, None, :]]
+
+    def __call__(self, x):
+        if self.size is not None:
+            x = self._crop(x)
+        std = torch.tensor(self.std, device=x.device).view(1, -1, 1, 1)
+        mean = torch.tensor(self.mean, device=x.device).view(1, -1, 1, 1)
+        scale = 1.0 / (255.0 * std)
+        shift = -mean / std
+        return torch.addcmul(shift, x.float(), scale).contiguous()
+
+    def __repr__(self):
+        return (f"BatchAugment(size={self.size}, padding={self.padding}, random={self.random}, "
+                f"flip={self.flip}, center={self.center}, mean={self.mean}, std={self.std})")
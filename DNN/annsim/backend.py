@@ -0,0 +1,104 @@
+"""Device, threads, data loading and memory format of the training scripts.
+
+:func:`select_device` picks CUDA when it is available and the CPU
+otherwise. On the CPU, :func:`configure` shares the cores the process
+may run on (its affinity, which :mod:`annsim.sweep` restricts when
+several format runs share a node) between the DataLoader workers and
+the intra-op threads of torch, and leaves one inter-op thread: the
+formats of a run and the layers of a model run one after the other. The
+workers decode and augment every batch from the image files, so they
+get their own cores; with the memory-mapped cache of :mod:`annsim.data`
+one worker copies slices and the compute threads take every core.
+Pinned memory only serves copies to a GPU.
+
+The ResNets run in ``channels_last`` on the CPU
+(:data:`annsim.models.CHANNELS_LAST`), the NHWC layout of the oneDNN
+convolutions, which the quantizers keep
+(:func:`annsim.quant.quant_function`).
+"""
+
+import os
+
+import torch
+
+from .models import CHANNELS_LAST
+
+DEVICES = ("auto", "cpu", "cuda")
+MEMORY_FORMATS = ("auto", "contiguous", "channels_last")
+# DataLoader workers of a GPU run, as before the CPU backend.
+GPU_WORKERS = 8
+
+
+def select_device(name="auto"):
+    """``name``, or for ``"auto"`` CUDA if it is available and else the CPU."""
+    if name not in DEVICES:
+        raise ValueError(f"unknown device '{name}'")
+    if name == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return name
+
+
+def cpu_cores():
+    """Number of cores the process may run on."""
+    return len(os.sched_getaffinity(0))
+
+
+def loader_workers(cores, cached=False):
+    """DataLoader workers for ``cores`` cores: one reading the cache, else
+    a quarter of the cores (at least one, at most eight).
+    """
+    if cached:
+        return 1
+    return max(1, min(8, cores // 4))
+
+
+def configure(device, workers=None, cached=False):
+    """Set the torch threads for a run on ``device``; return the keyword
+    arguments of its DataLoaders.
+
+    ``workers`` overrides the number of DataLoader workers; ``cached``
+    tells that the batches come from the cache of :mod:`annsim.data`.
+    """
+    if device == "cpu":
+        cores = cpu_cores()
+        if workers is None:
+            workers = loader_workers(cores, cached)
+        threads = cores if cached else max(1, cores - workers)
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # already set, or inter-op work already started
+            pass
+        pin_memory = False
+    else:
+        if workers is None:
+            workers = GPU_WORKERS
+        pin_memory = True
+    # no persistent workers: their random states would outlive an epoch and
+    # not be restored on resume (see annsim.checkpoint)
+    return {"num_workers": workers, "pin_memory": pin_memory}
+
+
+def memory_format(dataset, device, name="auto"):
+    """Memory format of the model of ``dataset`` on ``device``; ``name`` is
+    one of :data:`MEMORY_FORMATS`. Models that cannot run in
+    ``channels_last`` (LeNet) stay contiguous.
+    """
+    if name not in MEMORY_FORMATS:
+        raise ValueError(f"unknown memory format '{name}'")
+    if name == "auto":
+        name = "channels_last" if device == "cpu" else "contiguous"
+    if name == "channels_last" and CHANNELS_LAST[dataset]:
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+def describe(device, loader_kwargs, fmt):
+    """One line describing the settings of a run, for its log."""
+    line = f"device {device}, {loader_kwargs['num_workers']} DataLoader workers"
+    if device == "cpu":
+        line += (f", {torch.get_num_threads()} threads on {cpu_cores()} cores, "
+                 f"{torch.get_num_interop_threads()} inter-op")
+    name = "channels_last" if fmt == torch.channels_last else "contiguous"
+    return f"{line}, {name} models"
@@ -0,0 +1,158 @@
+"""Periodic checkpoints of a training run, written in the background.
+
+A checkpoint holds everything the next epoch depends on: the models, the
+SGD state wrapped by ``OptimLP`` (momentum buffers) and its weight
+accumulators (or the packed ones of ``PackedOptimLP``), the partial
+histories, and the random number generator states (torch CPU/CUDA,
+numpy, python, the batch augmenters and the counter-based generators of
+:mod:`annsim.philox`). The global torch generator drives the DataLoader
+shuffling and the stochastic rounding of ``momentum_quant``/``acc_quant``
+(:mod:`annsim.posit` and :mod:`annsim.floating`, see
+:func:`annsim.quant.quant_function`; with ``--rounding-seed`` the
+counter-based generators instead), so restoring it at an epoch boundary
+makes a resumed run continue bit-identically. Numbers rounded by
+qtorch_plus itself (neither Posit nor FloatingPoint) draw from its own
+``std::mt19937`` and are not reproducible.
+
+This also holds because the DataLoader workers are not persistent: each
+epoch starts new workers seeded from the global generator, whereas
+persistent workers would keep the seed drawn for the first epoch, which
+a checkpoint does not hold.
+
+The state is copied to CPU memory when ``save`` is called and written to
+disk by a background thread (to a temporary file renamed on completion),
+so training only waits for the copy.
+"""
+
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def _to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _params(optimizer):
+    return [p for group in optimizer.param_groups for p in group["params"]]
+
+
+def optimizer_state(optimizer):
+    """Return the state of an ``OptimLP`` (or plain torch) optimizer."""
+    inner = getattr(optimizer, "optim", optimizer)
+    state = {"optim": inner.state_dict()}
+    # by parameter index: per-layer optimizers keep some layers in float32
+    for key in ("weight_acc", "momentum"):
+        tensors = getattr(optimizer, key, None)
+        if tensors:
+            state[key] = {i: tensors[p] for i, p in enumerate(_params(optimizer)) if p in tensors}
+    return state
+
+
+def load_optimizer_state(optimizer, state):
+    """Restore a state returned by :func:`optimizer_state`."""
+    getattr(optimizer, "optim", optimizer).load_state_dict(state["optim"])
+    params = _params(optimizer)
+    for key in ("weight_acc", "momentum"):
+        # PackedOptimLP keeps them as integer codes, replaced rather than copied
+        tensors = getattr(optimizer, key, None)
+        for i, t in state.get(key, {}).items():
+            tensors[params[i]] = t.to(params[i].device)
+
+
+def rng_state(augmenters=(), generators=()):
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "python": random.getstate(),
+        "augment": [a.state_dict() for a in augmenters],
+        "counter": [g.state_dict() for g in generators],
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def load_rng_state(state, augmenters=(), generators=()):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    for a, s in zip(augmenters, state["augment"]):
+        a.load_state_dict(s)
+    for g, s in zip(generators, state.get("counter", [])):
+        g.load_state_dict(s)
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class Checkpointer:
+    """Save the run every ``every`` epochs to ``path`` and resume from it.
+
+    ``formats`` names the models; resuming with other formats is refused.
+    """
+
+    def __init__(self, path, models, optimizers, formats, augmenters=(), generators=(), every=1):
+        self.path = path
+        self.models = models
+        self.optimizers = optimizers
+        self.formats = list(formats)
+        self.augmenters = list(augmenters)
+        self.generators = list(generators)
+        self.every = every
+        self._thread = None
+
+    def state(self, epoch, train_hist, test_hist):
+        return {
+            "epoch": epoch,
+            "formats": self.formats,
+            "models": [m.state_dict() for m in self.models],
+            "optimizers": [optimizer_state(o) for o in self.optimizers],
+            "rng": rng_state(self.augmenters, self.generators),
+            "train_hist": train_hist,
+            "test_hist": test_hist,
+        }
+
+    def save(self, epoch, train_hist, test_hist):
+        """Snapshot the run after ``epoch`` and write it in the background."""
+        state = _to_cpu(self.state(epoch, train_hist, test_hist))
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(state,))
+        self._thread.start()
+
+    def step(self, epoch, train_hist, test_hist):
+        """Save after ``epoch`` if it is a checkpoint epoch."""
+        if self.every > 0 and (epoch + 1) % self.every == 0:
+            self.save(epoch, train_hist, test_hist)
+
+    def _write(self, state):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + ".tmp"
+        torch.save(state, tmp)
+        os.replace(tmp, self.path)
+
+    def wait(self):
+        """Block until the last checkpoint is on disk."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def load(self):
+        """Restore the run; return ``(next epoch, train_hist, test_hist)``."""
+        state = torch.load(self.path, map_location="cpu", weights_only=False)
+        if state["formats"] != self.formats:
+            raise ValueError(f"checkpoint {self.path} trains {state['formats']}, not {self.formats}")
+        for model, s in zip(self.models, state["models"]):
+            model.load_state_dict(s)
+        for optimizer, s in zip(self.optimizers, state["optimizers"]):
+            load_optimizer_state(optimizer, s)
+        load_rng_state(state["rng"], self.augmenters, self.generators)
+        return state["epoch"] + 1, state["train_hist"], state["test_hist"]
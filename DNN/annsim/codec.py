@@ -0,0 +1,230 @@
+"""Integer codes of the values of the number formats up to 16 bits.
+
+A tensor rounded to a format (e.g. by :func:`annsim.quant.quant_function`)
+holds only values of that format, which are stored exactly by their bit
+patterns: ``uint8`` codes for formats up to 8 bits, ``int16`` up to 16.
+
+* :class:`PositCodec`: the posit bit pattern, two's complement for the
+  negative values, ``0`` for zero and ``100...0`` for NaR (NaN);
+* :class:`FloatCodec`: sign, exponent and mantissa of a
+  ``FloatingPoint(exp, man)``. The formats of qtorch_plus (and of
+  :mod:`annsim.floating`) have no subnormals but one more exponent than
+  IEEE 754, ``-2**(exp-1) + 1``, so their bias is ``2**(exp-1)`` and the
+  exponent field ``0`` is the signed zero. With ``exp=8`` that exponent,
+  ``-127``, is the one of the float32 subnormals, which hold the values
+  of the field ``1`` as the rounding produces them.
+
+``decode(encode(x))`` returns ``x`` for values of the format (a posit
+negative zero comes back as zero); other values are not detected by
+``encode``, :meth:`Codec.exact` checks a round trip. Codes are decoded
+with a table of the values of all the codes of the format, built once
+per device.
+
+The values of a format have no float32 mantissa bits below its fraction
+bits, so the float32 bits above them are a key of the code (the keys of
+:mod:`annsim.posit` for posits): formats with at most
+:data:`annsim.posit.LOOKUP_MAX_BITS` key bits are encoded with a table
+of the code of every key, built once per format and device by the
+computation (a search of the posit values, the fields of the float)
+that encodes the other formats. Both directions go through
+:data:`CHUNK` elements at a time. :meth:`Codec.spec` describes a codec
+as JSON for :func:`from_spec`.
+"""
+
+import functools
+
+import torch
+from qtorch_plus import FloatingPoint
+
+from .formats import bits
+from .posit import LOOKUP_MAX_BITS, TABLE_MAX_NSIZE, _lookup_shift, _tables
+
+# Elements encoded or decoded at once: the passes over them are faster on
+# CPU while they stay in the caches.
+CHUNK = 1 << 16
+
+
+def _to_storage(code, nbits):
+    if nbits <= 8:
+        return code.to(torch.uint8)
+    return torch.where(code >= 1 << 15, code - (1 << 16), code).to(torch.int16)
+
+
+def _from_storage(codes):
+    index = codes.int()
+    return index if codes.dtype == torch.uint8 else index.bitwise_and_(0xFFFF)
+
+
+class Codec:
+    """Codes of one number format; see the module documentation."""
+
+    # float32 bits below the keys of the encoding table, None without one
+    key_shift = None
+
+    def __init__(self, nbits):
+        self.bits = nbits
+        self.dtype = torch.uint8 if nbits <= 8 else torch.int16
+        self._tables = {}
+
+    def encode(self, x, out=None):
+        """Codes of the values of ``x``, of its shape (written to ``out`` if given)."""
+        flat = x.float().contiguous().view(-1)
+        codes = torch.empty(x.shape, dtype=self.dtype, device=x.device) if out is None else out
+        flat_codes = codes.view(-1)
+        if self.key_shift is not None:
+            table = _encode_table(type(self), self.args(), x.device)
+            mask = (1 << (32 - self.key_shift)) - 1
+        for start in range(0, len(flat), CHUNK):
+            xf = flat[start:start + CHUNK]
+            if self.key_shift is None:
+                flat_codes[start:start + CHUNK] = self._encode(xf)
+            else:
+                keys = (xf.view(torch.int32) >> self.key_shift).bitwise_and_(mask)
+                torch.index_select(table, 0, keys, out=flat_codes[start:start + CHUNK])
+        return codes
+
+    def _encode(self, xf):
+        """Codes of the values of the 1-d float32 ``xf``, computed."""
+        raise NotImplementedError
+
+    def values(self, code):
+        """float32 values of the int64 codes ``code``."""
+        raise NotImplementedError
+
+    def decode(self, codes, out=None):
+        """float32 values of ``codes``, of their shape (written to ``out`` if given)."""
+        if codes.device not in self._tables:
+            self._tables[codes.device] = self.values(
+                torch.arange(1 << self.bits, dtype=torch.int64)).to(codes.device)
+        table = self._tables[codes.device]
+        flat = codes.reshape(-1)
+        if out is None:
+            out = torch.empty(codes.shape, dtype=torch.float32, device=codes.device)
+        values = out.view(-1)
+        for start in range(0, len(flat), CHUNK):
+            torch.index_select(table, 0, _from_storage(flat[start:start + CHUNK]),
+                               out=values[start:start + CHUNK])
+        return out
+
+    def args(self):
+        """The arguments of the constructor."""
+        raise NotImplementedError
+
+    def spec(self):
+        raise NotImplementedError
+
+    def exact(self, x, codes):
+        """Whether ``codes`` decode to ``x``, NaN included."""
+        y = self.decode(codes).view_as(x)
+        return bool(((y == x) | (y.isnan() & x.isnan())).all())
+
+
+class PositCodec(Codec):
+    def __init__(self, nsize, es):
+        if nsize > TABLE_MAX_NSIZE:
+            raise ValueError(f"no codes for posits wider than {TABLE_MAX_NSIZE} bits")
+        super(PositCodec, self).__init__(nsize)
+        self.nsize = nsize
+        self.es = es
+        if 32 - _lookup_shift(nsize, es) <= LOOKUP_MAX_BITS:
+            self.key_shift = _lookup_shift(nsize, es)
+
+    def args(self):
+        return self.nsize, self.es
+
+    def spec(self):
+        return {"posit": [self.nsize, self.es]}
+
+    def _encode(self, xf):
+        n = self.nsize
+        values = _tables(n, self.es, xf.device)[0]
+        ax = xf.abs()
+        code = torch.searchsorted(values, ax.clamp(max=values[-1])) + 1
+        code = torch.where(xf < 0, (1 << n) - code, code)
+        code = torch.where(xf == 0, 0, code)
+        code = torch.where(xf.isnan(), 1 << (n - 1), code)
+        return _to_storage(code, n)
+
+    def values(self, code):
+        n = self.nsize
+        values = _tables(n, self.es, code.device)[0]
+        nar = code == 1 << (n - 1)
+        negative = (code >> (n - 1)) & 1 == 1
+        magnitude = torch.where(negative, (1 << n) - code, code)
+        value = values[(magnitude - 1).clamp(0, len(values) - 1)]
+        value = torch.where(magnitude == 0, 0.0, value)
+        value = torch.where(negative, -value, value)
+        return torch.where(nar, float("nan"), value)
+
+
+class FloatCodec(Codec):
+    def __init__(self, exp, man):
+        if 1 + exp + man > 16 or exp > 8 or man > 23:
+            raise ValueError(f"no codes for FloatingPoint(exp={exp}, man={man})")
+        super(FloatCodec, self).__init__(1 + exp + man)
+        self.exp = exp
+        self.man = man
+        self.bias = 1 << (exp - 1)
+        if 9 + man <= LOOKUP_MAX_BITS:
+            self.key_shift = 23 - man
+
+    def args(self):
+        return self.exp, self.man
+
+    def spec(self):
+        return {"float": [self.exp, self.man]}
+
+    def _encode(self, xf):
+        exp, man = self.exp, self.man
+        b = xf.view(torch.int32).long() & 0xFFFFFFFF
+        sign = b >> 31
+        e = (b >> 23) & 0xFF
+        # zero, and with exp=8 the float32 subnormals as the lowest exponent
+        stored = torch.where((b & 0x7FFFFFFF) >> (23 - man) == 0, 0,
+                             (e - 127 + self.bias).clamp(0, (1 << exp) - 1))
+        mantissa = torch.where(stored == 0, 0, (b >> (23 - man)) & ((1 << man) - 1))
+        return _to_storage((sign << (exp + man)) | (stored << man) | mantissa, self.bits)
+
+    def values(self, code):
+        exp, man = self.exp, self.man
+        sign = (code >> (exp + man)) & 1
+        stored = (code >> man) & ((1 << exp) - 1)
+        mantissa = code & ((1 << man) - 1)
+        b = (sign << 31) | torch.where(stored == 0, 0,
+                                       ((stored - self.bias + 127) << 23) | (mantissa << (23 - man)))
+        b = torch.where(b >= 1 << 31, b - (1 << 32), b)
+        return b.to(torch.int32).view(torch.float32)
+
+
+@functools.lru_cache(maxsize=None)
+def _encode_table(cls, args, device):
+    # the code of every key, computed for its float32 bits with zeros below,
+    # ones for the exponent of infinities and NaN, which are NaN in any case
+    c = _codec(cls, *args)
+    keys = torch.arange(1 << (32 - c.key_shift), dtype=torch.int64) << c.key_shift
+    keys |= torch.where(keys & 0x7F800000 == 0x7F800000, (1 << c.key_shift) - 1, 0)
+    keys = torch.where(keys >= 1 << 31, keys - (1 << 32), keys).to(torch.int32)
+    return c._encode(keys.view(torch.float32)).to(device)
+
+
+def codec(number):
+    """Codec of ``number``, or ``None`` for float32 and formats without codes."""
+    if number is None or bits(number) > 16:
+        return None
+    if hasattr(number, "nsize") and hasattr(number, "es"):
+        return PositCodec(number.nsize, number.es)
+    if isinstance(number, FloatingPoint):
+        return FloatCodec(number.exp, number.man)
+    return None
+
+
+def from_spec(spec):
+    """Codec described by ``Codec.spec()``."""
+    if "posit" in spec:
+        return _codec(PositCodec, *spec["posit"])
+    return _codec(FloatCodec, *spec["float"])
+
+
+@functools.lru_cache(maxsize=None)
+def _codec(cls, *args):
+    return cls(*args)
@@ -0,0 +1,232 @@
+"""Analytical compute and memory cost of the models per number format.
+
+One forward pass of a single sample through the model of a dataset
+records the convolutions, linear layers and quantizers in execution
+order. The operands of a layer are taken to be in the formats of the
+quantizers around it: its input in the ``activation`` format of the last
+quantizer called before it (float32 if none), its output gradient in the
+``error`` format of the next one. For a format, a policy of
+:mod:`annsim.formats` or a :class:`~annsim.layerpolicy.LayerPolicy` JSON
+file the model reports, per layer,
+
+* ``macs``: multiply-accumulates of the forward pass, per sample;
+* ``bitops``: ``macs`` times the bits of both operands, for the forward
+  pass and for training (the two backward products, with the error);
+* ``weight_bytes``: weights read by the forward and backward passes and
+  written by the update, per step;
+* ``grad_bytes``: gradients written by the backward pass and read by the
+  update, per step;
+* ``optimizer_bytes``: momentum and gradient accumulator read and written
+  by the update, per step;
+
+and per quantizer ``activation_bytes``/``error_bytes``, written by one
+pass and read by the other for a batch of ``--batch-size`` samples. The
+totals are joined with the final and best test accuracy of the histories
+of every format (``<dataset>/<format dir>/test.hist``), for plots of
+accuracy against the modeled cost. Run from the ``DNN/`` directory::
+
+    python -m annsim.costmodel MNIST --out MNIST/cost.json --plot MNIST/cost.pdf
+"""
+
+import argparse
+import json
+import os
+
+import torch
+import torch.nn as nn
+
+from .formats import NAMES, bits, result_dir
+from .layerpolicy import LayerPolicy, layer_of
+from .models import MODELS
+from .ptq import FP32
+from .quant import Quantizer
+
+# Shape of one preprocessed sample (MNIST is center-cropped to 32x32).
+INPUT_SHAPES = {"MNIST": (1, 32, 32), "SVHN": (3, 32, 32), "CIFAR10": (3, 32, 32)}
+COSTS = ("macs", "bitops", "bitops_train", "weight_bytes", "grad_bytes", "optimizer_bytes",
+         "activation_bytes", "error_bytes", "bytes")
+
+
+def trace(model, sample):
+    """``(name, module, output elements)`` of the layers and quantizers of
+    ``model`` in the order of one forward pass of ``sample`` in eval mode.
+    """
+    events = []
+
+    def record(name, module, input, output):
+        events.append((name, module, output.numel()))
+
+    hooks = [m.register_forward_hook(lambda m, i, o, name=name: record(name, m, i, o))
+             for name, m in model.named_modules()
+             if isinstance(m, (nn.Conv2d, nn.Linear, Quantizer))]
+    training = model.training
+    try:
+        with torch.no_grad():
+            model.eval()(sample)
+    finally:
+        model.train(training)
+        for hook in hooks:
+            hook.remove()
+    return events
+
+
+def _macs(module, elements):
+    if isinstance(module, nn.Conv2d):
+        return (elements * module.in_channels // module.groups *
+                module.kernel_size[0] * module.kernel_size[1])
+    return elements * module.in_features
+
+
+def costs(model, layer_policy, sample, batch_size=128, momentum=True):
+    """Per layer and per quantizer costs of ``model`` quantized by ``layer_policy``."""
+    layers, sites, pending = {}, {}, []
+    activation = None
+    for name, module, elements in trace(model, sample):
+        if isinstance(module, Quantizer):
+            for entry in pending:
+                entry["error_bits"] = bits(module.backward_number)
+            pending = []
+            activation = module.forward_number
+            site = sites.setdefault(name, {"elements": 0,
+                                           "activation_bits": bits(module.forward_number),
+                                           "error_bits": bits(module.backward_number)})
+            site["elements"] += elements
+        else:
+            entry = {"macs": _macs(module, elements), "input_bits": bits(activation),
+                     "error_bits": 32}
+            layers[name] = entry
+            pending.append(entry)
+
+    params = {}
+    for name, p in model.named_parameters():
+        params[layer_of(name)] = params.get(layer_of(name), 0) + p.numel()
+    for layer, n in params.items():
+        entry = layers.setdefault(layer, {"macs": 0, "input_bits": 32, "error_bits": 32})
+        w, g, m, acc = (bits(layer_policy.number(role, layer))
+                        for role in ("weight", "grad", "momentum", "acc"))
+        a, e = entry["input_bits"], entry["error_bits"]
+        acc_state = layer_policy.number("acc", layer) is not None
+        entry.update(params=n, weight_bits=w,
+                     bitops=entry["macs"] * w * a,
+                     bitops_train=entry["macs"] * (w * a + w * e + a * e),
+                     weight_bytes=3 * n * w // 8,
+                     grad_bytes=2 * n * g // 8,
+                     optimizer_bytes=2 * n * ((m if momentum else 0) + (acc if acc_state else 0)) // 8)
+    for site in sites.values():
+        site["activation_bytes"] = 2 * batch_size * site["elements"] * site["activation_bits"] // 8
+        site["error_bytes"] = 2 * batch_size * site["elements"] * site["error_bits"] // 8
+    return {"layers": layers, "sites": sites}
+
+
+def totals(cost):
+    """Sums of the per layer and per quantizer entries of :func:`costs`."""
+    total = {key: sum(e.get(key, 0) for e in cost["layers"].values())
+             for key in ("macs", "bitops", "bitops_train", "weight_bytes", "grad_bytes",
+                         "optimizer_bytes")}
+    for key in ("activation_bytes", "error_bytes"):
+        total[key] = sum(s[key] for s in cost["sites"].values())
+    total["bytes"] = sum(total[key] for key in ("weight_bytes", "grad_bytes", "optimizer_bytes",
+                                                "activation_bytes", "error_bytes"))
+    return total
+
+
+def load_policy(name):
+    """``(run name, LayerPolicy)`` of a format, ``FP32`` or a policy JSON file."""
+    if name.endswith(".json"):
+        return os.path.splitext(os.path.basename(name))[0], LayerPolicy.load(name)
+    return name, LayerPolicy(None if name == FP32 else name)
+
+
+def accuracy(dataset_dir, name):
+    """Final and best test accuracy of the run ``name``, ``None`` without history."""
+    path = os.path.join(dataset_dir, result_dir(name), "test.hist")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        hist = json.load(f)
+    if not hist:
+        return None
+    return {"final_accuracy": hist[-1]["accuracy"],
+            "best_accuracy": max(h["accuracy"] for h in hist), "epochs": len(hist)}
+
+
+def table(dataset, formats, batch_size=128, momentum=True, dataset_dir=None):
+    """One row per format with its totals, per layer costs and accuracies."""
+    sample = torch.zeros(1, *INPUT_SHAPES[dataset])
+    rows = []
+    for spec in formats:
+        name, layer_policy = load_policy(spec)
+        cost = costs(MODELS[dataset](layer_policy), layer_policy, sample, batch_size, momentum)
+        row = {"format": name, **totals(cost), **cost}
+        if dataset_dir is not None:
+            row.update(accuracy(dataset_dir, name) or {})
+        rows.append(row)
+    return rows
+
+
+def print_table(rows):
+    print(f"{'format':>12} {'MMACs':>8} {'Gbitops':>8} {'train':>8} {'weights':>9} "
+          f"{'grads':>9} {'optim':>9} {'acts':>10} {'errors':>10} {'accuracy':>9}")
+    for r in rows:
+        acc = f"{r['final_accuracy']:>8.2f}%" if "final_accuracy" in r else f"{'-':>9}"
+        print(f"{r['format']:>12} {r['macs'] / 1e6:>8.2f} {r['bitops'] / 1e9:>8.2f} "
+              f"{r['bitops_train'] / 1e9:>8.2f} {r['weight_bytes']:>9} {r['grad_bytes']:>9} "
+              f"{r['optimizer_bytes']:>9} {r['activation_bytes']:>10} {r['error_bytes']:>10} {acc}")
+
+
+def print_layers(row):
+    print(f"{row['format']}:")
+    print(f"{'layer':>24} {'MACs':>10} {'bits w/a/e':>11} {'bitops':>12} {'bytes':>10}")
+    for name, e in row["layers"].items():
+        moved = e.get("weight_bytes", 0) + e.get("grad_bytes", 0) + e.get("optimizer_bytes", 0)
+        operands = f"{e.get('weight_bits', 32)}/{e['input_bits']}/{e['error_bits']}"
+        print(f"{name:>24} {e['macs']:>10} {operands:>11} {e.get('bitops', 0):>12} {moved:>10}")
+
+
+def plot(rows, path, cost="bitops_train"):
+    """Final test accuracy against ``cost`` of every row with a history."""
+    import matplotlib.pyplot as plt
+
+    rows = [r for r in rows if "final_accuracy" in r]
+    fig, ax = plt.subplots()
+    ax.scatter([r[cost] for r in rows], [r["final_accuracy"] for r in rows])
+    for r in rows:
+        ax.annotate(r["format"], (r[cost], r["final_accuracy"]))
+    ax.set_xscale("log")
+    ax.set_xlabel(cost)
+    ax.set_ylabel("test accuracy (%)")
+    fig.savefig(path, bbox_inches="tight")
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dataset", choices=list(MODELS))
+    parser.add_argument("--formats", nargs="+", default=[FP32, *NAMES],
+                        help=f"formats of {', '.join(NAMES)}, {FP32} or policy JSON files")
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--no-momentum", action="store_true",
+                        help="the optimizer keeps no momentum")
+    parser.add_argument("--histories", default=None,
+                        help="dataset folder with the <format dir>/test.hist, default <dataset>")
+    parser.add_argument("--layers", action="store_true", help="print the per layer costs")
+    parser.add_argument("--out", default=None, help="also write the rows as JSON")
+    parser.add_argument("--plot", default=None, help="plot accuracy against --cost to this file")
+    parser.add_argument("--cost", choices=COSTS, default="bitops_train")
+    args = parser.parse_args()
+
+    rows = table(args.dataset, args.formats, args.batch_size, not args.no_momentum,
+                 args.histories or args.dataset)
+    print_table(rows)
+    if args.layers:
+        for row in rows:
+            print_layers(row)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(rows, f, indent=1)
+    if args.plot:
+        plot(rows, args.plot, args.cost)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Memory-mapped uint8 cache of the MNIST, SVHN and CIFAR10 datasets.
+
+Each split is converted once into a raw ``(N, C, H, W)`` uint8 image file
+and an int64 label file next to the torchvision data. The files are
+opened with ``torch.from_file(..., shared=True)``, so DataLoader workers
+and concurrent format runs all read the same page cache instead of
+holding private copies. A deterministic transform (such as the test
+CenterCrop + ToTensor + Normalize) can be applied once and cached as a
+float32 file, keyed by the transform description.
+
+Convert a dataset ahead of time with::
+
+    python -m annsim.data MNIST MNIST/data/MNIST
+"""
+
+import argparse
+import hashlib
+import json
+import os
+
+import torch
+import torchvision
+import torchvision.transforms as transforms
+
+DATASETS = ("MNIST", "SVHN", "CIFAR10")
+_DTYPES = {"uint8": torch.uint8, "int64": torch.int64, "float32": torch.float32}
+
+
+def save_tensor(path, tensor):
+    """Write ``tensor`` as a raw file with a ``.json`` description next to it."""
+    tensor = tensor.contiguous()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(memoryview(tensor.numpy()))
+    os.replace(tmp, path)
+    meta = {"dtype": str(tensor.dtype).replace("torch.", ""), "shape": list(tensor.shape)}
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    # The metadata is written last: its presence marks a complete file.
+    os.replace(tmp, path + ".json")
+
+
+def load_tensor(path):
+    """Memory-map a file written by :func:`save_tensor`."""
+    with open(path + ".json") as f:
+        meta = json.load(f)
+    size = 1
+    for n in meta["shape"]:
+        size *= n
+    data = torch.from_file(path, shared=True, size=size, dtype=_DTYPES[meta["dtype"]])
+    return data.view(meta["shape"])
+
+
+def _torchvision(name, root, split):
+    ds = getattr(torchvision.datasets, name)
+    if name == "SVHN":
+        return ds(root, split=split, download=True)
+    return ds(root, train=split == "train", download=True)
+
+
+def build_cache(name, root, split):
+    """Convert the torchvision ``name`` dataset to uint8 image and label files."""
+    ds = _torchvision(name, root, split)
+    images = torch.as_tensor(ds.data)
+    if images.dim() == 3:
+        images = images.unsqueeze(1)        # MNIST: N, H, W
+    elif images.shape[-1] == 3:
+        images = images.permute(0, 3, 1, 2) # CIFAR10: N, H, W, C
+    labels = torch.as_tensor(ds.labels if name == "SVHN" else ds.targets, dtype=torch.int64)
+    prefix = os.path.join(root, f"{name}_{split}")
+    save_tensor(prefix + ".labels.i64", labels)
+    save_tensor(prefix + ".images.u8", images)
+
+
+def tensor_transform(transform):
+    """Return ``transform`` with ``ToTensor`` replaced by its uint8-tensor equivalent."""
+    if isinstance(transform, transforms.Compose):
+        return transforms.Compose([tensor_transform(t) for t in transform.transforms])
+    if isinstance(transform, transforms.ToTensor):
+        return transforms.ConvertImageDtype(torch.float32)
+    return transform
+
+
+class CachedDataset(torch.utils.data.Dataset):
+    """Dataset reading a split from the memory-mapped cache.
+
+    ``transform`` is applied to every uint8 ``(C, H, W)`` image as in the
+    torchvision datasets; ``ToTensor`` in it is handled by
+    :func:`tensor_transform`. With ``preprocess=True`` the transform must
+    be deterministic and is applied to the whole split once.
+    """
+
+    def __init__(self, name, root, split, transform=None, preprocess=False):
+        self.name, self.root, self.split = name, root, split
+        self.transform = None if transform is None else tensor_transform(transform)
+        self.preprocess = preprocess
+        prefix = os.path.join(root, f"{name}_{split}")
+        if not os.path.exists(prefix + ".images.u8.json"):
+            build_cache(name, root, split)
+        if preprocess and self.transform is not None:
+            key = hashlib.sha1(repr(self.transform).encode()).hexdigest()[:12]
+            self._preprocessed = f"{prefix}.{key}.f32"
+            if not os.path.exists(self._preprocessed + ".json"):
+                self._build_preprocessed(load_tensor(prefix + ".images.u8"))
+        self._open()
+
+    def _build_preprocessed(self, images, chunk=1024):
+        out = torch.cat([self.transform(images[i:i+chunk]) for i in range(0, len(images), chunk)])
+        save_tensor(self._preprocessed, out)
+
+    def _open(self):
+        prefix = os.path.join(self.root, f"{self.name}_{self.split}")
+        self.targets = load_tensor(prefix + ".labels.i64")
+        if self.preprocess and self.transform is not None:
+            self.data = load_tensor(self._preprocessed)
+        else:
+            self.data = load_tensor(prefix + ".images.u8")
+
+    def __getstate__(self):
+        # Workers reopen the mapping instead of receiving a pickled copy.
+        state = dict(self.__dict__)
+        del state["data"], state["targets"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        img = self.data[index]
+        if self.transform is not None and not self.preprocess:
+            img = self.transform(img)
+        return img, int(self.targets[index])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the memory-mapped cache of a dataset")
+    parser.add_argument("dataset", choices=DATASETS)
+    parser.add_argument("root", help="torchvision root of the dataset, e.g. MNIST/data/MNIST")
+    args = parser.parse_args()
+    for split in ("train", "test"):
+        build_cache(args.dataset, args.root, split)
+
+
+if __name__ == "__main__":
+    main()
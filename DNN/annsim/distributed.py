@@ -0,0 +1,304 @@
+"""Data-parallel training over processes, with gradients sent as codes.
+
+The training scripts run as one process per replica under ``torchrun``
+(the ``gloo`` backend, on the cores of one node or over several nodes)::
+
+    torchrun --nproc-per-node 4 SVHN/svhn_posit.py --format bit_8
+
+:func:`init` joins the process group from the ``torchrun`` environment and
+gives every local process its own share of the cores of the node, as
+:mod:`annsim.sweep` does for the jobs of a sweep. Every rank trains the
+same models on its part of each batch (:func:`train_loader`, the global
+batch being split between the ranks) and :class:`GradientReducer`
+averages the gradients before every optimizer step.
+
+The gradients are reduced after the gradient quantizer of the optimizer:
+every rank rounds its gradients by ``grad_quant`` as ``OptimLP`` does,
+which leaves only values of the gradient format, and the ranks exchange
+them as the ``uint8``/``int16`` codes of :mod:`annsim.codec` in a ring
+all-reduce (reduce-scatter then all-gather, Patarasuk and Yuan,
+"Bandwidth optimal all-reduce algorithms for clusters of workstations",
+JPDC 2009), 2-4x fewer bytes than float32. The partial sums passed along
+the ring are rounded to the gradient format at every hop, and the mean
+rounded once more by the rank that completes it, which sends its codes to
+the others: every rank gets the same gradients. These roundings make the
+mean depend on the number of ranks, unlike the float32 sum rounded once;
+``benchmarks/bench_ddp.py`` reports its relative error. Formats without
+codes (float32, more than 16 bits) are reduced in float32 by
+``torch.distributed.all_reduce``. The float formats have no NaN or
+infinity (they saturate), so the ranks first agree whether all their
+gradients are finite: the steps where some are not are reduced in
+float32 without rounding, and the NaN and infinities of one rank reach
+every rank, whose step then rounds them as in a single process.
+
+The replicas stay identical: they start from the weights of rank 0
+(:func:`broadcast`), step with the same gradients and round the weights,
+momentum and accumulators stochastically with the same counter-based
+draws of :class:`annsim.philox.CounterRNG`. The batch norms normalize by
+the statistics of the part of the batch of their rank and their running
+statistics are averaged at the end of every epoch
+(:func:`average_buffers`). The training results are summed over the ranks
+(:func:`reduce_results`); rank 0 evaluates the test set and shares the
+results with the others (:func:`broadcast_object`).
+
+``benchmarks/bench_ddp.py`` measures the scaling over 1-16 processes and
+the bytes sent per step.
+"""
+
+import contextlib
+import datetime
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DistributedSampler
+
+from .codec import codec
+from .metrics import MetricAccumulator
+from .optim import LayerwiseOptimLP
+from .quant import number_spec, quantizer
+from .sweep import core_sets
+
+# Rank 0 evaluates the test set while the others wait for its results.
+TIMEOUT = datetime.timedelta(hours=2)
+
+
+def world_size():
+    """Number of processes training together, 1 without a process group."""
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def is_main():
+    """Whether this process writes the histories, weights and logs."""
+    return rank() == 0
+
+
+def init():
+    """Join the process group described by the ``torchrun`` environment;
+    return the world size. Nothing is done for a single process.
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return 1
+    if not dist.is_initialized():
+        dist.init_process_group("gloo", timeout=TIMEOUT)
+    # the local processes share the cores of the node
+    local_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    cores = os.sched_getaffinity(0)
+    if local_size > 1 and len(cores) >= local_size:
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        os.sched_setaffinity(0, core_sets(cores, len(cores) // local_size)[local_rank])
+    return world_size()
+
+
+@contextlib.contextmanager
+def main_first():
+    """Let rank 0 run the block first, e.g. to download a dataset once."""
+    if not is_main():
+        dist.barrier()
+    yield
+    if is_main() and world_size() > 1:
+        dist.barrier()
+
+
+def train_loader(dataset, batch_size, **kwargs):
+    """Training ``DataLoader`` of this rank: ``batch_size`` images a step
+    split between the ranks, each reading its own shuffled part of
+    ``dataset``; call :func:`set_epoch` before every epoch.
+    """
+    if world_size() == 1:
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, **kwargs)
+    # every rank gets as many batches, padded with repeated samples
+    sampler = DistributedSampler(dataset, shuffle=True, seed=0)
+    return torch.utils.data.DataLoader(dataset, batch_size=max(1, batch_size // world_size()),
+                                       sampler=sampler, **kwargs)
+
+
+def set_epoch(loader, epoch):
+    """Shuffle the parts of the ranks anew for ``epoch``."""
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+@torch.no_grad()
+def broadcast(model):
+    """Copy the parameters and buffers of rank 0 to the other ranks."""
+    if world_size() > 1:
+        for t in model.state_dict().values():
+            # gloo sends contiguous tensors, not the channels_last weights
+            buf = t.contiguous()
+            dist.broadcast(buf, 0)
+            if buf is not t:
+                t.copy_(buf)
+
+
+@torch.no_grad()
+def average_buffers(model):
+    """Average the floating-point buffers (batch norm statistics) of the ranks."""
+    if world_size() > 1:
+        for b in model.buffers():
+            if b.is_floating_point():
+                dist.all_reduce(b)
+                b.div_(world_size())
+
+
+def reduce_results(results):
+    """Training results of ``run_epoch`` over the batches of every rank."""
+    if world_size() == 1:
+        return results
+    reduced = []
+    for r in results:
+        confusion = torch.tensor(r["confusion"], dtype=torch.int64)
+        metrics = MetricAccumulator(len(confusion), device="cpu")
+        metrics.confusion = confusion.view(-1)
+        metrics.loss_sum = torch.tensor(r["loss"] * int(confusion.sum()), dtype=torch.float64)
+        dist.all_reduce(metrics.confusion)
+        dist.all_reduce(metrics.loss_sum)
+        reduced.append(metrics.compute())
+    return reduced
+
+
+def broadcast_object(obj):
+    """``obj`` of rank 0 on every rank."""
+    if world_size() == 1:
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, 0)
+    return objects[0]
+
+
+def rank_path(path):
+    """``path`` for rank 0, ``<path>.rank<N>`` for the others: the random
+    states of the data of the ranks differ, so each keeps a checkpoint.
+    """
+    return path if is_main() else f"{path}.rank{rank()}"
+
+
+def _grad_quants(optimizer):
+    """Gradient quantizer of every parameter of an ``OptimLP`` and whether
+    its step scales the gradients.
+    """
+    params = [p for group in optimizer.param_groups for p in group["params"]]
+    if isinstance(optimizer, LayerwiseOptimLP):
+        return {p: optimizer.quants[p]["grad"] for p in params}, True
+    # OptimLP scales the gradients only with a gradient quantizer
+    return {p: optimizer.grad_quant for p in params}, optimizer.grad_quant is not None
+
+
+def _exchange(send, recv, dst, src):
+    requests = []
+    if send.numel():
+        requests.append(dist.isend(send.view(torch.uint8), dst))
+    if recv.numel():
+        requests.append(dist.irecv(recv.view(torch.uint8), src))
+    for r in requests:
+        r.wait()
+
+
+class GradientReducer:
+    """Average the gradients of ``optimizer`` (an ``OptimLP``) over the
+    ranks before each of its steps, as codes of the gradient formats.
+
+    The parameters are bucketed by gradient format, one ring all-reduce
+    per bucket. The mean is written to ``p.grad`` divided by the gradient
+    scaling, so that the rounding of the step gives it back. ``packed=False``
+    reduces every bucket in float32 instead (rounding only the mean), for
+    comparison. A step with a non-finite gradient on any rank is reduced
+    in float32 without rounding. ``sent`` counts the bytes sent by this
+    rank and ``float32_sent`` those a float32 ring all-reduce would send.
+    """
+
+    def __init__(self, optimizer, packed=True):
+        self.optimizer = optimizer
+        self.packed = packed
+        self.quants, self.scaled = _grad_quants(optimizer)
+        self.buckets = {}
+        for p, quant in self.quants.items():
+            number = getattr(quant, "forward_number", None)
+            key = number_spec(number)
+            bucket = self.buckets.setdefault(key if key is not None else repr(number),
+                                             {"number": number, "params": []})
+            bucket["params"].append(p)
+        for bucket in self.buckets.values():
+            number = bucket["number"]
+            bucket["codec"] = codec(number) if packed else None
+            bucket["quant"] = (None if number is None
+                               else quantizer(forward_number=number, forward_rounding="nearest"))
+        self.sent = self.float32_sent = 0
+        self.handle = optimizer.register_step_pre_hook(lambda *args: self.reduce())
+
+    @torch.no_grad()
+    def reduce(self):
+        world = world_size()
+        if world == 1:
+            return
+        scaling = self.optimizer.grad_scaling if self.scaled else 1.0
+        buckets = []
+        for bucket in self.buckets.values():
+            params = [p for p in bucket["params"] if p.grad is not None]
+            if params:
+                buckets.append((bucket, params))
+        # the float formats round NaN and infinities to finite values
+        finite = True
+        if any(bucket["codec"] is not None for bucket, _ in buckets):
+            flag = torch.tensor([all(bool(p.grad.isfinite().all())
+                                     for _, params in buckets for p in params)],
+                                dtype=torch.int32)
+            dist.all_reduce(flag, op=dist.ReduceOp.MIN)
+            finite = bool(flag)
+        for bucket, params in buckets:
+            grads = []
+            for p in params:
+                grad = p.grad * scaling if self.scaled else p.grad
+                quant = self.quants[p] if finite else None
+                grads.append((grad if quant is None else quant(grad)).reshape(-1))
+            # gloo sends and receives CPU tensors
+            flat = torch.cat(grads).float().cpu()
+            if not finite:
+                mean = self._all_reduce(flat, None)
+            elif bucket["codec"] is None:
+                mean = self._all_reduce(flat, bucket["quant"])
+            else:
+                mean = self._ring_all_reduce(flat, bucket["quant"], bucket["codec"])
+            self.float32_sent += 2 * (world - 1) * flat.numel() * 4 // world
+            offset = 0
+            for p in params:
+                n = p.grad.numel()
+                p.grad.copy_(mean[offset:offset + n].view_as(p.grad) / scaling)
+                offset += n
+
+    def _all_reduce(self, flat, quant):
+        world = world_size()
+        dist.all_reduce(flat)
+        self.sent += 2 * (world - 1) * flat.numel() * 4 // world
+        mean = flat / world
+        return mean if quant is None else quant(mean)
+
+    def _ring_all_reduce(self, flat, quant, codec):
+        world, r = world_size(), rank()
+        dst, src = (r + 1) % world, (r - 1) % world
+        chunks = flat.tensor_split(world)
+        # reduce-scatter: the partial sum of chunk (r - step) goes to the next
+        # rank; rank r ends with the sum of chunk r + 1
+        send = codec.encode(chunks[r])
+        for step in range(world - 1):
+            i = (r - step - 1) % world
+            recv = torch.empty(chunks[i].numel(), dtype=codec.dtype)
+            _exchange(send, recv, dst, src)
+            self.sent += send.numel() * send.element_size()
+            total = codec.decode(recv) + chunks[i]
+            if step < world - 2:
+                send = codec.encode(quant(total))
+        codes = [None] * world
+        codes[(r + 1) % world] = send = codec.encode(quant(total / world))
+        # all-gather of the means as codes
+        for step in range(world - 1):
+            i = (r - step) % world
+            recv = torch.empty(chunks[i].numel(), dtype=codec.dtype)
+            _exchange(send, recv, dst, src)
+            self.sent += send.numel() * send.element_size()
+            codes[i] = send = recv
+        return codec.decode(torch.cat(codes))
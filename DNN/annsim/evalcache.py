@@ -0,0 +1,78 @@
+"""Cache of the quantized test inputs used in the eval phase.
+
+In eval the test images go through the same deterministic preprocessing
+and input quantizer (nearest rounding) in every epoch. A
+``QuantizedTestSet`` runs them once and then serves the stored batches;
+``run_epoch`` sees its ``input_quantized`` flag and switches off the
+input quantizer of the model (``model.quantize_input``) while it runs.
+
+The cache is keyed by the input quantizer (number format and rounding),
+the preprocessing (normalization, crops) and the dataset, so changing
+any of them builds a new one. It is kept on the device, or with
+``cache_dir`` in a memory-mapped float32 file shared by all runs.
+"""
+
+import hashlib
+import math
+import os
+
+import torch
+
+from .data import load_tensor, save_tensor
+
+_cached = {}
+
+
+def cache_key(loader, input_quant=None, transform=None):
+    """Return the key identifying the quantized inputs of ``loader``."""
+    dataset = loader.dataset
+    parts = [type(dataset).__name__, getattr(dataset, "split", ""), str(len(dataset)),
+             repr(getattr(dataset, "transform", None)), repr(transform), repr(input_quant)]
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+
+
+class QuantizedTestSet:
+    """Test batches of ``loader``, preprocessed and quantized by ``input_quant`` once."""
+
+    input_quantized = True
+
+    def __init__(self, loader, input_quant=None, device="cuda", transform=None, cache_dir=None):
+        self.batch_size = loader.batch_size
+        self.device = device
+        self.key = cache_key(loader, input_quant, transform)
+        if self.key in _cached:
+            self.inputs, self.targets = _cached[self.key]
+            return
+        path = None if cache_dir is None else os.path.join(cache_dir, f"test_quantized.{self.key}")
+        if path is not None and os.path.exists(path + ".inputs.f32.json"):
+            self.inputs = load_tensor(path + ".inputs.f32")
+            self.targets = load_tensor(path + ".targets.i64")
+        else:
+            self._build(loader, input_quant, transform)
+            if path is not None:
+                save_tensor(path + ".targets.i64", self.targets.cpu())
+                save_tensor(path + ".inputs.f32", self.inputs.cpu())
+                self.inputs = load_tensor(path + ".inputs.f32")
+                self.targets = load_tensor(path + ".targets.i64")
+        _cached[self.key] = self.inputs, self.targets
+
+    @torch.no_grad()
+    def _build(self, loader, input_quant, transform):
+        inputs, targets = [], []
+        for input, target in loader:
+            input = input.to(device=self.device)
+            if transform is not None:
+                input = transform(input)
+            if input_quant is not None:
+                input = input_quant(input)
+            inputs.append(input)
+            targets.append(target.to(device=self.device))
+        self.inputs = torch.cat(inputs)
+        self.targets = torch.cat(targets)
+
+    def __len__(self):
+        return math.ceil(len(self.targets) / self.batch_size)
+
+    def __iter__(self):
+        for i in range(0, len(self.targets), self.batch_size):
+            yield self.inputs[i:i+self.batch_size], self.targets[i:i+self.batch_size]
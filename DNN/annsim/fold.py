@@ -0,0 +1,185 @@
+"""Frozen inference models with the batch norms folded into the convolutions.
+
+In eval mode a ``BatchNorm2d`` is the affine map
+``(x - mean) * weight / sqrt(var + eps) + bias`` per channel, which
+:func:`freeze` folds into the convolution producing ``x``: its weight is
+scaled by ``weight / sqrt(var + eps)`` and it gets the bias
+``bias - mean * weight / sqrt(var + eps)``, both rounded again by
+``weight_quant`` as the optimizer rounds the weights in training. A
+convolution followed by the quantizer of its output and then the batch
+norm (the shortcut of ``ResNet18Posit``, ``conv1`` of the blocks of
+``PreResNet``) is folded too, the quantizer then rounding the folded
+output: the activation quantizers keep their place after the
+convolutions, the rounding of the normalized values instead of the raw
+ones being the only change of the results with the rounding of the
+folded weights. Batch norms whose input is used elsewhere or does not
+come from a convolution (the pre-activation ones of ``PreResNet``) are
+kept. The result is a ``torch.fx.GraphModule`` (:mod:`annsim.graphopt`,
+whose passes are applied too) without gradients, on a copy of the model.
+
+The folded model is checked against the unfolded one on the test set,
+with the eval throughput of both; the command fails when their
+predictions agree on less than ``--min-agreement`` percent of the
+images::
+
+    python -m annsim.fold SVHN SVHN/P8/weights.bin --format bit_8
+"""
+
+import argparse
+import copy
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .data import DATASETS
+from .formats import NAMES
+from .graphopt import _module, _quantizer, optimize, trace
+from .layerpolicy import LayerPolicy
+from .ptq import FP32, build_model, load_state, test_set
+from .train import run_epoch
+
+
+def _fold(conv, bn, weight_quant=None):
+    scale = bn.weight.double() / (bn.running_var.double() + bn.eps).sqrt()
+    weight = conv.weight.double() * scale.view(-1, *([1] * (conv.weight.dim() - 1)))
+    bias = conv.bias.double() if conv.bias is not None else torch.zeros_like(scale)
+    bias = bn.bias.double() + (bias - bn.running_mean.double()) * scale
+    weight, bias = weight.float(), bias.float()
+    if weight_quant is not None:
+        weight, bias = weight_quant(weight), weight_quant(bias)
+    conv.weight = nn.Parameter(weight, requires_grad=False)
+    conv.bias = nn.Parameter(bias, requires_grad=False)
+
+
+def fold_batchnorms(gm, weight_quant=None):
+    """Fold the batch norms of the ``GraphModule`` ``gm`` into their
+    convolutions; return the numbers of folded and kept batch norms.
+
+    ``weight_quant`` rounds the folded weights and biases: a function, a
+    :class:`~annsim.layerpolicy.LayerPolicy` (weight format of the layer of
+    the convolution) or ``None``.
+    """
+    folded = kept = 0
+    quants = weight_quant.param_quants(gm) if isinstance(weight_quant, LayerPolicy) else None
+    for node in list(gm.graph.nodes):
+        if not _module(gm, node, nn.BatchNorm2d):
+            continue
+        bn = gm.get_submodule(node.target)
+        source = node.args[0]
+        if _quantizer(gm, source) is not None and len(source.users) == 1:
+            source = source.args[0]
+        if (not _module(gm, source, nn.Conv2d) or len(source.users) != 1
+                or bn.running_mean is None or not bn.affine):
+            kept += 1
+            continue
+        conv = gm.get_submodule(source.target)
+        _fold(conv, bn, weight_quant if quants is None else quants[conv.weight]["weight"])
+        node.replace_all_uses_with(node.args[0])
+        gm.graph.erase_node(node)
+        folded += 1
+    gm.graph.lint()
+    gm.delete_all_unused_submodules()
+    gm.recompile()
+    return folded, kept
+
+
+def freeze(model, weight_quant=None):
+    """Frozen eval copy of ``model`` with its batch norms folded; return it
+    and the numbers of folded and kept batch norms.
+    """
+    gm = trace(copy.deepcopy(model).eval())
+    folded, kept = fold_batchnorms(gm, weight_quant)
+    gm, _ = optimize(gm)
+    gm.requires_grad_(False)
+    return gm.eval(), folded, kept
+
+
+def compare(models, data, targets, device="cpu", batch_size=1000):
+    """Evaluate every model of ``models`` (a dict) with
+    ``run_epoch(phase="eval")``; return their results with the eval time
+    and throughput, and the agreement of their predictions with the first.
+    """
+    batches = [(data[i:i+batch_size], targets[i:i+batch_size])
+               for i in range(0, len(targets), batch_size)]
+    rows, reference = [], None
+    for name, model in models.items():
+        model = model.to(device)
+        with torch.no_grad():
+            model(batches[0][0].to(device))  # warm-up
+        start = time.perf_counter()
+        result, = run_epoch(batches, [model], F.cross_entropy, phase="eval", device=device,
+                            log_every=0)
+        if device != "cpu":
+            torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - start
+        with torch.no_grad():
+            outputs = torch.cat([model(x.to(device)).cpu() for x, _ in batches])
+        if reference is None:
+            reference = outputs
+        rows.append({"model": name, "loss": result["loss"], "accuracy": result["accuracy"],
+                     "time": elapsed, "images_per_s": len(targets) / elapsed,
+                     "agreement": (outputs.argmax(1) == reference.argmax(1)).float().mean().item() * 100,
+                     "max_logit_diff": (outputs - reference).abs().max().item()})
+    return rows
+
+
+def disagreeing(rows, min_agreement):
+    """Names of the models of ``compare`` agreeing with the first on less
+    than ``min_agreement`` percent of the predictions.
+    """
+    return [r["model"] for r in rows if r["agreement"] < min_agreement]
+
+
+def print_table(rows):
+    base = rows[0]["images_per_s"]
+    print(f"{'model':>10} {'loss':>8} {'accuracy':>9} {'agreement':>10} {'max diff':>9} "
+          f"{'images/s':>9} {'speedup':>8}")
+    for r in rows:
+        print(f"{r['model']:>10} {r['loss']:>8.4f} {r['accuracy']:>8.2f}% {r['agreement']:>9.2f}% "
+              f"{r['max_logit_diff']:>9.4f} {r['images_per_s']:>9.1f} "
+              f"{r['images_per_s'] / base:>7.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dataset", choices=DATASETS)
+    parser.add_argument("checkpoint", help="FP32 model.pt, a training checkpoint or a weight file")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--format", choices=[FP32, *NAMES], help="format of the model")
+    group.add_argument("--policy", metavar="JSON", help="per-layer policy of the model")
+    parser.add_argument("--root", default=None,
+                        help="torchvision root of the dataset, default <dataset>/data/<dataset>")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=None, help="evaluate the first N test images")
+    parser.add_argument("--model-index", type=int, default=0,
+                        help="model of a multi-format training checkpoint")
+    parser.add_argument("--min-agreement", type=float, default=99.0, metavar="PERCENT",
+                        help="fail if the folded predictions agree on fewer of the images")
+    args = parser.parse_args(argv)
+
+    name = LayerPolicy.load(args.policy) if args.policy else args.format
+    layer_policy = name if isinstance(name, LayerPolicy) else LayerPolicy(None if name == FP32 else name)
+    model = build_model(args.dataset, name, load_state(args.checkpoint, args.model_index))
+    frozen, folded, kept = freeze(model, layer_policy)
+    print(f"{folded} batch norms folded, {kept} kept")
+
+    root = args.root or os.path.join(args.dataset, "data", args.dataset)
+    test = test_set(args.dataset, root)
+    data, targets = test.data[:args.limit], test.targets[:args.limit]
+    rows = compare({"unfolded": model, "folded": frozen}, data, targets, args.device,
+                   args.batch_size)
+    print_table(rows)
+    failed = disagreeing(rows, args.min_agreement)
+    if failed:
+        print(f"agreement below {args.min_agreement}%: {' '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""Number formats and quantization policies used in the experiments.
+
+A *policy* maps every quantized role of a training run (weights,
+gradients, momentum, gradient accumulator, activations and errors) to a
+number format. Uniform formats such as ``bit_8`` use the same number
+everywhere, while the mixed configurations of ``mnist_IBM8.py`` and
+``mnist_Posit8.py`` keep 16 bits for momentum and accumulator.
+"""
+
+from qtorch_plus import FloatingPoint
+
+from .posit import Posit
+
+ROLES = ("weight", "grad", "momentum", "acc", "activation", "error")
+
+bit_8  = Posit(nsize=8,  es=2)
+bit_10 = Posit(nsize=10, es=2)
+bit_12 = Posit(nsize=12, es=2)
+bit_14 = Posit(nsize=14, es=2)
+bit_16 = Posit(nsize=16, es=2)
+bit_20 = Posit(nsize=20, es=2)
+bit_24 = Posit(nsize=24, es=2)
+bit_28 = Posit(nsize=28, es=2)
+bit_32 = Posit(nsize=32, es=2)
+IEEE_Half = FloatingPoint(exp=5, man=10)
+bfloat16  = FloatingPoint(exp=8, man=7 )
+IBM_8     = FloatingPoint(exp=5, man=2 )
+IBM_half  = FloatingPoint(exp=6, man=9 )
+
+FORMATS = {
+    "bit_8": bit_8,
+    "bit_10": bit_10,
+    "bit_12": bit_12,
+    "bit_14": bit_14,
+    "bit_16": bit_16,
+    "bit_20": bit_20,
+    "bit_24": bit_24,
+    "bit_28": bit_28,
+    "bit_32": bit_32,
+    "IEEE_Half": IEEE_Half,
+    "bfloat16": bfloat16,
+}
+
+# Mixed configurations: 8 bits for weights, gradients, activations and
+# errors, 16 bits for momentum and gradient accumulator.
+POLICIES = {
+    "IBM8": dict(weight=IBM_8, grad=IBM_8, momentum=IBM_half, acc=IBM_half,
+                 activation=IBM_8, error=IBM_8),
+    "Posit8": dict(weight=bit_8, grad=bit_8, momentum=bit_16, acc=bit_16,
+                   activation=bit_8, error=bit_8),
+}
+
+# Result directory of every format, as used by the plotting notebooks.
+RESULT_DIRS = {
+    "bit_8": "P8",
+    "bit_10": "P10",
+    "bit_12": "P12",
+    "bit_14": "P14",
+    "bit_16": "P16",
+    "bit_20": "P20",
+    "bit_24": "P24",
+    "bit_28": "P28",
+    "bit_32": "P32",
+    "IEEE_Half": "FP16",
+    "bfloat16": "bfloat16",
+    "IBM8": "IBM8",
+    "Posit8": "Posit8",
+}
+
+NAMES = tuple(FORMATS) + tuple(POLICIES)
+
+
+def policy(name):
+    """Return the role -> number format dictionary of ``name``."""
+    if name in POLICIES:
+        return dict(POLICIES[name])
+    if name not in FORMATS:
+        raise KeyError(f"unknown number format '{name}', expected one of {NAMES}")
+    return {role: FORMATS[name] for role in ROLES}
+
+
+def result_dir(name):
+    """Return the directory (relative to a dataset folder) for ``name``."""
+    return RESULT_DIRS.get(name, name)
+
+
+def bits(number):
+    """Storage size of ``number`` in bits; ``None`` (no quantization) is float32."""
+    if number is None:
+        return 32
+    if isinstance(number, FloatingPoint):
+        return 1 + number.exp + number.man
+    return number.nsize
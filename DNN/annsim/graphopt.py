@@ -0,0 +1,297 @@
+"""torch.fx passes removing redundant work around the quantizers of a model.
+
+:func:`trace` turns a model of :mod:`annsim.models` into a
+``torch.fx.GraphModule`` in which every :class:`annsim.quant.Quantizer`
+call is one node; the parameters, buffers and quantizers are those of the
+model, under the same names, and the input quantizer still depends on
+``quantize_input``. :func:`optimize` rewrites the graph without changing
+its results:
+
+* quantizers without formats (float32 sites of a
+  :class:`~annsim.layerpolicy.LayerPolicy`) are removed;
+* a quantizer fed, through ReLUs, non-overlapping max pooling and
+  reshapes used only there, by another one whose forward format it
+  contains and with the same nearest rounding of the errors (or none),
+  rounds nothing in either direction and is removed;
+* a ReLU followed by max pooling is moved after it, on a quarter of the
+  elements (both are monotone, so they commute);
+* a ReLU of the output of a convolution, linear layer, batch norm, max
+  pooling or addition used only there writes into it instead of
+  allocating a new tensor, as none of them needs its output for backward.
+
+The rounding kernels are compositions of torch operations, so a
+quantizer cannot be fused into the convolution it follows. The savings
+of every model, per forward and backward pass, are printed by::
+
+    python -m annsim.graphopt --formats bit_8 bfloat16
+"""
+
+import argparse
+import operator
+
+import torch
+import torch.fx as fx
+import torch.nn as nn
+import torch.nn.functional as F
+from qtorch_plus import FloatingPoint
+from torch.fx.passes.shape_prop import ShapeProp
+
+from .costmodel import INPUT_SHAPES
+from .formats import NAMES
+from .layerpolicy import LayerPolicy
+from .models import MODELS
+from .posit import Posit
+from .quant import Quantizer
+
+_RELUS = (F.relu, torch.relu)
+_RESHAPES = ("view", "reshape", "flatten", "contiguous")
+# producers of a tensor that their backward does not read
+_INPLACE_SOURCES = (nn.Conv2d, nn.Linear, nn.BatchNorm2d, nn.MaxPool2d)
+_ADDS = (operator.add, operator.iadd, torch.add)
+
+
+class QuantTracer(fx.Tracer):
+    """Tracer keeping the quantizers as single nodes."""
+
+    def is_leaf_module(self, m, module_qualified_name):
+        return isinstance(m, Quantizer) or super().is_leaf_module(m, module_qualified_name)
+
+
+def _quantize_if(enabled, quant, x):
+    return quant(x) if enabled else x
+
+
+def trace(model):
+    """``GraphModule`` of ``model`` with its quantizers as leaves."""
+    graph = QuantTracer().trace(model)
+    if hasattr(model, "quantize_input"):
+        # traced with the input quantized: keep the test of the flag
+        for node in list(graph.nodes):
+            if (node.op == "call_module" and node.args and node.args[0].op == "placeholder"
+                    and isinstance(model.get_submodule(node.target), Quantizer)):
+                with graph.inserting_before(node):
+                    flag = graph.get_attr("quantize_input")
+                    quant = graph.get_attr(node.target)
+                    call = graph.call_function(_quantize_if, (flag, quant, node.args[0]))
+                node.replace_all_uses_with(call)
+                graph.erase_node(node)
+    gm = fx.GraphModule(model, graph, model.__class__.__name__)
+    gm.quantize_input = getattr(model, "quantize_input", True)
+    return gm
+
+
+def _module(gm, node, types):
+    return node.op == "call_module" and isinstance(gm.get_submodule(node.target), types)
+
+
+def _is_relu(gm, node):
+    return ((node.op == "call_function" and node.target in _RELUS)
+            or (node.op == "call_method" and node.target == "relu")
+            or _module(gm, node, nn.ReLU))
+
+
+def _pool_args(gm, node):
+    """``(kernel, stride, dilation)`` of a max pooling node, else ``None``."""
+    if _module(gm, node, nn.MaxPool2d):
+        m = gm.get_submodule(node.target)
+        if m.return_indices:
+            return None
+        return m.kernel_size, m.stride, m.dilation
+    if node.op == "call_function" and node.target is F.max_pool2d:
+        names = ("input", "kernel_size", "stride", "padding", "dilation", "ceil_mode",
+                 "return_indices")
+        args = dict(zip(names, node.args), **node.kwargs)
+        if args.get("return_indices", False):
+            return None
+        return args["kernel_size"], args.get("stride") or args["kernel_size"], args.get("dilation", 1)
+    return None
+
+
+def _pairs(v):
+    return tuple(v) if isinstance(v, (tuple, list)) else (v, v)
+
+
+def _disjoint_pool(gm, node):
+    args = _pool_args(gm, node)
+    if args is None:
+        return False
+    kernel, stride, dilation = (_pairs(v) for v in args)
+    return dilation == (1, 1) and all(s >= k for k, s in zip(kernel, stride))
+
+
+def _preserving(gm, node):
+    # the values and (copied or zeroed) gradients of their input, in place
+    return (_is_relu(gm, node) or _disjoint_pool(gm, node)
+            or (node.op == "call_method" and node.target in _RESHAPES))
+
+
+def _quantizer(gm, node):
+    return gm.get_submodule(node.target) if _module(gm, node, Quantizer) else None
+
+
+def _same(a, b):
+    if isinstance(a, FloatingPoint) and isinstance(b, FloatingPoint):
+        return (a.exp, a.man) == (b.exp, b.man)
+    return a == b
+
+
+def _contains(outer, inner):
+    """Whether every value of ``inner`` is one of ``outer``."""
+    if isinstance(outer, Posit) and isinstance(inner, Posit):
+        return outer.es == inner.es and inner.nsize <= outer.nsize
+    return _same(outer, inner)
+
+
+def _redundant(q, source, single_user):
+    """Whether ``q`` changes nothing after ``source`` (see the module documentation)."""
+    forward = q.forward_number is None or (source.forward_number is not None
+                                           and _contains(q.forward_number, source.forward_number))
+    if q.backward_number is None:
+        return forward
+    qb, sb = q.quantize, source.quantize
+    return (forward and single_user and sb.backward_number is not None
+            and _same(qb.backward_number, sb.backward_number)
+            and qb.backward_rounding == sb.backward_rounding == "nearest")
+
+
+def remove_quantizers(gm):
+    """Remove the identity and redundant quantizer calls; return their number."""
+    removed = 0
+    for node in list(gm.graph.nodes):
+        q = _quantizer(gm, node)
+        if q is None:
+            continue
+        if q.forward_number is None and q.backward_number is None:
+            redundant = True
+        else:
+            source, single_user = node.args[0], True
+            while not _module(gm, source, Quantizer) and _preserving(gm, source):
+                single_user &= len(source.users) == 1
+                source = source.args[0]
+            single_user &= len(source.users) == 1
+            redundant = (_module(gm, source, Quantizer)
+                         and _redundant(q, gm.get_submodule(source.target), single_user))
+        if redundant:
+            node.replace_all_uses_with(node.args[0])
+            gm.graph.erase_node(node)
+            removed += 1
+    return removed
+
+
+def move_relus(gm):
+    """Apply the ReLUs followed by max pooling after it; return their number."""
+    moved = 0
+    for node in list(gm.graph.nodes):
+        if not _is_relu(gm, node) or len(node.users) != 1:
+            continue
+        pool = next(iter(node.users))
+        if _pool_args(gm, pool) is None or pool.args[0] is not node:
+            continue
+        pool.replace_input_with(node, node.args[0])
+        with gm.graph.inserting_after(pool):
+            relu = gm.graph.call_function(F.relu, (pool,))
+        pool.replace_all_uses_with(relu, delete_user_cb=lambda user: user is not relu)
+        gm.graph.erase_node(node)
+        moved += 1
+    return moved
+
+
+def inplace_relus(gm):
+    """Make the ReLUs of unshared outputs in place; return their number."""
+    changed = 0
+    for node in list(gm.graph.nodes):
+        if not _is_relu(gm, node) or node.kwargs.get("inplace", False):
+            continue
+        if _module(gm, node, nn.ReLU) and gm.get_submodule(node.target).inplace:
+            continue
+        source = node.args[0]
+        if len(source.users) != 1 or not (
+                _module(gm, source, _INPLACE_SOURCES) or _pool_args(gm, source) is not None
+                or (source.op == "call_function" and source.target in _ADDS)):
+            continue
+        with gm.graph.inserting_after(node):
+            relu = gm.graph.call_function(F.relu, (source,), {"inplace": True})
+        node.replace_all_uses_with(relu)
+        gm.graph.erase_node(node)
+        changed += 1
+    return changed
+
+
+def optimize(gm):
+    """Apply the passes to the ``GraphModule`` ``gm``; return it and the counts."""
+    counts = {"quantizers": remove_quantizers(gm), "moved_relus": move_relus(gm),
+              "inplace_relus": inplace_relus(gm)}
+    gm.graph.lint()
+    gm.recompile()
+    return gm, counts
+
+
+def passes(gm, sample):
+    """Quantizer roundings and ReLUs of one forward and backward pass of
+    ``sample``: calls and elements of each, and ReLU elements allocated.
+    """
+    ShapeProp(gm).propagate(sample)
+    stats = dict.fromkeys(("forward", "forward_elements", "backward", "backward_elements",
+                           "relu_elements", "relu_allocated"), 0)
+    for node in gm.graph.nodes:
+        meta = node.meta.get("tensor_meta")
+        n = meta.shape.numel() if meta is not None else 0
+        q = _quantizer(gm, node)
+        if q is None and node.op == "call_function" and node.target is _quantize_if:
+            q = getattr(gm, node.args[1].target) if gm.quantize_input else None
+        if q is not None:
+            for direction, number in (("forward", q.forward_number),
+                                      ("backward", q.backward_number)):
+                if number is not None:
+                    stats[direction] += 1
+                    stats[f"{direction}_elements"] += n
+        elif _is_relu(gm, node):
+            stats["relu_elements"] += n
+            inplace = (node.kwargs.get("inplace", False)
+                       or (_module(gm, node, nn.ReLU) and gm.get_submodule(node.target).inplace))
+            if not inplace:
+                stats["relu_allocated"] += n
+    return stats
+
+
+def report(datasets, formats, batch_size=1):
+    """Rows of the passes of every model and format before and after :func:`optimize`."""
+    rows = []
+    for dataset in datasets:
+        sample = torch.zeros(batch_size, *INPUT_SHAPES[dataset])
+        for name in formats:
+            layer_policy = name if isinstance(name, LayerPolicy) else LayerPolicy(name)
+            model = MODELS[dataset](layer_policy).eval()
+            gm = trace(model)
+            before = passes(gm, sample)
+            gm, counts = optimize(gm)
+            rows.append({"model": MODELS[dataset].__name__, "format": str(name), **counts,
+                         "before": before, "after": passes(gm, sample)})
+    return rows
+
+
+def print_report(rows):
+    print(f"{'model':>14} {'format':>10} {'removed':>8} {'fwd':>9} {'bwd':>9} "
+          f"{'fwd elements':>21} {'bwd elements':>21} {'relu elements':>21} "
+          f"{'relu allocated':>21}")
+    for r in rows:
+        b, a = r["before"], r["after"]
+        cols = [f"{b[k]}->{a[k]}" for k in ("forward", "backward", "forward_elements",
+                                            "backward_elements", "relu_elements",
+                                            "relu_allocated")]
+        print(f"{r['model']:>14} {r['format']:>10} {r['quantizers']:>8} {cols[0]:>9} {cols[1]:>9} "
+              + " ".join(f"{c:>21}" for c in cols[2:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--datasets", nargs="+", default=list(MODELS), choices=list(MODELS))
+    parser.add_argument("--formats", nargs="+", default=["bit_8", "bfloat16"],
+                        help=f"formats of {', '.join(NAMES)} or policy JSON files")
+    args = parser.parse_args()
+    formats = [LayerPolicy.load(f) if f.endswith(".json") else f for f in args.formats]
+    print_report(report(args.datasets, formats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Number formats chosen per layer and per role.
+
+A :class:`LayerPolicy` starts from a ``default`` format or policy of
+:mod:`annsim.formats` and overrides it for single quantizer *sites*
+(``activation`` and ``error`` of a :class:`annsim.quant.Quantizer`, named
+as in :func:`annsim.models.sites`) and single *layers* (``weight``,
+``grad``, ``momentum`` and ``acc`` of the parameters of a module). It is
+stored as JSON with the format names::
+
+    {"default": "bit_16",
+     "sites": {"quant_fc1": {"activation": "bit_8", "error": "bit_10"}},
+     "layers": {"fc1": {"weight": "bit_8"}}}
+
+A policy is the ``quant`` argument of the models: calling it with a site
+name returns that site's quantizer. :meth:`LayerPolicy.param_quants`
+returns the quantizers of every parameter for
+:class:`annsim.optim.LayerwiseOptimLP`. The stochastic ones draw from
+``generator`` (:class:`annsim.philox.CounterRNG`) when it is set.
+"""
+
+import json
+
+import torch
+
+from .formats import FORMATS, ROLES, bits, policy
+from .quant import Quantizer, quantizer
+
+SITE_ROLES = ("activation", "error")
+LAYER_ROLES = ("weight", "grad", "momentum", "acc")
+# Rounding of every role, as in make_quantizers of the training scripts.
+ROUNDING = dict(weight="nearest", grad="nearest", momentum="stochastic", acc="stochastic",
+                activation="nearest", error="nearest")
+
+
+def layer_of(param_name):
+    """Module owning the parameter ``param_name``, e.g. ``layer1.0.conv1``."""
+    return param_name.rpartition(".")[0]
+
+
+class LayerPolicy:
+    """Formats per site and layer on top of a ``default``; ``None`` is float32."""
+
+    def __init__(self, default=None, sites=None, layers=None):
+        self.default = default
+        self.sites = {k: dict(v) for k, v in (sites or {}).items()}
+        self.layers = {k: dict(v) for k, v in (layers or {}).items()}
+        for overrides, roles in ((self.sites, SITE_ROLES), (self.layers, LAYER_ROLES)):
+            for key, formats in overrides.items():
+                for role, name in formats.items():
+                    if role not in roles:
+                        raise ValueError(f"{key}: role '{role}' is not one of {roles}")
+                    if name is not None and name not in FORMATS:
+                        raise KeyError(f"{key}: unknown number format '{name}'")
+        self._default = dict.fromkeys(ROLES) if default is None else policy(default)
+        self.generator = None
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get("default"), d.get("sites"), d.get("layers"))
+
+    def to_dict(self):
+        return {"default": self.default, "sites": self.sites, "layers": self.layers}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def save(self, path, **extra):
+        """Write the policy, with ``extra`` entries (e.g. search results), to ``path``."""
+        with open(path, "w") as f:
+            json.dump(dict(self.to_dict(), **extra), f, indent=1)
+
+    def number(self, role, key):
+        """Number format of ``role`` at the site or layer ``key``."""
+        overrides = self.sites if role in SITE_ROLES else self.layers
+        name = overrides.get(key, {}).get(role, ...)
+        if name is ...:
+            return self._default[role]
+        return None if name is None else FORMATS[name]
+
+    def __call__(self, site):
+        return Quantizer(forward_number=self.number("activation", site),
+                         backward_number=self.number("error", site),
+                         forward_rounding=ROUNDING["activation"],
+                         backward_rounding=ROUNDING["error"], generator=self.generator)
+
+    def param_quants(self, model):
+        """``{param: {role: quant function or None}}`` of the weight, grad,
+        momentum and acc roles of every parameter of ``model``.
+        """
+        quants = {}
+        for name, p in model.named_parameters():
+            layer = layer_of(name)
+            quants[p] = {}
+            for role in LAYER_ROLES:
+                number = self.number(role, layer)
+                quants[p][role] = (None if number is None
+                                   else quantizer(forward_number=number,
+                                                  forward_rounding=ROUNDING[role],
+                                                  generator=self.generator))
+        return quants
+
+    def bits(self, sizes):
+        """Total bits of the quantized tensors, with the element counts
+        ``sizes`` returned by :func:`element_counts`.
+        """
+        total = 0
+        for site, n in sizes["sites"].items():
+            total += n * sum(bits(self.number(role, site)) for role in SITE_ROLES)
+        for layer, n in sizes["layers"].items():
+            total += n * sum(bits(self.number(role, layer)) for role in LAYER_ROLES)
+        return total
+
+
+def element_counts(model, sample, sites=None):
+    """Elements per sample quantized at every site of ``model`` (one forward
+    pass in eval mode on ``sample``), or at ``sites`` only, and parameters
+    of every layer.
+    """
+    names = {m.quantize: name for name, m in model.named_modules()
+             if isinstance(m, Quantizer) and (sites is None or name in sites)}
+    counts = dict.fromkeys(names.values(), 0)
+
+    def count(quantize, direction, x, out, call):
+        if direction == "forward":
+            counts[names[quantize]] += out[0].numel()
+
+    training = model.training
+    for quantize in names:
+        quantize.add_observer(count)
+    try:
+        with torch.no_grad():
+            model.eval()(sample[:1])
+    finally:
+        model.train(training)
+        for quantize in names:
+            quantize.remove_observer(count)
+    layers = {}
+    for name, p in model.named_parameters():
+        layers[layer_of(name)] = layers.get(layer_of(name), 0) + p.numel()
+    return {"sites": counts, "layers": layers}
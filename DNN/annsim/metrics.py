@@ -0,0 +1,52 @@
+"""Classification metrics accumulated on the device.
+
+``run_epoch`` used to read every batch loss with ``loss.cpu().item()``,
+which waits for the GPU at every step. :class:`MetricAccumulator` keeps
+the loss sum and a confusion matrix in device tensors instead: the
+sample count, the correct predictions and the per-class accuracy all
+follow from the confusion matrix, so they cost nothing extra, and the
+host only reads the tensors when :meth:`MetricAccumulator.compute` is
+called (once per epoch, and every few steps for the progress bar).
+
+The confusion matrix is filled with ``scatter_add_`` rather than
+``torch.bincount``, which reads the largest index back to the host on
+CUDA.
+"""
+
+import torch
+
+
+class MetricAccumulator:
+    """Loss, accuracy, per-class accuracy and confusion matrix of a model.
+
+    ``confusion[t][p]`` counts the samples of class ``t`` predicted as ``p``.
+    """
+
+    def __init__(self, num_classes, device="cuda"):
+        self.num_classes = num_classes
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.confusion = torch.zeros(num_classes * num_classes, dtype=torch.int64, device=device)
+
+    def update(self, loss, output, target):
+        """Add a batch with mean loss ``loss``; nothing is read back to the host."""
+        target = target.view(-1)
+        self.loss_sum += loss.detach().double() * target.numel()
+        pred = output.detach().max(1)[1]
+        index = target * self.num_classes + pred
+        self.confusion.scatter_add_(0, index, torch.ones_like(index))
+
+    def compute(self):
+        """Read the metrics back: one transfer per call."""
+        # the counts are exact in float64 up to 2**53
+        values = torch.cat([self.loss_sum.view(1), self.confusion.double()]).tolist()
+        loss_sum, n = values[0], self.num_classes
+        confusion = [[int(v) for v in values[1 + t * n:1 + (t + 1) * n]] for t in range(n)]
+        count = sum(map(sum, confusion))
+        correct = sum(confusion[c][c] for c in range(self.num_classes))
+        return {
+            'loss': loss_sum / count if count else float("nan"),
+            'accuracy': correct / count * 100.0 if count else 0.0,
+            'per_class_accuracy': [row[c] / sum(row) * 100.0 if sum(row) else 0.0
+                                   for c, row in enumerate(confusion)],
+            'confusion': confusion,
+        }
@@ -0,0 +1,287 @@
+"""Low-precision models of the experiments.
+
+Every model takes ``quant``, a function returning a new
+:class:`annsim.quant.Quantizer` (``act_error_quant`` in the scripts), and
+inserts it after its layers; the quantization of weights, gradients,
+momentum and accumulators is left to the optimizer. ``quant`` is called
+with the name of the quantizer in the model (its *site*, e.g. ``quant_fc1``
+or ``layer2.0.quant``), so an :class:`annsim.layerpolicy.LayerPolicy` can
+give every site its own formats.
+
+* ``LeNet``: MNIST, with the input quantized by ``quant``;
+* ``ResNet18Posit``: SVHN, the input is not quantized;
+* ``PreResNet``: CIFAR10, with the input and logits in IBM half precision.
+
+The FP32 baselines (``mnist.py``, ``svhn.py``) have the same parameters
+and buffers in the same order, so their weights load into these models
+with :func:`load_state_by_position`.
+"""
+
+import math
+
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .formats import IBM_half
+from .quant import Quantizer
+
+
+class LeNet(nn.Module):
+    def __init__(self, quant, num_classes=10):
+        super(LeNet, self).__init__()
+        self.conv1 = nn.Conv2d(1, 6, 5)
+        self.conv2 = nn.Conv2d(6, 16, 5)
+        self.fc1   = nn.Linear(16*5*5, 120)
+        self.fc2   = nn.Linear(120, 84)
+        self.fc3   = nn.Linear(84, num_classes)
+        # one quantizer for the input and one after every layer
+        self.quant = quant("quant")
+        self.quant_conv1 = quant("quant_conv1")
+        self.quant_conv2 = quant("quant_conv2")
+        self.quant_fc1 = quant("quant_fc1")
+        self.quant_fc2 = quant("quant_fc2")
+        self.quant_fc3 = quant("quant_fc3")
+        self.quantize_input = True
+
+    def forward(self, x):
+        if self.quantize_input:
+            x = self.quant(x)
+        out = self.conv1(x)
+        out = F.relu(out)
+        out = F.max_pool2d(out, 2)
+        out = self.quant_conv1(out)
+        out = self.conv2(out)
+        out = F.relu(out)
+        out = F.max_pool2d(out, 2)
+        out = self.quant_conv2(out)
+        out = out.view(out.size(0), -1)
+        out = self.fc1(out)
+        out = F.relu(out)
+        out = self.quant_fc1(out)
+        out = self.fc2(out)
+        out = F.relu(out)
+        out = self.quant_fc2(out)
+        out = self.fc3(out)
+        out = self.quant_fc3(out)
+        return out
+
+
+class BasicBlock(nn.Module):
+    expansion = 1
+
+    def __init__(self, in_planes, planes, quant, stride=1, name=""):
+        super(BasicBlock, self).__init__()
+        self.conv1 = nn.Conv2d(
+            in_planes, planes, kernel_size=3, stride=stride, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(planes)
+        self.conv2 = nn.Conv2d(planes, planes, kernel_size=3,
+                               stride=1, padding=1, bias=False)
+        self.bn2 = nn.BatchNorm2d(planes)
+        self.quant=quant(f"{name}.quant")
+        self.shortcut = nn.Sequential()
+        if stride != 1 or in_planes != self.expansion*planes:
+            self.shortcut = nn.Sequential(
+                nn.Conv2d(in_planes, self.expansion*planes,
+                          kernel_size=1, stride=stride, bias=False),
+                quant(f"{name}.shortcut.1"),
+                nn.BatchNorm2d(self.expansion*planes)
+            )
+
+    def forward(self, x):
+        out = F.relu(self.bn1(self.conv1(x)))
+        out = self.quant(out)
+        out = self.bn2(self.conv2(out))
+        out = self.quant(out)
+        out += self.shortcut(x)
+        out = F.relu(out)
+        return out
+
+
+class ResNet(nn.Module):
+    def __init__(self, block, num_blocks, quant, num_classes=10):
+        super(ResNet, self).__init__()
+        self.in_planes = 64
+        self.quant = quant("quant")
+        self.conv1 = nn.Conv2d(3, 64, kernel_size=3,
+                               stride=1, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(64)
+        self.layer1 = self._make_layer(block, 64, quant, num_blocks[0], stride=1, name="layer1")
+        self.layer2 = self._make_layer(block, 128, quant, num_blocks[1], stride=2, name="layer2")
+        self.layer3 = self._make_layer(block, 256, quant, num_blocks[2], stride=2, name="layer3")
+        self.layer4 = self._make_layer(block, 512, quant, num_blocks[3], stride=2, name="layer4")
+        self.linear = nn.Linear(512*block.expansion, num_classes)
+
+    def _make_layer(self, block, planes, quant, num_blocks, stride, name):
+        strides = [stride] + [1]*(num_blocks-1)
+        layers = []
+        for i, stride in enumerate(strides):
+            layers.append(block(self.in_planes, planes, quant, stride, name=f"{name}.{i}"))
+            self.in_planes = planes * block.expansion
+        return nn.Sequential(*layers)
+
+    def forward(self, x):
+        out = F.relu(self.bn1(self.conv1(x)))
+        out = self.quant(out)
+        out = self.layer1(out)
+        out = self.quant(out)
+        out = self.layer2(out)
+        out = self.quant(out)
+        out = self.layer3(out)
+        out = self.quant(out)
+        out = self.layer4(out)
+        out = self.quant(out)
+        out = F.avg_pool2d(out, 4)
+        out = out.view(out.size(0), -1)
+        out = self.linear(out)
+        return out
+
+
+def ResNet18Posit(quant):
+    return ResNet(BasicBlock, [2, 2, 2, 2], quant)
+
+
+def conv3x3(in_planes, out_planes, stride=1):
+    return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride,
+                     padding=1, bias=False)
+
+
+class PreActBlock(nn.Module):
+    expansion = 1
+
+    def __init__(self, inplanes, planes, quant, stride=1, downsample=None, name=""):
+        super(PreActBlock, self).__init__()
+        self.bn1 = nn.BatchNorm2d(inplanes)
+        self.relu = nn.ReLU(inplace=True)
+        self.conv1 = conv3x3(inplanes, planes, stride)
+        self.bn2 = nn.BatchNorm2d(planes)
+        self.conv2 = conv3x3(planes, planes)
+        self.downsample = downsample
+        self.stride = stride
+        self.quant = quant(f"{name}.quant")
+
+    def forward(self, x):
+        residual = x
+
+        out = self.bn1(x)
+        out = self.relu(out)
+        out = self.quant(out)
+        out = self.conv1(out)
+        out = self.quant(out)
+
+        out = self.bn2(out)
+        out = self.relu(out)
+        out = self.quant(out)
+        out = self.conv2(out)
+        out = self.quant(out)
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        out += residual
+
+        return out
+
+
+class PreResNet(nn.Module):
+
+    def __init__(self,quant, num_classes=10, depth=20):
+
+        super(PreResNet, self).__init__()
+        assert (depth - 2) % 6 == 0, 'depth should be 6n+2'
+        n = (depth - 2) // 6
+
+        block = PreActBlock
+
+        self.inplanes = 16
+        self.conv1 = nn.Conv2d(3, 16, kernel_size=3, padding=1,
+                               bias=False)
+        self.layer1 = self._make_layer(block, 16, n, quant, name="layer1")
+        self.layer2 = self._make_layer(block, 32, n, quant, stride=2, name="layer2")
+        self.layer3 = self._make_layer(block, 64, n, quant, stride=2, name="layer3")
+        self.bn = nn.BatchNorm2d(64 * block.expansion)
+        self.relu = nn.ReLU(inplace=True)
+        self.avgpool = nn.AvgPool2d(8)
+        self.fc = nn.Linear(64 * block.expansion, num_classes)
+        self.quant = quant("quant")
+        self.quant_half = Quantizer(IBM_half, IBM_half, "nearest", "nearest")
+        self.quantize_input = True
+        for m in self.modules():
+            if isinstance(m, nn.Conv2d):
+                n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
+                m.weight.data.normal_(0, math.sqrt(2. / n))
+            elif isinstance(m, nn.BatchNorm2d):
+                m.weight.data.fill_(1)
+                m.bias.data.zero_()
+
+    def _make_layer(self, block, planes, blocks, quant, stride=1, name=""):
+        downsample = None
+        if stride != 1 or self.inplanes != planes * block.expansion:
+            downsample = nn.Sequential(
+                nn.Conv2d(self.inplanes, planes * block.expansion,
+                          kernel_size=1, stride=stride, bias=False),
+            )
+
+        layers = list()
+        layers.append(block(self.inplanes, planes, quant , stride, downsample, name=f"{name}.0"))
+        self.inplanes = planes * block.expansion
+        for i in range(1, blocks):
+            layers.append(block(self.inplanes, planes, quant, name=f"{name}.{i}"))
+
+        return nn.Sequential(*layers)
+
+    def forward(self, x):
+        if self.quantize_input:
+            x = self.quant_half(x)
+        x = self.conv1(x)
+        x = self.quant(x)
+
+        x = self.layer1(x)  # 32x32
+        x = self.layer2(x)  # 16x16
+        x = self.layer3(x)  # 8x8
+        x = self.bn(x)
+        x = self.relu(x)
+        x = self.quant(x)
+
+        x = self.avgpool(x)
+        x = x.view(x.size(0), -1)
+        x = self.fc(x)
+        x = self.quant_half(x)
+
+        return x
+
+
+# Model of each dataset and the attribute holding its input quantizer.
+MODELS = {"MNIST": LeNet, "SVHN": ResNet18Posit, "CIFAR10": PreResNet}
+INPUT_QUANT = {"MNIST": "quant", "SVHN": None, "CIFAR10": "quant_half"}
+# Whether the model of each dataset runs in channels_last on the CPU
+# (annsim.backend); LeNet flattens its 5x5 feature maps with view.
+CHANNELS_LAST = {"MNIST": False, "SVHN": True, "CIFAR10": True}
+
+
+def sites(dataset):
+    """Names of the quantizers that the model of ``dataset`` gets from ``quant``."""
+    names = []
+    def record(site):
+        names.append(site)
+        return Quantizer()
+    MODELS[dataset](record)
+    return names
+
+
+def load_state_by_position(model, state):
+    """Load ``state`` into ``model`` matching entries by order and shape.
+
+    The quantizers of the shortcuts shift the indices of ``nn.Sequential``
+    entries, so an FP32 state dict does not match the names of the
+    low-precision model, only the order of its tensors.
+    """
+    own = model.state_dict()
+    if len(own) != len(state):
+        raise ValueError(f"state has {len(state)} entries, the model {len(own)}")
+    mapped = {}
+    for (name, tensor), (src_name, src) in zip(own.items(), state.items()):
+        if tensor.shape != src.shape:
+            raise ValueError(f"{src_name} {tuple(src.shape)} does not match "
+                             f"{name} {tuple(tensor.shape)}")
+        mapped[name] = src
+    model.load_state_dict(mapped)
@@ -0,0 +1,140 @@
+"""Early end of format runs that diverge or stall.
+
+A :class:`Monitor` watches every model of a run through two channels:
+
+* the running loss that :func:`annsim.train.run_epoch` reads back every
+  few steps: a non-finite loss stops stepping the model;
+* observers on its :class:`annsim.quant.Quantizer` modules, counting the
+  NaN/NaR and saturated (rounded to the largest finite value) outputs of
+  both directions over the epoch.
+
+After every epoch :meth:`Monitor.check` adds the quantizer counts to the
+last train history entry and applies the rules below to the histories:
+
+* ``diverged``: non-finite loss, NaN/NaR at the quantizers, a train loss
+  ``diverge_factor`` times its best value, or more than
+  ``max_saturation`` of the quantized values saturated for ``patience``
+  epochs;
+* ``stalled``: the test accuracy has not improved by ``min_delta`` points
+  over ``patience`` epochs while still below ``stall_accuracy`` (twice the
+  chance level by default), as P(8,2) on MNIST stuck at 11.35%.
+
+A stopped run gets ``status`` and ``reason`` keys in its last train and
+test history entries; :func:`stopped` reads them back, so the decision
+survives a checkpoint and resume.
+"""
+
+import math
+
+import torch
+
+from .quant import Quantizer, max_value
+
+STATUSES = ("stalled", "diverged")
+
+
+def stopped(hist):
+    """Whether the history of a run ends with a monitor status."""
+    return bool(hist) and "status" in hist[-1]
+
+
+class QuantStats:
+    """Quantizer observer counting non-finite and saturated outputs.
+
+    The counts stay on the device until :meth:`reduce`.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.nonfinite = 0
+        self.saturated = 0
+        self.count = 0
+
+    def __call__(self, quantize, direction, x, out, call):
+        with torch.no_grad():
+            self.nonfinite = self.nonfinite + (~torch.isfinite(out)).sum()
+            limit = max_value(quantize.number(direction))
+            if limit is not None:
+                self.saturated = self.saturated + (out.abs() >= limit).sum()
+            self.count += out.numel()
+
+    def reduce(self):
+        """Return ``(nonfinite, saturated, count)`` and reset the counts."""
+        stats = int(self.nonfinite), int(self.saturated), self.count
+        self.reset()
+        return stats
+
+
+class Monitor:
+    """Detect diverged and stalled runs; see the module documentation."""
+
+    def __init__(self, num_classes=10, patience=10, min_delta=0.5, stall_accuracy=None,
+                 diverge_factor=10.0, max_saturation=0.1):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.stall_accuracy = (200.0 / num_classes if stall_accuracy is None
+                               else stall_accuracy)
+        self.diverge_factor = diverge_factor
+        self.max_saturation = max_saturation
+        self.stats = {}
+        self.reasons = {}
+
+    def watch(self, model):
+        """Observe the quantizers of ``model``."""
+        stats = self.stats[model] = QuantStats()
+        for module in model.modules():
+            if isinstance(module, Quantizer):
+                module.quantize.add_observer(stats)
+
+    def running(self, model):
+        return model not in self.reasons
+
+    def batch(self, model, loss):
+        """Record the running loss of the epoch; return whether to keep stepping ``model``."""
+        if not math.isfinite(loss):
+            self.reasons[model] = ("diverged", f"non-finite loss {loss}")
+        return self.running(model)
+
+    def _reason(self, model, train_hist, test_hist):
+        if model in self.reasons:
+            return self.reasons.pop(model)
+        last = train_hist[-1]
+        if not math.isfinite(last["loss"]):
+            return "diverged", f"non-finite loss {last['loss']}"
+        if last.get("nonfinite"):
+            return "diverged", f"{last['nonfinite']} NaN/NaR values at the quantizers"
+        best = min(h["loss"] for h in train_hist)
+        if last["loss"] > self.diverge_factor * best:
+            return "diverged", f"train loss grew from {best:.4g} to {last['loss']:.4g}"
+        if len(test_hist) <= self.patience:
+            return None
+        window = train_hist[-self.patience:]
+        if all(h.get("saturation", 0.0) > self.max_saturation for h in window):
+            return "diverged", (f"more than {self.max_saturation:.0%} of the quantized values "
+                                f"saturated for {self.patience} epochs")
+        before = max(h["accuracy"] for h in test_hist[:-self.patience])
+        recent = max(h["accuracy"] for h in test_hist[-self.patience:])
+        if recent - before < self.min_delta and recent < self.stall_accuracy:
+            return "stalled", (f"test accuracy {recent:.2f}% has not improved by "
+                               f"{self.min_delta} points in {self.patience} epochs")
+        return None
+
+    def check(self, model, train_hist, test_hist):
+        """Judge ``model`` after an epoch; return its status or ``None``.
+
+        The quantizer counts of the epoch and, for a stopped run, its
+        ``status`` and ``reason`` are written to the last history entries.
+        """
+        if model in self.stats:
+            nonfinite, saturated, count = self.stats[model].reduce()
+            train_hist[-1]["nonfinite"] = nonfinite
+            train_hist[-1]["saturation"] = saturated / count if count else 0.0
+        reason = self._reason(model, train_hist, test_hist)
+        if reason is None:
+            return None
+        status, message = reason
+        for hist in (train_hist, test_hist):
+            hist[-1].update(status=status, reason=message)
+        return status
@@ -0,0 +1,435 @@
+"""Low-precision optimizers on top of ``qtorch_plus.optim.OptimLP``."""
+
+import contextlib
+
+import torch
+from qtorch_plus.optim import OptimLP
+from torch.optim import SGD
+
+from .codec import codec
+
+
+class LayerwiseOptimLP(OptimLP):
+    """``OptimLP`` with the quantizers chosen per parameter.
+
+    ``quants`` maps every parameter to its ``weight``, ``grad``,
+    ``momentum`` and ``acc`` quant functions, ``None`` for float32
+    (:meth:`annsim.layerpolicy.LayerPolicy.param_quants`). The step is the
+    one of ``OptimLP``, except that the gradients are always multiplied by
+    ``grad_scaling``: ``OptimLP`` only does so with a gradient quantizer,
+    which would leave float32 layers with the scaled-up loss gradient.
+    """
+
+    def __init__(self, optim, quants, grad_scaling=1.0):
+        super(LayerwiseOptimLP, self).__init__(optim, grad_scaling=grad_scaling)
+        self.quants = quants
+        self.weight_acc = {p: p.detach().clone() for p in self._params()
+                           if quants[p]["acc"] is not None}
+
+    def _params(self):
+        return [p for group in self.param_groups for p in group["params"]]
+
+    def step(self, closure=None):
+        params = self._params()
+        # quantize gradient
+        for p in params:
+            if p.grad is None:
+                continue
+            grad = p.grad.data * self.grad_scaling
+            quant = self.quants[p]["grad"]
+            p.grad.data = grad if quant is None else quant(grad)
+
+        # switch acc into weight before stepping
+        for p, acc in self.weight_acc.items():
+            p.data = acc.data
+
+        loss = self.optim.step()
+
+        # switch weight into acc after stepping and quantize
+        for p, acc in self.weight_acc.items():
+            p.data = acc.data = self.quants[p]["acc"](p.data).data
+
+        # quantize momentum
+        if self.optim.defaults["momentum"] != 0:
+            for p in params:
+                quant = self.quants[p]["momentum"]
+                param_state = self.optim.state[p]
+                if quant is None:
+                    continue
+                for key in self.momentum_keys:
+                    if key in param_state:
+                        param_state[key] = quant(param_state[key])
+
+        # quantize weight from acc
+        for p in params:
+            quant = self.quants[p]["weight"]
+            if quant is not None:
+                p.data = quant(p.data).data
+        return loss
+
+
+def _codec(quant):
+    return None if quant is None else codec(getattr(quant, "forward_number", None))
+
+
+def _views(params, flat):
+    views, offset = [], 0
+    for p in params:
+        views.append(flat[offset:offset + p.numel()].view_as(p))
+        offset += p.numel()
+    return views
+
+
+def _flatten(tensors):
+    flat = torch.cat([t.detach().reshape(-1) for t in tensors])
+    return flat, _views(tensors, flat)
+
+
+# Elements per bucket of PackedOptimLP and FusedOptimLP: the quantizers
+# make several passes over their input, which are faster on CPU while it
+# stays in the caches.
+BUCKET_SIZE = 1 << 18
+
+
+def _buckets(params, bucket_size):
+    """Consecutive ``params`` up to ``bucket_size`` elements, or a single larger one."""
+    buckets, bucket, size = [], [], 0
+    for p in params:
+        if bucket and size + p.numel() > bucket_size:
+            buckets.append(bucket)
+            bucket, size = [], 0
+        bucket.append(p)
+        size += p.numel()
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+class _Float32Codec:
+    """The float32 values as codes, for the formats without codes."""
+
+    dtype = torch.float32
+
+    def encode(self, x, out=None):
+        return x.clone() if out is None else out.copy_(x)
+
+    decode = encode
+
+
+class PackedOptimLP(OptimLP):
+    """``OptimLP`` over SGD with its state stored as codes of its formats.
+
+    The momentum buffers rounded by ``momentum_quant`` and the accumulators
+    rounded by ``acc_quant`` are kept as the ``uint8``/``int16`` codes of
+    :mod:`annsim.codec` (float32 for formats without codes) in
+    ``momentum`` and ``weight_acc``, views of one code tensor per
+    parameter group, which the step encodes in place. The accumulators are
+    decoded and encoded a bucket of ``bucket_size`` elements at a time
+    into one float32 buffer; the momentum buffers are float32 until the
+    end of the step. Tensors replaced from outside (loading a checkpoint)
+    are gathered again by the next step. The update is the one of
+    ``torch.optim.SGD`` followed by the rounding of ``OptimLP``, one
+    parameter at a time in the same order, so the stochastic rounding
+    draws the same random numbers (of the global generator or of a
+    :class:`annsim.philox.CounterRNG`) and the weights are the same as
+    with ``OptimLP``.
+    """
+
+    def __init__(self, optim, weight_quant=None, grad_scaling=1.0, grad_quant=None,
+                 momentum_quant=None, acc_quant=None, bucket_size=BUCKET_SIZE):
+        if not isinstance(optim, SGD):
+            raise TypeError("PackedOptimLP only supports SGD")
+        super(PackedOptimLP, self).__init__(optim, weight_quant=weight_quant,
+                                            grad_scaling=grad_scaling, grad_quant=grad_quant,
+                                            momentum_quant=momentum_quant, acc_quant=acc_quant)
+        self.momentum = {}
+        self.momentum_codec = _codec(momentum_quant) or _Float32Codec()
+        self.acc_codec = _codec(acc_quant) or _Float32Codec()
+        self.bucket_size = bucket_size
+        # (state, group index) -> its code tensor and the views of the parameters
+        self.codes = {}
+        self.buffer = None
+
+    def _gather(self, key, params, c):
+        """The code tensor of the ``key`` state of ``params`` and its views,
+        and the state tensors to fill it from if they are not these views
+        (float32 accumulators before the first step, ``None`` for the
+        parameters without momentum buffer).
+        """
+        tensors = [getattr(self, key[0]).get(p) for p in params]
+        codes, views = self.codes.get(key, (None, []))
+        if len(views) == len(tensors) and all(t is v for t, v in zip(tensors, views)):
+            return codes, views, None
+        codes = torch.empty(sum(p.numel() for p in params), dtype=c.dtype, device=params[0].device)
+        return codes, _views(params, codes), tensors
+
+    @staticmethod
+    def _decode(c, codes, tensors, params, out):
+        """Decode the state of ``params`` to ``out``: ``codes`` at once, or
+        the state ``tensors`` returned by :meth:`_gather` one at a time.
+        """
+        if tensors is None:
+            c.decode(codes, out=out)
+            return
+        for t, v in zip(tensors, _views(params, out)):
+            if t is None:
+                continue
+            if t.is_floating_point():
+                v.copy_(t)
+            else:
+                c.decode(t, out=v)
+
+    def _buffer(self, n, device):
+        if self.buffer is None or self.buffer.numel() < n or self.buffer.device != device:
+            self.buffer = torch.empty(n, device=device)
+        return self.buffer[:n]
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        # quantize gradient
+        if self.grad_quant is not None:
+            for group in self.param_groups:
+                for p in group["params"]:
+                    if p.grad is not None:
+                        p.grad.data = self.grad_quant(p.grad.data * self.grad_scaling)
+
+        buffers = []
+        for i, group in enumerate(self.param_groups):
+            lr, momentum, dampening = group["lr"], group["momentum"], group["dampening"]
+            weight_decay = group["weight_decay"]
+            params = [p for p in group["params"] if p.grad is not None]
+            if not params:
+                continue
+            device = params[0].device
+            if self.acc_quant is not None:
+                acc_key = ("weight_acc", i)
+                acc_codes, acc_views, accs = self._gather(acc_key, params, self.acc_codec)
+            if momentum != 0:
+                key = ("momentum", i)
+                codes, views, bufs = self._gather(key, params, self.momentum_codec)
+                flat = torch.empty(codes.numel(), device=device)
+                self._decode(self.momentum_codec, codes, bufs, params, flat)
+                buffers.append((key, params, codes, views, flat))
+
+            offset, first = 0, 0
+            for bucket in _buckets(params, self.bucket_size):
+                n = sum(p.numel() for p in bucket)
+                if self.acc_quant is None:
+                    weights = [p.data for p in bucket]
+                else:
+                    acc = self._buffer(n, device)
+                    self._decode(self.acc_codec, acc_codes[offset:offset + n],
+                                 None if accs is None else accs[first:first + len(bucket)],
+                                 bucket, acc)
+                    weights = _views(bucket, acc)
+                if momentum != 0:
+                    bufs = _views(bucket, flat[offset:offset + n])
+                for j, (p, w) in enumerate(zip(bucket, weights)):
+                    grad = -p.grad if group["maximize"] else p.grad
+                    if weight_decay != 0:
+                        grad = grad.add(w, alpha=weight_decay)
+                    if momentum != 0:
+                        buf = bufs[j]
+                        if p not in self.momentum:
+                            buf.copy_(grad)
+                        else:
+                            buf.mul_(momentum).add_(grad, alpha=1 - dampening)
+                        grad = grad.add(buf, alpha=momentum) if group["nesterov"] else buf
+                    w.add_(grad, alpha=-lr)
+
+                    # round the accumulator, quantize weight from it
+                    if self.acc_quant is not None:
+                        w.copy_(self.acc_quant(w))
+                        p.data = w.clone() if self.weight_quant is None else self.weight_quant(w)
+                    elif self.weight_quant is not None:
+                        p.data = self.weight_quant(w)
+                # pack the accumulators
+                if self.acc_quant is not None:
+                    self.acc_codec.encode(acc, out=acc_codes[offset:offset + n])
+                offset += n
+                first += len(bucket)
+            if self.acc_quant is not None:
+                self.codes[acc_key] = acc_codes, acc_views
+                self.weight_acc.update(zip(params, acc_views))
+
+        # quantize and pack momentum
+        for key, params, codes, views, flat in buffers:
+            if self.momentum_quant is not None:
+                for buf in _views(params, flat):
+                    buf.copy_(self.momentum_quant(buf))
+            self.momentum_codec.encode(flat, out=codes)
+            self.codes[key] = codes, views
+            self.momentum.update(zip(params, views))
+        return loss
+
+
+def _split(params, bucket_size):
+    """The buckets of ``bucket_size`` elements of the concatenated ``params``:
+    ``(start, end, pieces, words, ended)``, with the ``(index, start,
+    count)`` pieces of the parameters they cover, the same counted from the
+    first parameter not ended before (for :meth:`CounterRNG.pieces
+    <annsim.philox.CounterRNG.pieces>`), and the number of parameters
+    ending in them.
+    """
+    starts = [0]
+    for p in params:
+        starts.append(starts[-1] + p.numel())
+    buckets, first = [], 0
+    for start in range(0, starts[-1], bucket_size):
+        end = min(start + bucket_size, starts[-1])
+        pieces, last = [], first
+        for j in range(first, len(params)):
+            if starts[j] >= end:
+                break
+            a, b = max(start, starts[j]), min(end, starts[j + 1])
+            pieces.append((j, a - starts[j], b - a))
+            if starts[j + 1] <= end:
+                last = j + 1
+        words = [(j - first, a, n) for j, a, n in pieces]
+        buckets.append((start, end, pieces, words, last - first))
+        first = last
+    return buckets
+
+
+def _words(quant, bucket):
+    # the words of the per-parameter draws of OptimLP for a bucket rounded
+    # by a quantizer with a CounterRNG
+    generator = getattr(quant, "generator", None)
+    if generator is None:
+        return contextlib.nullcontext()
+    return generator.pieces(bucket[3], bucket[4])
+
+
+class FusedOptimLP(OptimLP):
+    """``OptimLP`` over SGD stepping the parameters of a group as one tensor.
+
+    The parameters of a group become (contiguous) views of one flat weight
+    tensor, and their accumulators (``weight_acc``) and momentum buffers
+    (the SGD state) views of flat tensors of their own. The step goes through them
+    ``bucket_size`` elements at a time, across the parameters, so the
+    gradient scaling and quantization, weight decay, momentum and the
+    rounding of accumulators and weights are one operation per bucket, on
+    data that stays in the caches; a second pass rounds the momentum. The
+    elementwise operations are those of ``OptimLP`` and
+    ``torch.optim.SGD`` in the same order, so the weights are the same:
+    the global generator draws the words of the accumulators, then of the
+    momentum, in the sequence of ``OptimLP`` (with the gradients rounded
+    to nearest), and a :class:`annsim.philox.CounterRNG` those of the
+    parameters a bucket covers. The quantized gradients are not written
+    back to ``p.grad``. Tensors replaced from outside (loading a
+    checkpoint) are gathered again by the next step.
+    """
+
+    def __init__(self, optim, weight_quant=None, grad_scaling=1.0, grad_quant=None,
+                 momentum_quant=None, acc_quant=None, bucket_size=BUCKET_SIZE):
+        if not isinstance(optim, SGD):
+            raise TypeError("FusedOptimLP only supports SGD")
+        super(FusedOptimLP, self).__init__(optim, weight_quant=weight_quant,
+                                           grad_scaling=grad_scaling, grad_quant=grad_quant,
+                                           momentum_quant=momentum_quant, acc_quant=acc_quant)
+        self.flats = [self._flat(group, bucket_size) for group in self.param_groups]
+
+    def _flat(self, group, bucket_size):
+        params = group["params"]
+        flat = {"group": group, "params": params, "weights": None, "acc": None,
+                "momentum": None, "buckets": _split(params, bucket_size)}
+        self._gather(flat)
+        return flat
+
+    def _gather(self, flat):
+        """Make the weights, accumulators and momentum views of the flat tensors again."""
+        params = flat["params"]
+        if flat["weights"] is None or any(p.data_ptr() != v.data_ptr()
+                                          for p, v in zip(params, flat["weight_views"])):
+            flat["weights"], flat["weight_views"] = _flatten(params)
+            for p, v in zip(params, flat["weight_views"]):
+                p.data = v
+        if self.acc_quant is not None:
+            accs = [self.weight_acc[p] for p in params]
+            if flat["acc"] is None or any(a is not v for a, v in zip(accs, flat["acc_views"])):
+                flat["acc"], flat["acc_views"] = _flatten(accs)
+                self.weight_acc.update(zip(params, flat["acc_views"]))
+        states = [self.optim.state[p] for p in params]
+        if not all("momentum_buffer" in s for s in states):
+            flat["momentum"] = None
+        elif flat["momentum"] is None or any(s["momentum_buffer"] is not v for s, v
+                                             in zip(states, flat["momentum_views"])):
+            self._set_momentum(flat, *_flatten([s["momentum_buffer"] for s in states]))
+
+    def _set_momentum(self, flat, tensor, views):
+        flat["momentum"], flat["momentum_views"] = tensor, views
+        for p, v in zip(flat["params"], views):
+            self.optim.state[p]["momentum_buffer"] = v
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for flat in self.flats:
+            group, params = flat["group"], flat["params"]
+            if any(p.grad is None for p in params):
+                raise RuntimeError("FusedOptimLP steps every parameter, some have no gradient")
+            self._gather(flat)
+            lr, momentum, dampening = group["lr"], group["momentum"], group["dampening"]
+            weight_decay = group["weight_decay"]
+            grads = [p.grad.reshape(-1) for p in params]
+            weights = flat["weights"] if self.acc_quant is None else flat["acc"]
+            first = momentum != 0 and flat["momentum"] is None
+            if first:
+                buf = torch.empty_like(weights)
+                self._set_momentum(flat, buf, _views(params, buf))
+
+            for bucket in flat["buckets"]:
+                start, end, pieces = bucket[:3]
+                # quantize gradient
+                grad = [grads[j][a:a + n] for j, a, n in pieces]
+                grad = torch.cat(grad) if len(grad) > 1 else grad[0]
+                if self.grad_quant is not None:
+                    with _words(self.grad_quant, bucket):
+                        grad = self.grad_quant(grad * self.grad_scaling)
+                if group["maximize"]:
+                    grad = -grad
+
+                w = weights[start:end]
+                if weight_decay != 0:
+                    grad = grad.add(w, alpha=weight_decay)
+                if momentum != 0:
+                    buf = flat["momentum"][start:end]
+                    if first:
+                        buf.copy_(grad)
+                    else:
+                        buf.mul_(momentum).add_(grad, alpha=1 - dampening)
+                    grad = grad.add(buf, alpha=momentum) if group["nesterov"] else buf
+                w.add_(grad, alpha=-lr)
+
+                # quantize acc, and weight from acc
+                if self.acc_quant is not None:
+                    with _words(self.acc_quant, bucket):
+                        w.copy_(self.acc_quant(w))
+                    if self.weight_quant is None:
+                        flat["weights"][start:end].copy_(w)
+                    else:
+                        with _words(self.weight_quant, bucket):
+                            flat["weights"][start:end].copy_(self.weight_quant(w))
+                elif self.weight_quant is not None:
+                    with _words(self.weight_quant, bucket):
+                        w.copy_(self.weight_quant(w))
+
+        # quantize momentum
+        if self.momentum_quant is not None:
+            for flat in self.flats:
+                if flat["momentum"] is None:
+                    continue
+                for bucket in flat["buckets"]:
+                    buf = flat["momentum"][bucket[0]:bucket[1]]
+                    with _words(self.momentum_quant, bucket):
+                        buf.copy_(self.momentum_quant(buf))
+        return loss
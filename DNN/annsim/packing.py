@@ -0,0 +1,107 @@
+"""Activations saved for backward as integer codes of their format.
+
+Autograd keeps float32 copies of the tensors that the layers save for
+the backward pass, also the outputs of the quantizers, which hold only
+values of an 8 or 16-bit format. :class:`PackedActivations` observes the
+quantizers of a model and, during its forward passes, stores every saved
+tensor that is the output of one of them as the codes of
+:mod:`annsim.codec` (``uint8`` for 8-bit formats, ``int16`` up to 16),
+decoded on backward. ``channels_last`` tensors are stored as the codes
+of their NHWC memory and come back ``channels_last``.
+
+The codes of a quantizer are checked to decode exactly once, on its
+first output, so the gradients are the same as without packing. A saved
+tensor is then only packed when it is that output as the quantizer
+returned it: still alive (not a new tensor at a freed address) and not
+modified in place since (the ``out += shortcut`` of the residual blocks),
+by its version counter. The others, e.g. activations of float32 sites
+and of formats wider than 16 bits, are kept as they are.
+"""
+
+import weakref
+
+import torch
+
+from .codec import codec
+from .quant import Quantizer
+
+
+class PackedActivations:
+    """Pack the quantized activations that ``model`` saves for backward."""
+
+    def __init__(self, model):
+        self.model = model
+        self.codecs = {}
+        self.exact = {}
+        self.outputs = {}
+        self.packed = 0
+        self.kept = 0
+        self._context = None
+        self._quantizers = [m.quantize for m in model.modules() if isinstance(m, Quantizer)]
+        for quantize in self._quantizers:
+            quantize.add_observer(self._observe)
+        self._hooks = [model.register_forward_pre_hook(self._enter),
+                       model.register_forward_hook(self._exit)]
+
+    def _codec(self, quantize):
+        if quantize not in self.codecs:
+            self.codecs[quantize] = codec(quantize.forward_number)
+        return self.codecs[quantize]
+
+    def _observe(self, quantize, direction, x, out, call):
+        # the forward of an autograd function runs without grad mode
+        if direction == "forward" and self._context is not None:
+            c = self._codec(quantize)
+            if c is None or out.dtype != torch.float32:
+                return
+            if quantize not in self.exact:
+                self.exact[quantize] = c.exact(out, c.encode(out))
+            if self.exact[quantize]:
+                self.outputs[out.data_ptr()] = c, weakref.ref(out), out._version
+
+    def _enter(self, module, input):
+        self.outputs.clear()
+        if torch.is_grad_enabled():
+            self._context = torch.autograd.graph.saved_tensors_hooks(self._pack, self._unpack)
+            self._context.__enter__()
+
+    def _exit(self, module, input, output):
+        self.outputs.clear()
+        if self._context is not None:
+            self._context.__exit__(None, None, None)
+            self._context = None
+
+    def _pack(self, x):
+        output = self.outputs.get(x.data_ptr()) if x.dtype == torch.float32 else None
+        if output is None:
+            return x
+        c, ref, version = output
+        if ref() is None:
+            # another tensor at the address of a freed output
+            return x
+        if x._version != version:
+            self.kept += 1
+            return x
+        if x.is_contiguous():
+            memory = x
+        elif x.dim() == 4 and x.is_contiguous(memory_format=torch.channels_last):
+            memory = x.permute(0, 2, 3, 1)
+        else:
+            self.kept += 1
+            return x
+        self.packed += 1
+        return c, c.encode(memory), memory.shape, memory is not x
+
+    def _unpack(self, packed):
+        if isinstance(packed, torch.Tensor):
+            return packed
+        c, codes, shape, channels_last = packed
+        x = c.decode(codes).view(shape)
+        return x.permute(0, 3, 1, 2) if channels_last else x
+
+    def remove(self):
+        """Detach from the model and its quantizers."""
+        for hook in self._hooks:
+            hook.remove()
+        for quantize in self._quantizers:
+            quantize.remove_observer(self._observe)
@@ -0,0 +1,160 @@
+"""Counter-based random numbers for reproducible stochastic rounding.
+
+The stochastic rounding of :mod:`annsim.posit` and :mod:`annsim.floating`
+draws from the global torch generator, so the rounding of a tensor
+depends on everything drawn before it. :class:`CounterRNG` instead
+derives the random word of every element from its position alone with
+Philox4x32-10 (Salmon et al., "Parallel random numbers: as easy as 1, 2,
+3", SC 2011): the key is the ``seed``, the counter the element index,
+the draw number within the step, the step and the stream of the
+quantizer. The words only depend on these integers, so they are the
+same on every device, for any number of threads and after resuming
+from a checkpoint at the same step.
+
+The words are the bits of int32 tensors, written in place into a buffer
+that every stream reuses (4 bytes per element, as float32 random numbers
+would take), and compared as integers by the rounding. A draw is valid
+until the next draw of its stream.
+
+Every stochastic quantizer gets a stream with :meth:`CounterRNG.stream`
+(``quantizer(..., generator=rng)``). A stream numbers its draws within a
+step, so the momentum and accumulator quantizers of ``OptimLP``, called
+once per parameter, draw with the parameter index. :meth:`attach` starts
+a new step after every optimizer step. Within :meth:`CounterRNG.pieces`,
+a draw is made of parts of several of the next draws, for a bucket of
+parameters rounded at once.
+"""
+
+import contextlib
+import functools
+
+import torch
+
+ROUNDS = 10
+_MASK = 0xFFFFFFFF
+_M0, _M1 = 0xD2511F53, 0xCD9E8D57
+_W0, _W1 = 0x9E3779B9, 0xBB67AE85
+
+
+# Philox blocks computed at once by CounterRNG.words: the rounds make many
+# passes over them, which stay in the caches.
+CHUNK = 1 << 14
+
+
+def _mulhilo(a, m):
+    # High and low words of a * m for 32-bit a and m; the int64 product
+    # wraps around, which keeps both words.
+    product = a * m
+    return (product >> 32).bitwise_and_(_MASK), product.bitwise_and_(_MASK)
+
+
+def philox(c0, c1, c2, c3, key, rounds=ROUNDS):
+    """The four 32-bit words of Philox4x32 of the counters ``c0`` (int64
+    tensor) and ``c1``, ``c2``, ``c3`` (ints or tensors) with the 64-bit
+    ``key``, as int64 tensors.
+    """
+    k0, k1 = key & _MASK, (key >> 32) & _MASK
+    if isinstance(c2, int):
+        c2 = torch.full_like(c0, c2)
+    for _ in range(rounds):
+        hi0, lo0 = _mulhilo(c0, _M0)
+        hi1, lo1 = _mulhilo(c2, _M1)
+        c0, c2 = hi1.bitwise_xor_(c1).bitwise_xor_(k0), hi0.bitwise_xor_(c3).bitwise_xor_(k1)
+        c1, c3 = lo1, lo0
+        k0, k1 = (k0 + _W0) & _MASK, (k1 + _W1) & _MASK
+    return c0, c1, c2, c3
+
+
+class CounterRNG:
+    """Random 32-bit words keyed by seed, step, stream and draw."""
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.step = 0
+        self._streams = 0
+        self._draws = {}
+        self._buffers = {}
+        self._pieces = self._drawn = None
+
+    def stream(self):
+        """Return ``random(shape, device)`` drawing the words of a new stream."""
+        stream = self._streams
+        self._streams += 1
+        return functools.partial(self.words, stream)
+
+    def words(self, stream, shape, device):
+        """Draw an int32 tensor of ``shape`` holding the bits of 32-bit random
+        words, in the buffer of ``stream``.
+        """
+        n = 1
+        for s in shape:
+            n *= s
+        key = (stream, str(device))
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.numel() < n:
+            buffer = self._buffers[key] = torch.empty(n, dtype=torch.int32, device=device)
+        words = buffer[:n]
+        draw = self._draws.get(stream, 0)
+        if self._pieces is None:
+            self._draws[stream] = draw + 1
+            self._fill(words, stream, draw, 0)
+            return words.view(shape)
+        self._drawn.add(stream)
+        offset = 0
+        for k, start, count in self._pieces:
+            self._fill(words[offset:offset + count], stream, draw + k, start)
+            offset += count
+        if offset != n:
+            raise ValueError(f"pieces of {offset} words drawn for {n} elements")
+        return words.view(shape)
+
+    def _fill(self, out, stream, draw, start):
+        # the words of the elements start to start + len(out) of a draw; one
+        # Philox block gives the words of four consecutive elements
+        end = start + out.numel()
+        first, last = start // 4, (end + 3) // 4
+        block = torch.empty(min(CHUNK, last - first), 4, dtype=torch.int64, device=out.device)
+        for b in range(first, last, CHUNK):
+            blocks = torch.arange(b, min(b + CHUNK, last), dtype=torch.int64, device=out.device)
+            signed = block[:len(blocks)]
+            torch.stack(philox(blocks, draw, self.step & _MASK, stream, self.seed), dim=1,
+                        out=signed)
+            # the words above 2**31 - 1 as the negative int32 of their bits
+            signed = signed.view(-1)
+            signed.sub_((signed >> 31) << 32)
+            lo, hi = max(4 * b, start), min(4 * (b + len(blocks)), end)
+            out[lo - start:hi - start] = signed[lo - 4 * b:hi - 4 * b]
+
+    @contextlib.contextmanager
+    def pieces(self, pieces, draws):
+        """Draw the words of parts of the next draws of the streams.
+
+        Within the block, a stream draws the words of ``pieces``, ``(k,
+        start, count)`` for the elements ``start`` to ``start + count`` of
+        its ``k``-th next draw, in sequence; the streams that drew move on
+        by ``draws`` at the end. ``FusedOptimLP`` rounds buckets of several
+        parameters so with the words of the rounding of one at a time.
+        """
+        self._pieces, self._drawn = list(pieces), set()
+        try:
+            yield
+        finally:
+            for stream in self._drawn:
+                self._draws[stream] = self._draws.get(stream, 0) + draws
+            self._pieces = self._drawn = None
+
+    def advance(self):
+        """Start the next step."""
+        self.step += 1
+        self._draws.clear()
+
+    def attach(self, optimizer):
+        """Advance after every step of ``optimizer``; returns the hook handle."""
+        return optimizer.register_step_post_hook(lambda *args: self.advance())
+
+    def state_dict(self):
+        return {"seed": self.seed, "step": self.step}
+
+    def load_state_dict(self, state):
+        self.seed, self.step = state["seed"], state["step"]
+        self._draws.clear()
@@ -0,0 +1,182 @@
+"""Post-training quantization sweep of a trained model over number formats.
+
+The weights of a checkpoint (the FP32 ``model.pt`` saved by ``mnist.py``
+and ``svhn.py``, a :mod:`annsim.checkpoint` file or a packed
+:mod:`annsim.weightfile`) are loaded into the
+low-precision model of the dataset (:mod:`annsim.models`) once per
+format. The weights are rounded to nearest by ``weight_quant`` and the
+activations by ``act_error_quant``, as in training, and the test set is
+evaluated for all formats concurrently in a process pool. The
+preprocessed test set is a memory-mapped float32 file
+(:class:`annsim.data.CachedDataset`), so every worker reads the same
+pages instead of decoding its own copy. Run from the ``DNN/`` directory::
+
+    python -m annsim.ptq MNIST MNIST/FP32/model.pt --jobs 8
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+from .data import DATASETS, CachedDataset
+from .formats import NAMES
+from .layerpolicy import LayerPolicy
+from .metrics import MetricAccumulator
+from .models import MODELS, load_state_by_position
+from .weightfile import is_weight_file, load
+
+_CIFAR_NORMALIZE = transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))
+# The test transforms of the training scripts.
+TEST_TRANSFORMS = {
+    "MNIST": transforms.Compose([
+        transforms.CenterCrop(32),
+        transforms.ToTensor(),
+        transforms.Normalize((0.5,), (0.5,)),
+    ]),
+    "SVHN": transforms.Compose([transforms.ToTensor(), _CIFAR_NORMALIZE]),
+    "CIFAR10": transforms.Compose([transforms.ToTensor(), _CIFAR_NORMALIZE]),
+}
+# The training transforms of the scripts.
+TRAIN_TRANSFORMS = {
+    "MNIST": transforms.Compose([
+        transforms.RandomCrop(32, padding=4),
+        transforms.ToTensor(),
+        transforms.Normalize((0.5,), (0.5,)),
+    ]),
+    "SVHN": transforms.Compose([
+        transforms.RandomCrop(32, padding=4),
+        transforms.ToTensor(),
+        _CIFAR_NORMALIZE,
+    ]),
+    "CIFAR10": transforms.Compose([
+        transforms.RandomCrop(32, padding=4),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        _CIFAR_NORMALIZE,
+    ]),
+}
+# Unquantized reference row of the table.
+FP32 = "FP32"
+
+
+def test_set(dataset, root):
+    """The preprocessed, memory-mapped test split of ``dataset``."""
+    return CachedDataset(dataset, root, "test", transform=TEST_TRANSFORMS[dataset], preprocess=True)
+
+
+def load_state(path, index=0):
+    """Model state of ``path``, a state dict, the ``index``-th model of a
+    checkpoint or a weight file.
+    """
+    if is_weight_file(path):
+        return load(path)
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    if "models" in state:
+        state = state["models"][index]
+    return state
+
+
+def build_model(dataset, name, state):
+    """Model of ``dataset`` in format ``name`` with the weights of ``state`` rounded to it.
+
+    ``name`` is a format of :mod:`annsim.formats`, ``FP32`` or a
+    :class:`annsim.layerpolicy.LayerPolicy`.
+    """
+    layer_policy = (name if isinstance(name, LayerPolicy)
+                    else LayerPolicy(None if name == FP32 else name))
+    model = MODELS[dataset](layer_policy)
+    load_state_by_position(model, state)
+    with torch.no_grad():
+        for p, quants in layer_policy.param_quants(model).items():
+            if quants['weight'] is not None:
+                p.copy_(quants['weight'](p))
+    return model.eval()
+
+
+def evaluate(model, data, targets, device="cpu", batch_size=1000):
+    """Loss and accuracy of ``model`` on the tensors ``data`` and ``targets``."""
+    model = model.to(device)
+    metrics = None
+    with torch.no_grad():
+        for i in range(0, len(targets), batch_size):
+            input = data[i:i+batch_size].to(device)
+            target = targets[i:i+batch_size].to(device)
+            output = model(input)
+            if metrics is None:
+                metrics = MetricAccumulator(output.size(1), device=output.device)
+            metrics.update(F.cross_entropy(output, target), output, target)
+    return metrics.compute()
+
+
+_test = None
+
+
+def _init_worker(dataset, root, threads):
+    global _test
+    torch.set_num_threads(threads)
+    _test = test_set(dataset, root)
+
+
+def _run(dataset, name, checkpoint, index, device, batch_size):
+    model = build_model(dataset, name, load_state(checkpoint, index))
+    result = evaluate(model, _test.data, _test.targets, device, batch_size)
+    return {'format': name, 'loss': result['loss'], 'accuracy': result['accuracy'],
+            'per_class_accuracy': result['per_class_accuracy']}
+
+
+def sweep(dataset, checkpoint, formats, root, jobs, device="cpu", batch_size=1000, index=0):
+    """Evaluate ``checkpoint`` in every format of ``formats``; one row per format."""
+    test_set(dataset, root)  # build the shared file before the workers open it
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(jobs, mp_context=context, initializer=_init_worker,
+                                                initargs=(dataset, root, threads)) as pool:
+        futures = [pool.submit(_run, dataset, name, checkpoint, index, device, batch_size)
+                   for name in formats]
+        return [f.result() for f in futures]
+
+
+def print_table(rows):
+    reference = next((r['accuracy'] for r in rows if r['format'] == FP32), None)
+    print(f"{'format':>10} {'loss':>8} {'accuracy':>9}" + (f" {'drop':>7}" if reference is not None else ""))
+    for r in rows:
+        line = f"{r['format']:>10} {r['loss']:>8.4f} {r['accuracy']:>8.2f}%"
+        if reference is not None:
+            line += f" {reference - r['accuracy']:>7.2f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dataset", choices=DATASETS)
+    parser.add_argument("checkpoint", help="FP32 model.pt, a training checkpoint or a weight file")
+    parser.add_argument("--formats", nargs="+", default=[FP32, *NAMES], choices=[FP32, *NAMES])
+    parser.add_argument("--root", default=None,
+                        help="torchvision root of the dataset, default <dataset>/data/<dataset>")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="worker processes, default one per format up to the CPU count")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--model-index", type=int, default=0,
+                        help="model of a multi-format training checkpoint")
+    parser.add_argument("--out", default=None, help="also write the table as JSON")
+    args = parser.parse_args()
+
+    root = args.root or os.path.join(args.dataset, "data", args.dataset)
+    jobs = args.jobs or min(len(args.formats), os.cpu_count() or 1)
+    rows = sweep(args.dataset, args.checkpoint, args.formats, root, jobs, args.device,
+                 args.batch_size, args.model_index)
+    print_table(rows)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(rows, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Drop-in replacements for ``qtorch_plus.quant.quantizer`` and ``Quantizer``.
+
+Posit formats from :mod:`annsim.posit` are rounded natively and
+FloatingPoint formats by the bit-mask path of :mod:`annsim.floating`,
+identical to qtorch_plus for the same random words; any other number is
+handed to qtorch_plus unchanged. Stochastic rounding draws from the
+global torch generator, so a run is reproducible from its seed, or from
+the counter-based words of a quantizer ``generator``
+(:class:`annsim.philox.CounterRNG`).
+
+The rounding is also registered as the custom operators
+``annsim::round`` and ``annsim::quantize`` (with its gradient), whose
+formats are strings (:func:`number_spec`). Under ``torch.compile`` the
+quantizers without observers or generator call ``annsim::quantize``,
+which the compiler keeps as one opaque node of the whole-model graph
+instead of breaking the graph at every quantizer.
+"""
+
+import functools
+
+import torch
+from torch import nn
+from qtorch_plus import FloatingPoint
+from qtorch_plus import quant as qtorch_quant
+
+from .floating import float_quantize
+from .posit import Posit, posit_quantize
+
+ROUNDINGS = ("nearest", "stochastic")
+
+
+def _qtorch_quantize(x, number, rounding):
+    return qtorch_quant.quantizer(forward_number=number, forward_rounding=rounding)(x)
+
+
+def _in_memory_order(quantize, x, **kwargs):
+    # channels_last tensors are rounded as the contiguous NHWC tensor of their
+    # memory, the words of stochastic rounding still drawn in NCHW order
+    if x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last):
+        random = kwargs.get("random")
+        if random is not None:
+            kwargs["random"] = lambda shape, device: random(
+                (shape[0], shape[3], shape[1], shape[2]), device).permute(0, 2, 3, 1)
+        # detached: a new tensor for autograd, not a view of the NHWC result
+        return quantize(x.permute(0, 2, 3, 1), **kwargs).permute(0, 3, 1, 2).detach()
+    return quantize(x, **kwargs)
+
+
+def quant_function(number, rounding="nearest", random=None):
+    """Return a function rounding a tensor to ``number``; no autograd involved.
+
+    ``random(shape, device)`` draws the 32-bit words of stochastic rounding.
+    The result has the memory format of the tensor (e.g. channels_last).
+    """
+    if rounding not in ROUNDINGS:
+        raise ValueError(f"invalid rounding mode '{rounding}'")
+    if rounding == "nearest":
+        random = None
+    if isinstance(number, Posit):
+        return functools.partial(_in_memory_order, posit_quantize, nsize=number.nsize,
+                                 es=number.es, rounding=rounding, random=random)
+    if isinstance(number, FloatingPoint):
+        return functools.partial(_in_memory_order, float_quantize, exp=number.exp,
+                                 man=number.man, rounding=rounding, random=random)
+    if random is not None:
+        raise ValueError(f"no counter-based stochastic rounding for {number}")
+    return functools.partial(_in_memory_order, _qtorch_quantize, number=number,
+                             rounding=rounding)
+
+
+def max_value(number):
+    """Largest finite value of ``number``, or ``None`` if it is not known."""
+    if isinstance(number, FloatingPoint):
+        return (2.0 - 2.0**-number.man) * 2.0**((1 << (number.exp - 1)) - 1)
+    if hasattr(number, "nsize") and hasattr(number, "es"):
+        return Posit(number.nsize, number.es).maxpos
+    return None
+
+
+def number_spec(number):
+    """String of ``number`` for the custom operators: ``""`` for ``None``,
+    ``"posit:<nsize>:<es>"``, ``"float:<exp>:<man>"`` or ``None`` for the
+    formats they do not support.
+    """
+    if number is None:
+        return ""
+    if isinstance(number, Posit):
+        return f"posit:{number.nsize}:{number.es}"
+    if isinstance(number, FloatingPoint):
+        return f"float:{number.exp}:{number.man}"
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _spec_function(spec, rounding):
+    kind, a, b = spec.split(":")
+    number = Posit(int(a), int(b)) if kind == "posit" else FloatingPoint(exp=int(a), man=int(b))
+    return quant_function(number, rounding)
+
+
+@torch.library.custom_op("annsim::round", mutates_args=())
+def round_op(x: torch.Tensor, number: str, rounding: str) -> torch.Tensor:
+    """Round ``x`` to the format ``number`` (:func:`number_spec`)."""
+    out = _spec_function(number, rounding)(x)
+    # the outputs of custom operators cannot alias their inputs
+    return out.clone() if out is x else out
+
+
+@round_op.register_fake
+def _(x, number, rounding):
+    return torch.empty_like(x)
+
+
+@torch.library.custom_op("annsim::quantize", mutates_args=())
+def quantize_op(x: torch.Tensor, forward_number: str, forward_rounding: str,
+                backward_number: str, backward_rounding: str) -> torch.Tensor:
+    """Round ``x`` to ``forward_number`` and its gradient to
+    ``backward_number``; ``""`` leaves that direction untouched.
+    """
+    if not forward_number:
+        return x.clone()
+    return round_op(x, forward_number, forward_rounding)
+
+
+@quantize_op.register_fake
+def _(x, forward_number, forward_rounding, backward_number, backward_rounding):
+    return torch.empty_like(x)
+
+
+def _setup_quantize(ctx, inputs, output):
+    ctx.backward_number, ctx.backward_rounding = inputs[3], inputs[4]
+
+
+def _backward_quantize(ctx, grad):
+    if ctx.backward_number:
+        grad = round_op(grad, ctx.backward_number, ctx.backward_rounding)
+    return grad, None, None, None, None
+
+
+quantize_op.register_autograd(_backward_quantize, setup_context=_setup_quantize)
+
+
+class _Rounding(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, quantize, call):
+        ctx.quantize, ctx.call = quantize, call
+        if quantize.forward_quant is None:
+            # an input returned as is would be a view, which autograd forbids
+            # modifying in place (the out += shortcut of the residual blocks)
+            return x.clone()
+        out = quantize.forward_quant(x)
+        quantize.notify("forward", x, out, call)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        quantize = ctx.quantize
+        if quantize.backward_quant is not None:
+            out = quantize.backward_quant(grad_output)
+            quantize.notify("backward", grad_output, out, ctx.call)
+            grad_output = out
+        return grad_output, None, None
+
+
+class _Quantize:
+    def __init__(self, forward_number, backward_number, forward_rounding, backward_rounding,
+                 generator=None):
+        self.observers = []
+        self.calls = 0
+        self.forward_number = forward_number
+        self.backward_number = backward_number
+        self.forward_rounding = forward_rounding
+        self.backward_rounding = backward_rounding
+        self.generator = generator
+        self.forward_quant = (None if forward_number is None
+                              else quant_function(forward_number, forward_rounding,
+                                                  self._stream(forward_rounding)))
+        self.backward_quant = (None if backward_number is None
+                               else quant_function(backward_number, backward_rounding,
+                                                   self._stream(backward_rounding)))
+        specs = (number_spec(forward_number), number_spec(backward_number))
+        self.op_args = (None if None in specs or generator is not None
+                        else (specs[0], forward_rounding, specs[1], backward_rounding))
+
+    def _stream(self, rounding):
+        if self.generator is None or rounding != "stochastic":
+            return None
+        return self.generator.stream()
+
+    def add_observer(self, observer):
+        """Call ``observer(quantize, direction, x, out, call)`` after every
+        rounding, with ``direction`` either ``"forward"`` or ``"backward"``.
+        ``call`` numbers the calls of the quantizer since :meth:`reset_calls`,
+        and the backward rounding gets the number of its forward call, so a
+        quantizer applied at several points of a model tells them apart.
+        """
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
+
+    def notify(self, direction, x, out, call):
+        for observer in self.observers:
+            observer(self, direction, x, out, call)
+
+    def reset_calls(self):
+        self.calls = 0
+
+    def number(self, direction):
+        return self.forward_number if direction == "forward" else self.backward_number
+
+    def __call__(self, x):
+        if torch.compiler.is_compiling() and self.op_args is not None and not self.observers:
+            # the call counter is left alone: dynamo would guard on its value
+            return quantize_op(x, *self.op_args)
+        call = self.calls
+        self.calls += 1
+        if self.forward_quant is None and self.backward_quant is None:
+            return x
+        return _Rounding.apply(x, self, call)
+
+
+def quantizer(forward_number=None, backward_number=None,
+              forward_rounding="stochastic", backward_rounding="stochastic", generator=None):
+    """Return a function quantizing its input to ``forward_number`` and its
+    gradient to ``backward_number``; ``None`` leaves that direction untouched.
+    Stochastic rounding draws from the streams of ``generator``
+    (:class:`annsim.philox.CounterRNG`) if given, else the global generator.
+    """
+    return _Quantize(forward_number, backward_number, forward_rounding, backward_rounding,
+                     generator)
+
+
+class Quantizer(nn.Module):
+    """Module version of :func:`quantizer`, to insert between layers."""
+
+    def __init__(self, forward_number=None, backward_number=None,
+                 forward_rounding="stochastic", backward_rounding="stochastic", generator=None):
+        super(Quantizer, self).__init__()
+        self.quantize = quantizer(forward_number, backward_number,
+                                  forward_rounding, backward_rounding, generator)
+
+    @property
+    def forward_number(self):
+        return self.quantize.forward_number
+
+    @property
+    def backward_number(self):
+        return self.quantize.backward_number
+
+    def forward(self, x):
+        return self.quantize(x)
+
+    def extra_repr(self):
+        q = self.quantize
+        return (f"forward={q.forward_number} ({q.forward_rounding}), "
+                f"backward={q.backward_number} ({q.backward_rounding})")
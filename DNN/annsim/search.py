@@ -0,0 +1,277 @@
+"""Search of per-layer mixed-precision policies.
+
+Starting from a trained model (the FP32 ``model.pt`` or a training
+checkpoint), every variable, i.e. the ``activation``/``error`` format of
+a quantizer site or the ``weight``/``grad`` format of a layer, takes a
+format of the ``--candidates``. A configuration is scored by
+
+* ``ptq``: rounding the weights and evaluating the test set, which only
+  sees the ``activation`` and ``weight`` roles; the budget is the number
+  of test samples;
+* ``train``: a short proxy training (``LayerwiseOptimLP``) from the
+  trained weights followed by the test set; the budget is the number of
+  steps.
+
+and its cost is the total number of bits of the quantized tensors
+(:meth:`annsim.layerpolicy.LayerPolicy.bits`). Two strategies look for
+the cheapest configuration reaching ``--target`` accuracy:
+
+* ``greedy``: from the widest candidate everywhere, take the step of one
+  variable to the next narrower candidate that saves most bits while
+  meeting the target, until no step does;
+* ``halving``: successive halving of random configurations, keeping the
+  best half (target met first, then fewer bits) and doubling the budget.
+
+With ``--space`` the variables only take the formats allowed by a report
+of :mod:`annsim.sensitivity`. The configurations of a round are evaluated in parallel worker processes
+sharing the memory-mapped test (and train) data. The result is a
+:class:`~annsim.layerpolicy.LayerPolicy` JSON file, trained with
+``--policy`` by the scripts. Run from the ``DNN/`` directory::
+
+    python -m annsim.search MNIST MNIST/FP32/model.pt --target 98.5 --out MNIST/lenet_mixed.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import random
+
+import torch
+import torch.nn.functional as F
+from torch.optim import SGD
+
+from .augment import BatchAugment
+from .data import DATASETS, CachedDataset
+from .formats import FORMATS, bits
+from .layerpolicy import LayerPolicy, element_counts, layer_of
+from .models import MODELS, sites
+from .optim import LayerwiseOptimLP
+from .ptq import TRAIN_TRANSFORMS, build_model, evaluate, load_state, test_set
+
+MODES = ("ptq", "train")
+METHODS = ("greedy", "halving")
+
+
+def variables(dataset, roles):
+    """``(kind, key, role)`` of every searched format of the model of ``dataset``."""
+    model = MODELS[dataset](LayerPolicy())
+    layers = list(dict.fromkeys(layer_of(name) for name, _ in model.named_parameters()))
+    return ([("sites", site, role) for site in sites(dataset)
+             for role in ("activation", "error") if role in roles] +
+            [("layers", layer, role) for layer in layers
+             for role in ("weight", "grad") if role in roles])
+
+
+def to_policy(config, default):
+    """LayerPolicy of ``config``, a ``{(kind, key, role): format}`` dictionary."""
+    overrides = {"sites": {}, "layers": {}}
+    for (kind, key, role), name in config.items():
+        overrides[kind].setdefault(key, {})[role] = name
+    return LayerPolicy(default, overrides["sites"], overrides["layers"])
+
+
+def proxy_train(model, layer_policy, data, targets, augment, steps, device="cpu", lr=0.01,
+                batch_size=128, seed=0):
+    """Train ``model`` for ``steps`` batches of the uint8 ``data``, as the scripts do.
+
+    ``augment`` (a :class:`~annsim.augment.BatchAugment` of the training
+    transforms) is seeded with ``seed`` too, so every configuration sees
+    the same batches and crops.
+    """
+    model = model.to(device).train()
+    optimizer = SGD(model.parameters(), lr=lr, momentum=0.9, weight_decay=5e-4)
+    optimizer = LayerwiseOptimLP(optimizer, layer_policy.param_quants(model), grad_scaling=1/1000)
+    generator = torch.Generator().manual_seed(seed)
+    torch.manual_seed(seed)
+    augment.generator.manual_seed(seed)
+    for _ in range(steps):
+        index = torch.randint(len(targets), (batch_size,), generator=generator)
+        input = augment(data[index].to(device))
+        loss = F.cross_entropy(model(input), targets[index].to(device)) * 1000
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return model.eval()
+
+
+_worker = {}
+
+
+def _init_worker(dataset, root, checkpoint, index, threads, mode):
+    torch.set_num_threads(threads)
+    _worker.update(dataset=dataset, state=load_state(checkpoint, index), test=test_set(dataset, root))
+    if mode == "train":
+        _worker.update(train=CachedDataset(dataset, root, "train"),
+                       augment=BatchAugment.from_transform(TRAIN_TRANSFORMS[dataset]))
+
+
+def _score(policy_dict, mode, budget, device, lr):
+    layer_policy = LayerPolicy.from_dict(policy_dict)
+    model = build_model(_worker["dataset"], layer_policy, _worker["state"])
+    test = _worker["test"]
+    n = len(test)
+    if mode == "train":
+        train = _worker["train"]
+        model = proxy_train(model, layer_policy, train.data, train.targets, _worker["augment"],
+                            budget, device, lr)
+    else:
+        n = min(n, budget)
+    return evaluate(model, test.data[:n], test.targets[:n], device)['accuracy']
+
+
+class Search:
+    """State shared by the strategies: the pool, the cost model and the log."""
+
+    def __init__(self, pool, default, sizes, target, mode, device, lr):
+        self.pool = pool
+        self.default = default
+        self.sizes = sizes
+        self.target = target
+        self.mode = mode
+        self.device = device
+        self.lr = lr
+        self.evaluations = 0
+
+    def cost(self, config):
+        return to_policy(config, self.default).bits(self.sizes)
+
+    def score(self, configs, budget):
+        """Accuracy of every configuration of ``configs``, in parallel."""
+        futures = [self.pool.submit(_score, to_policy(c, self.default).to_dict(), self.mode,
+                                    budget, self.device, self.lr) for c in configs]
+        self.evaluations += len(configs)
+        return [f.result() for f in futures]
+
+    def rank(self, config, accuracy):
+        # feasible configurations first, by bits; the others by accuracy
+        if accuracy >= self.target:
+            return (0, self.cost(config))
+        return (1, -accuracy)
+
+
+def greedy(search, space, budget):
+    """``space`` maps every variable to its candidates, narrowest first."""
+    config = {v: candidates[-1] for v, candidates in space.items()}
+    accuracy, = search.score([config], budget)
+    print(f"widest: {accuracy:.2f}% {search.cost(config)} bits")
+    while accuracy >= search.target:
+        moves = []
+        for v, candidates in space.items():
+            i = candidates.index(config[v])
+            if i > 0:
+                moves.append({**config, v: candidates[i - 1]})
+        if not moves:
+            break
+        scores = search.score(moves, budget)
+        feasible = [(search.cost(m), -a, k) for k, (m, a) in enumerate(zip(moves, scores))
+                    if a >= search.target]
+        if not feasible:
+            break
+        _, _, k = min(feasible)
+        config, accuracy = moves[k], scores[k]
+        print(f"{len(moves)} moves, {len(feasible)} feasible: {accuracy:.2f}% "
+              f"{search.cost(config)} bits")
+    return config, accuracy
+
+
+def halving(search, space, budget, configs=32, eta=2, seed=0):
+    rng = random.Random(seed)
+    population = [{v: candidates[-1] for v, candidates in space.items()}]
+    population += [{v: rng.choice(candidates) for v, candidates in space.items()}
+                   for _ in range(configs - 1)]
+    rounds, n = 0, len(population)
+    while n > 1:
+        rounds, n = rounds + 1, n // eta
+    budget = max(1, budget // eta ** rounds)
+    while True:
+        scores = search.score(population, budget)
+        ranked = sorted(zip(population, scores), key=lambda ca: search.rank(*ca))
+        best, accuracy = ranked[0]
+        print(f"{len(population)} configurations, budget {budget}: best {accuracy:.2f}% "
+              f"{search.cost(best)} bits")
+        if len(population) == 1:
+            return best, accuracy
+        population = [c for c, _ in ranked[:max(1, len(ranked) // eta)]]
+        budget *= eta
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dataset", choices=DATASETS)
+    parser.add_argument("checkpoint", help="FP32 model.pt or a training checkpoint")
+    parser.add_argument("--target", type=float, required=True, help="test accuracy to reach, in %%")
+    parser.add_argument("--candidates", nargs="+", default=["bit_8", "bit_10", "bit_12", "bit_16"],
+                        choices=list(FORMATS))
+    parser.add_argument("--roles", nargs="+", default=["activation", "error", "weight", "grad"],
+                        choices=["activation", "error", "weight", "grad"])
+    parser.add_argument("--default", default="bit_16",
+                        help="format of the roles that are not searched (momentum, acc, ...)")
+    parser.add_argument("--method", choices=METHODS, default="greedy")
+    parser.add_argument("--mode", choices=MODES, default="ptq")
+    parser.add_argument("--budget", type=int, default=None,
+                        help="test samples (ptq) or proxy training steps (train) per evaluation; "
+                             "the final budget of halving")
+    parser.add_argument("--configs", type=int, default=32, help="initial configurations of halving")
+    parser.add_argument("--lr", type=float, default=0.01, help="proxy training learning rate")
+    parser.add_argument("--root", default=None,
+                        help="torchvision root of the dataset, default <dataset>/data/<dataset>")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--model-index", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--space", default=None,
+                        help="report of annsim.sensitivity: only search its allowed formats")
+    parser.add_argument("--out", required=True, help="policy JSON to write")
+    args = parser.parse_args()
+
+    roles = args.roles
+    if args.mode == "ptq":
+        roles = [r for r in roles if r in ("activation", "weight")]
+        print("ptq only evaluates the forward pass: searching", " and ".join(roles))
+    candidates = sorted(args.candidates, key=lambda name: bits(FORMATS[name]))
+    budget = args.budget or (10000 if args.mode == "ptq" else 200)
+    root = args.root or os.path.join(args.dataset, "data", args.dataset)
+
+    test = test_set(args.dataset, root)
+    if args.mode == "train":
+        CachedDataset(args.dataset, root, "train")
+    counting = MODELS[args.dataset](LayerPolicy("bit_32"))
+    sizes = element_counts(counting, test.data[:1], set(sites(args.dataset)))
+    names = variables(args.dataset, roles)
+    space = {v: candidates for v in names}
+    if args.space:
+        with open(args.space) as f:
+            allowed = {(e["kind"], e["key"], e["role"]): e["allowed"]
+                       for e in json.load(f)["variables"]}
+        space = {v: [c for c in candidates if c in allowed.get(v, candidates)] or candidates[-1:]
+                 for v in names}
+    print(f"{len(names)} variables, candidates {', '.join(candidates)}, "
+          f"{sum(len(c) for c in space.values())} variable formats")
+
+    threads = max(1, (os.cpu_count() or 1) // args.jobs)
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+            args.jobs, mp_context=context, initializer=_init_worker,
+            initargs=(args.dataset, root, args.checkpoint, args.model_index, threads, args.mode)) as pool:
+        search = Search(pool, args.default, sizes, args.target, args.mode, args.device, args.lr)
+        if args.method == "greedy":
+            config, accuracy = greedy(search, space, budget)
+        else:
+            config, accuracy = halving(search, space, budget, args.configs,
+                                       seed=args.seed)
+
+    layer_policy = to_policy(config, args.default)
+    reference = LayerPolicy(args.default).bits(sizes)
+    result = {"method": args.method, "mode": args.mode, "target": args.target,
+              "accuracy": accuracy, "bits": layer_policy.bits(sizes), "default_bits": reference,
+              "candidates": candidates, "evaluations": search.evaluations}
+    layer_policy.save(args.out, search=result)
+    status = "meets" if accuracy >= args.target else "misses"
+    print(f"{args.out}: {accuracy:.2f}% ({status} {args.target}%), "
+          f"{result['bits']} bits vs {reference} for {args.default}")
+
+
+if __name__ == "__main__":
+    main()
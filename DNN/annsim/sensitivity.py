@@ -0,0 +1,238 @@
+"""Sensitivity of every quantized variable of a trained model to its format.
+
+A cheap pre-pass of :mod:`annsim.search`: from the FP32 model and a few
+calibration batches of the training set, every variable (the
+``activation``/``error`` format of a quantizer site or the
+``weight``/``grad`` format of a layer, as in the search) gets a score per
+candidate format, with one backward pass per batch:
+
+* ``activation``, ``weight``: the loss change of rounding the variable
+  alone. ``gradnoise`` takes the first-order estimate ``g . (q(x) - x)``
+  (root mean square over the batches); ``hutchinson`` the second-order
+  ``Tr(H) / n * |q(x) - x|^2 / 2``, with the Hessian trace estimated by
+  ``--probes`` Rademacher vectors (one double backward each);
+* ``error``, ``grad``: the relative rounding error ``|q(g) - g| / |g|`` of
+  the gradient signal, the errors scaled by the loss scaling of training.
+
+A format is *allowed* for a variable if its score is within the tolerance:
+``--loss-tolerance`` of the loss split evenly between the forward
+variables, ``--grad-tolerance`` for the backward ones. The widest
+candidate is always allowed. The report ranks the variables by the width
+they need and lists the allowed formats (``python -m annsim.search ...
+--space REPORT`` only searches those); the narrowest allowed formats are
+written as a :class:`~annsim.layerpolicy.LayerPolicy`. Run from the
+``DNN/`` directory::
+
+    python -m annsim.sensitivity MNIST MNIST/FP32/model.pt --report MNIST/sensitivity.json \\
+        --policy MNIST/lenet_sensitivity.json
+"""
+
+import argparse
+import functools
+import json
+import os
+
+import torch
+import torch.nn.functional as F
+
+from .augment import BatchAugment
+from .data import DATASETS, CachedDataset
+from .formats import FORMATS, bits
+from .layerpolicy import ROUNDING, layer_of
+from .ptq import FP32, TEST_TRANSFORMS, build_model, load_state
+from .quant import quant_function
+from .search import to_policy, variables
+
+METHODS = ("gradnoise", "hutchinson")
+FORWARD_ROLES = ("activation", "weight")
+# Loss scaling of the training scripts, seen by the error quantizers.
+LOSS_SCALE = 1000
+
+
+def calibration_batches(dataset, root, batches, batch_size, seed=0):
+    """``batches`` random batches of the training split, preprocessed as the test set."""
+    train = CachedDataset(dataset, root, "train")
+    augment = BatchAugment.from_transform(TEST_TRANSFORMS[dataset])
+    generator = torch.Generator().manual_seed(seed)
+    index = torch.randperm(len(train), generator=generator)[:batches * batch_size]
+    for i in range(0, len(index), batch_size):
+        j = index[i:i+batch_size]
+        yield augment(train.data[j]), train.targets[j]
+
+
+def _keep(outputs, module, input, output):
+    outputs.append(output)
+    # later in-place ops (out += residual) must not change the kept tensor
+    return output.clone()
+
+
+def _rademacher(t, generator):
+    return (torch.randint(0, 2, t.shape, generator=generator) * 2 - 1).to(t)
+
+
+def analyze(model, batches, names, candidates, method="gradnoise", probes=1, device="cpu",
+            seed=0):
+    """Scores ``{variable: {format: score}}`` of the ``(kind, key, role)``
+    variables ``names`` for every format of ``candidates``, and the mean
+    loss of the float32 ``model`` on ``batches``.
+    """
+    if method not in METHODS:
+        raise ValueError(f"unknown method '{method}'")
+    model = model.to(device).eval()
+    modules = dict(model.named_modules())
+    keys = list(dict.fromkeys((kind, key) for kind, key, _ in names))
+    outputs = {key: [] for kind, key in keys if kind == "sites"}
+    params = {}
+    for name, p in model.named_parameters():
+        params.setdefault(layer_of(name), []).append(p)
+    quants = {(c, role): quant_function(FORMATS[c], ROUNDING[role])
+              for c in candidates for role in ROUNDING}
+    sums = {v: dict.fromkeys(candidates, 0.0) for v in names}
+    generator = torch.Generator().manual_seed(seed)
+    hooks = [modules[key].register_forward_hook(functools.partial(_keep, kept))
+             for key, kept in outputs.items()]
+    loss_sum, n = 0.0, 0
+    try:
+        for input, target in batches:
+            for kept in outputs.values():
+                kept.clear()
+            input = input.to(device).requires_grad_()
+            loss = F.cross_entropy(model(input), target.to(device))
+            tensors = {(kind, key): outputs[key] if kind == "sites" else params[key]
+                       for kind, key in keys}
+            flat = [t for k in keys for t in tensors[k]]
+            grads = torch.autograd.grad(loss, flat, create_graph=method == "hutchinson",
+                                        allow_unused=True)
+            grads = [torch.zeros_like(t) if g is None else g for t, g in zip(flat, grads)]
+            traces = [0.0] * len(flat)
+            curved = [i for i, g in enumerate(grads) if g.requires_grad]
+            for _ in range(probes if method == "hutchinson" and curved else 0):
+                vs = [_rademacher(flat[i], generator) for i in curved]
+                hvs = torch.autograd.grad([grads[i] for i in curved], [flat[i] for i in curved],
+                                          vs, retain_graph=True, allow_unused=True)
+                for i, v, hv in zip(curved, vs, hvs):
+                    if hv is not None:
+                        traces[i] += (v * hv).sum().item() / v.numel() / probes
+
+            # group the tensors, gradients and traces of every site and layer
+            grouped, i = {}, 0
+            for k in keys:
+                m = len(tensors[k])
+                grouped[k] = (flat[i:i+m], grads[i:i+m], traces[i:i+m])
+                i += m
+            with torch.no_grad():
+                for kind, key, role in names:
+                    ts, gs, trs = grouped[kind, key]
+                    for c in candidates:
+                        q = quants[c, role]
+                        if role in FORWARD_ROLES:
+                            ts_ = [t.detach() for t in ts]
+                            if method == "gradnoise":
+                                est = sum((g.detach() * (q(t) - t)).sum().item()
+                                          for t, g in zip(ts_, gs))
+                                score = est ** 2
+                            else:
+                                score = sum(0.5 * tr * ((q(t) - t) ** 2).sum().item()
+                                            for t, tr in zip(ts_, trs))
+                        else:
+                            scale = LOSS_SCALE if role == "error" else 1
+                            es = [g.detach() * scale for g in gs]
+                            noise = sum(((q(e) - e) ** 2).sum().item() for e in es)
+                            norm = sum((e ** 2).sum().item() for e in es)
+                            score = (noise / norm) ** 0.5 if norm > 0 else 0.0
+                        sums[kind, key, role][c] += score
+            loss_sum += loss.item()
+            n += 1
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    scores = {}
+    for (kind, key, role), per_format in sums.items():
+        scores[kind, key, role] = {c: s / n for c, s in per_format.items()}
+        if method == "gradnoise" and role in FORWARD_ROLES:
+            scores[kind, key, role] = {c: s ** 0.5 for c, s in scores[kind, key, role].items()}
+    return scores, loss_sum / n
+
+
+def allowed_formats(scores, candidates, tolerance):
+    """Formats of ``candidates`` (narrowest first) scoring within ``tolerance``."""
+    allowed = [c for c in candidates if scores[c] <= tolerance]
+    if candidates[-1] not in allowed:
+        allowed.append(candidates[-1])
+    return allowed
+
+
+def report(scores, loss, candidates, loss_tolerance, grad_tolerance):
+    """Entries of the variables, the ones needing most bits first."""
+    forward = sum(1 for _, _, role in scores if role in FORWARD_ROLES)
+    entries = []
+    for (kind, key, role), per_format in scores.items():
+        tolerance = (loss_tolerance * loss / max(1, forward) if role in FORWARD_ROLES
+                     else grad_tolerance)
+        allowed = allowed_formats(per_format, candidates, tolerance)
+        entries.append({"kind": kind, "key": key, "role": role, "scores": per_format,
+                        "tolerance": tolerance, "allowed": allowed, "recommended": allowed[0]})
+    entries.sort(key=lambda e: (-bits(FORMATS[e["recommended"]]),
+                                -e["scores"][candidates[0]] / max(e["tolerance"], 1e-30)))
+    return entries
+
+
+def print_report(entries, candidates):
+    print(f"{'variable':>28} {'role':>10} " + " ".join(f"{c:>10}" for c in candidates) +
+          f" {'needs':>10}")
+    for e in entries:
+        print(f"{e['key']:>28} {e['role']:>10} " +
+              " ".join(f"{e['scores'][c]:>10.3g}" for c in candidates) +
+              f" {e['recommended']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dataset", choices=DATASETS)
+    parser.add_argument("checkpoint", help="FP32 model.pt or a training checkpoint")
+    parser.add_argument("--candidates", nargs="+", default=["bit_8", "bit_10", "bit_12", "bit_16"],
+                        choices=list(FORMATS))
+    parser.add_argument("--roles", nargs="+", default=["activation", "error", "weight", "grad"],
+                        choices=["activation", "error", "weight", "grad"])
+    parser.add_argument("--default", default="bit_16",
+                        help="format of the roles that are not analyzed (momentum, acc, ...)")
+    parser.add_argument("--method", choices=METHODS, default="gradnoise")
+    parser.add_argument("--probes", type=int, default=4,
+                        help="Rademacher vectors per batch of the Hutchinson trace")
+    parser.add_argument("--batches", type=int, default=4, help="calibration batches")
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--loss-tolerance", type=float, default=0.05,
+                        help="allowed relative loss increase, split between the forward variables")
+    parser.add_argument("--grad-tolerance", type=float, default=0.05,
+                        help="allowed relative error of the errors and gradients")
+    parser.add_argument("--root", default=None,
+                        help="torchvision root of the dataset, default <dataset>/data/<dataset>")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--model-index", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", required=True, help="report JSON to write")
+    parser.add_argument("--policy", default=None, help="also write the recommended policy JSON")
+    args = parser.parse_args()
+
+    candidates = sorted(args.candidates, key=lambda name: bits(FORMATS[name]))
+    root = args.root or os.path.join(args.dataset, "data", args.dataset)
+    model = build_model(args.dataset, FP32, load_state(args.checkpoint, args.model_index))
+    names = variables(args.dataset, args.roles)
+    batches = calibration_batches(args.dataset, root, args.batches, args.batch_size, args.seed)
+    scores, loss = analyze(model, batches, names, candidates, args.method, args.probes,
+                           args.device, args.seed)
+    entries = report(scores, loss, candidates, args.loss_tolerance, args.grad_tolerance)
+    print_report(entries, candidates)
+
+    with open(args.report, "w") as f:
+        json.dump({"method": args.method, "loss": loss, "candidates": candidates,
+                   "variables": entries}, f, indent=1)
+    if args.policy:
+        config = {(e["kind"], e["key"], e["role"]): e["recommended"] for e in entries}
+        to_policy(config, args.default).save(args.policy, sensitivity=args.report)
+        print(f"{args.policy}: recommended formats, {args.default} elsewhere")
+
+
+if __name__ == "__main__":
+    main()
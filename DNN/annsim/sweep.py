@@ -0,0 +1,118 @@
+"""Run a training script for several number formats concurrently.
+
+Formats are split into groups of ``--formats-per-job`` and every group
+is trained by a separate worker process pinned to its own set of CPU
+cores; the formats of a group share one data pipeline (see
+``annsim.train.run_epoch``). Workers write their histories straight to
+``<outdir>/<format dir>/`` so no script is edited in place and several
+sweeps can share the same checkout.
+
+Example, from the DNN/ directory::
+
+    python -m annsim.sweep MNIST/mnist_posit.py --outdir MNIST \\
+        --formats bit_8 bit_10 bit_12 bit_14 bit_16 IEEE_Half bfloat16 \\
+        --cores-per-job 8
+"""
+
+import argparse
+import os
+import queue
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .formats import NAMES, result_dir
+
+
+def core_sets(cores, cores_per_job, jobs=None):
+    """Split ``cores`` into disjoint sets of ``cores_per_job`` cores."""
+    cores = sorted(cores)
+    if cores_per_job < 1 or cores_per_job > len(cores):
+        raise ValueError(f"cannot give {cores_per_job} cores per job with {len(cores)} cores available")
+    n = len(cores) // cores_per_job
+    if jobs is not None:
+        n = min(n, jobs)
+    return [cores[i*cores_per_job:(i+1)*cores_per_job] for i in range(n)]
+
+
+def _worker_cmd(script, formats, outdir, extra_args):
+    return [sys.executable, os.path.abspath(script),
+            "--format", *formats, "--outdir", os.path.abspath(outdir)] + list(extra_args)
+
+
+def run_job(script, formats, outdir, free_cores, extra_args=()):
+    """Run ``script`` for ``formats`` on the next free core set; return its exit code."""
+    cores = free_cores.get()
+    name = "+".join(formats)
+    try:
+        logdir = os.path.join(outdir, result_dir(formats[0]))
+        os.makedirs(logdir, exist_ok=True)
+        env = dict(os.environ)
+        for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+            env[var] = str(len(cores))
+        start = time.time()
+        print(f"[{name}] started on cores {cores[0]}-{cores[-1]}", flush=True)
+        with open(os.path.join(logdir, "train.log"), "w") as log:
+            proc = subprocess.Popen(
+                _worker_cmd(script, formats, outdir, extra_args),
+                cwd=os.path.dirname(os.path.abspath(script)),
+                env=env, stdout=log, stderr=subprocess.STDOUT,
+            )
+            # pinned from this thread: preexec_fn is not safe with threads; the
+            # worker starts its compute threads long after, when importing torch
+            try:
+                os.sched_setaffinity(proc.pid, cores)
+            except OSError:
+                # the worker already exited
+                pass
+            code = proc.wait()
+        print(f"[{name}] finished with code {code} in {time.time()-start:.0f}s", flush=True)
+        return code
+    finally:
+        free_cores.put(cores)
+
+
+def sweep(script, formats, outdir, cores_per_job, jobs=None, formats_per_job=1, extra_args=()):
+    """Train ``script`` for every format in ``formats``; return failed formats."""
+    groups = [formats[i:i+formats_per_job] for i in range(0, len(formats), formats_per_job)]
+    sets = core_sets(os.sched_getaffinity(0), cores_per_job, jobs)
+    free_cores = queue.Queue()
+    for cores in sets:
+        free_cores.put(cores)
+
+    # Datasets are downloaded once, before any worker touches them.
+    subprocess.run(_worker_cmd(script, groups[0], outdir, extra_args) + ["--download-only"],
+                   cwd=os.path.dirname(os.path.abspath(script)), check=True)
+
+    with ThreadPoolExecutor(max_workers=len(sets)) as pool:
+        codes = pool.map(lambda group: run_job(script, group, outdir, free_cores, extra_args), groups)
+        return [fmt for group, code in zip(groups, codes) if code != 0 for fmt in group]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("script", help="training script, e.g. MNIST/mnist_posit.py")
+    parser.add_argument("--formats", nargs="+", required=True, choices=NAMES,
+                        help="number formats to train")
+    parser.add_argument("--outdir", default=None,
+                        help="results directory (default: the directory of the script)")
+    parser.add_argument("--cores-per-job", type=int, default=8,
+                        help="CPU cores pinned to every worker")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="maximum number of concurrent workers")
+    parser.add_argument("--formats-per-job", type=int, default=1,
+                        help="formats trained together by one worker on shared batches")
+    args, extra_args = parser.parse_known_args(argv)
+
+    outdir = args.outdir or os.path.dirname(os.path.abspath(args.script))
+    failed = sweep(args.script, args.formats, outdir, args.cores_per_job, args.jobs,
+                   args.formats_per_job, extra_args)
+    if failed:
+        print(f"failed formats: {' '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
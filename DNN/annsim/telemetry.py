@@ -0,0 +1,131 @@
+"""Per call site statistics of the activation and error quantizers.
+
+:class:`Telemetry` observes every :class:`annsim.quant.Quantizer` of a
+model. A quantizer called at several points of ``forward`` (a ResNet
+block applies ``self.quant`` after both convolutions) is split into call
+sites named ``<module>:<call>``, e.g. ``quant_fc1:0`` or ``layer1.0.quant:1``, and each
+site has separate ``forward`` (activation) and ``backward`` (error)
+statistics:
+
+* ``overflow_rate``: inputs beyond the largest finite value of the format;
+* ``saturation_rate``: outputs rounded to the largest finite value;
+* ``underflow_rate``: non-zero inputs rounded to zero;
+* ``nonfinite``: NaN/NaR outputs;
+* ``mean_rel_error``: mean of ``|q(x) - x| / |x|`` over non-zero inputs;
+* ``exponents``: histogram of ``floor(log2 |x|)`` of the non-zero inputs.
+
+Only one training step out of ``every`` is observed. The counts are
+accumulated in device tensors and read back once per epoch by
+:meth:`Telemetry.flush`, which appends one JSON line to the output file.
+"""
+
+import json
+
+import torch
+
+from .quant import Quantizer, max_value
+
+# floor(log2 |x|) of the finite non-zero float32 values.
+EXP_MIN, EXP_MAX = -149, 127
+_COUNTS = ("values", "nonzero", "overflow", "saturated", "underflow", "nonfinite")
+
+
+class SiteStats:
+    """Device-resident counts of one call site and direction."""
+
+    def __init__(self, device):
+        self.counts = torch.zeros(len(_COUNTS), dtype=torch.float64, device=device)
+        self.rel_error = torch.zeros(1, dtype=torch.float64, device=device)
+        self.exponents = torch.zeros(EXP_MAX - EXP_MIN + 1, dtype=torch.float64, device=device)
+
+    def update(self, x, out, limit):
+        x, out = x.detach().float(), out.detach().float()
+        nonzero = (x != 0) & torch.isfinite(x)
+        if limit is None:
+            limit = float("inf")
+        self.counts[0] += x.numel()
+        self.counts[1:] += torch.stack([
+            nonzero.sum(),
+            (x.abs() > limit).sum(),
+            (out.abs() >= limit).sum(),
+            (nonzero & (out == 0)).sum(),
+            (~torch.isfinite(out)).sum(),
+        ]).double()
+        rel = (out - x).abs() / x.abs()
+        self.rel_error += torch.where(nonzero, rel, torch.zeros_like(rel)).sum(dtype=torch.float64)
+        exponent = torch.frexp(x)[1] - 1
+        index = (exponent.clamp(EXP_MIN, EXP_MAX) - EXP_MIN).view(-1).long()
+        self.exponents.scatter_add_(0, index, nonzero.view(-1).double())
+
+    def tensors(self):
+        return [self.counts, self.rel_error, self.exponents]
+
+    @staticmethod
+    def summary(values):
+        counts = dict(zip(_COUNTS, values[:len(_COUNTS)]))
+        rel_error = values[len(_COUNTS)]
+        hist = values[len(_COUNTS) + 1:]
+        n, nonzero = counts["values"] or 1.0, counts["nonzero"] or 1.0
+        return {
+            "values": int(counts["values"]),
+            "overflow_rate": counts["overflow"] / n,
+            "saturation_rate": counts["saturated"] / n,
+            "underflow_rate": counts["underflow"] / nonzero,
+            "nonfinite": int(counts["nonfinite"]),
+            "mean_rel_error": rel_error / nonzero,
+            "exponents": {str(EXP_MIN + i): int(c) for i, c in enumerate(hist) if c},
+        }
+
+
+class Telemetry:
+    """Sample the quantizers of ``model`` and append per-epoch lines to ``path``."""
+
+    def __init__(self, model, path, every=10):
+        self.path = path
+        self.every = every
+        self.step = -1
+        self.active = False
+        self.sites = {}
+        self.names = {}
+        for name, module in model.named_modules():
+            if isinstance(module, Quantizer):
+                self.names[module.quantize] = name
+                module.quantize.add_observer(self)
+        self._hook = model.register_forward_pre_hook(self._start)
+
+    def _start(self, model, inputs):
+        # Call numbers restart with every forward pass of the model.
+        for quantize in self.names:
+            quantize.reset_calls()
+        if model.training:
+            self.step += 1
+        self.active = model.training and self.step % self.every == 0
+
+    def __call__(self, quantize, direction, x, out, call):
+        if not self.active:
+            return
+        key = (f"{self.names[quantize]}:{call}", direction)
+        if key not in self.sites:
+            self.sites[key] = SiteStats(out.device)
+        with torch.no_grad():
+            self.sites[key].update(x, out, max_value(quantize.number(direction)))
+
+    def flush(self, epoch):
+        """Append the statistics of the epoch to the file and reset them."""
+        if not self.sites:
+            return
+        keys = list(self.sites)
+        size = len(_COUNTS) + 1 + EXP_MAX - EXP_MIN + 1
+        values = torch.cat([t for k in keys for t in self.sites[k].tensors()]).tolist()
+        record = {"epoch": epoch, "every": self.every, "sites": {}}
+        for i, (site, direction) in enumerate(keys):
+            stats = SiteStats.summary(values[i * size:(i + 1) * size])
+            record["sites"].setdefault(site, {})[direction] = stats
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.sites = {}
+
+    def remove(self):
+        self._hook.remove()
+        for quantize in self.names:
+            quantize.remove_observer(self)
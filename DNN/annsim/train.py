@@ -0,0 +1,74 @@
+"""Training loop shared by the dataset scripts.
+
+``run_epoch`` steps several models on the same batches, so that one data
+pipeline feeds every number format trained by a process.
+"""
+
+import torch
+from tqdm import tqdm
+
+from .metrics import MetricAccumulator
+
+
+def run_epoch(loader, models, criterion, optimizers=None, phase="train", device="cuda",
+              transform=None, monitor=None, log_every=50):
+    """Run every model of ``models`` over one epoch of ``loader``.
+
+    Each model is stepped with its own optimizer of ``optimizers`` on
+    every batch, which is loaded and moved to ``device`` only once.
+    ``transform`` is applied to the whole batch on the device, e.g. a
+    :class:`annsim.augment.BatchAugment`. When ``loader`` serves inputs
+    that are already quantized (:class:`annsim.evalcache.QuantizedTestSet`)
+    the input quantizer of the models is skipped.
+
+    The metrics stay on the device (:class:`annsim.metrics.MetricAccumulator`)
+    and are read back every ``log_every`` steps for the progress bar and
+    for ``monitor`` (:class:`annsim.monitor.Monitor`); a model it stops is
+    no longer run for the rest of the epoch.
+    Returns one ``{'loss', 'accuracy', 'per_class_accuracy', 'confusion'}``
+    dictionary per model.
+    """
+    assert phase in ["train", "eval"], "invalid running phase"
+    metrics = [None] * len(models)
+
+    input_quantized = getattr(loader, "input_quantized", False)
+    for model in models:
+        if phase=="train": model.train()
+        elif phase=="eval": model.eval()
+        model.quantize_input = not input_quantized
+
+    with torch.autograd.set_grad_enabled(phase=="train"):
+        progress = tqdm(loader, total=len(loader))
+        for i, (input, target) in enumerate(progress):
+            input = input.to(device=device, non_blocking=True)
+            if transform is not None:
+                input = transform(input)
+            target = target.to(device=device, non_blocking=True)
+            for k, model in enumerate(models):
+                if monitor is not None and not monitor.running(model):
+                    continue
+                output = model(input)
+                loss = criterion(output, target)
+                if metrics[k] is None:
+                    metrics[k] = MetricAccumulator(output.size(1), device=output.device)
+                metrics[k].update(loss, output, target)
+
+                if phase=="train":
+                    loss = loss * 1000 # do gradient scaling
+                    optimizers[k].zero_grad()
+                    loss.backward()
+                    optimizers[k].step()
+
+            if log_every and (i + 1) % log_every == 0:
+                running = [m.compute() if m is not None else None for m in metrics]
+                progress.set_postfix_str(" ".join(
+                    f"{r['loss']:.4f}/{r['accuracy']:.2f}%" for r in running if r is not None))
+                if monitor is not None:
+                    for model, r in zip(models, running):
+                        if r is not None and monitor.running(model):
+                            monitor.batch(model, r['loss'])
+
+    for model in models:
+        model.quantize_input = True
+
+    return [m.compute() for m in metrics]
@@ -0,0 +1,164 @@
+"""Model weights stored as the codes of their number format.
+
+Every weight of a low-precision model went through ``weight_quant``, so
+it holds values of an 8 or 16-bit format that :mod:`annsim.codec` stores
+exactly as ``uint8``/``int16`` codes. :func:`save` writes the tensors of a
+state dict to one raw file, each as the codes of its weight format when
+they decode back to it (float32 otherwise, like the batch norm
+statistics and formats wider than 16 bits), with a ``.json`` description
+next to it holding the codec, dtype, shape and offset of every tensor,
+as :func:`annsim.data.save_tensor` does. :class:`WeightFile` memory-maps
+the file and decodes a tensor when it is read, on the device it is read
+to; only posit negative zeros come back as zeros.
+
+Convert the last weights of a training checkpoint with::
+
+    python -m annsim.weightfile P8/checkpoint.pt P8/weights.bin --format bit_8
+"""
+
+import argparse
+import json
+import os
+from collections.abc import Mapping
+
+import torch
+
+from .codec import codec, from_spec
+from .formats import NAMES, policy
+from .layerpolicy import LayerPolicy, layer_of
+
+# Offset alignment of the tensors in the file, in bytes.
+ALIGN = 64
+
+
+def _dtype_name(dtype):
+    return str(dtype).replace("torch.", "")
+
+
+def _number(numbers, name):
+    if isinstance(numbers, LayerPolicy):
+        return numbers.number("weight", layer_of(name))
+    return numbers
+
+
+def save(path, state, numbers=None, **meta):
+    """Write the tensors of ``state`` to ``path`` as codes of their format.
+
+    ``numbers`` is the weight format of every tensor, a
+    :class:`~annsim.layerpolicy.LayerPolicy` giving it per layer or
+    ``None`` (float32); ``meta`` entries are added to the description.
+    """
+    entries, offset = {}, 0
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        for name, tensor in state.items():
+            tensor = tensor.detach().cpu().contiguous()
+            entry = {"dtype": _dtype_name(tensor.dtype), "shape": list(tensor.shape)}
+            c = codec(_number(numbers, name)) if tensor.dtype == torch.float32 else None
+            data = tensor
+            if c is not None:
+                codes = c.encode(tensor)
+                if c.exact(tensor, codes):
+                    entry["codec"] = c.spec()
+                    data = codes
+            entry.update(storage=_dtype_name(data.dtype), offset=offset)
+            raw = memoryview(data.reshape(-1).numpy()).cast("B")
+            f.write(raw)
+            offset += len(raw)
+            f.write(bytes(-offset % ALIGN))
+            offset += -offset % ALIGN
+            entries[name] = entry
+    os.replace(tmp, path)
+    with open(tmp, "w") as f:
+        json.dump(dict(meta, size=offset, tensors=entries), f, indent=1)
+    # The description is written last: its presence marks a complete file.
+    os.replace(tmp, path + ".json")
+
+
+class WeightFile(Mapping):
+    """Memory-mapped file written by :func:`save`, a mapping of decoded tensors."""
+
+    def __init__(self, path, device="cpu"):
+        with open(path + ".json") as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.device = device
+        self.entries = self.meta["tensors"]
+        self._raw = torch.from_file(path, shared=False, size=self.meta["size"], dtype=torch.uint8)
+
+    def codes(self, name):
+        """The stored tensor ``name``: codes, or the tensor itself if not coded."""
+        entry = self.entries[name]
+        dtype = getattr(torch, entry["storage"])
+        n = 1
+        for s in entry["shape"]:
+            n *= s
+        start = entry["offset"]
+        data = self._raw[start:start + n * dtype.itemsize].view(dtype)
+        return data.view(entry["shape"])
+
+    def tensor(self, name, device=None):
+        """Tensor ``name`` decoded on ``device`` (default the file's)."""
+        entry = self.entries[name]
+        data = self.codes(name).to(device or self.device)
+        if "codec" not in entry:
+            return data
+        return from_spec(entry["codec"]).decode(data).view(entry["shape"])
+
+    def __getitem__(self, name):
+        return self.tensor(name)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def nbytes(self):
+        """Bytes of the stored tensors and of their float32 (or own dtype) copies."""
+        stored = plain = 0
+        for name, entry in self.entries.items():
+            n = self.codes(name).numel()
+            stored += n * getattr(torch, entry["storage"]).itemsize
+            plain += n * getattr(torch, entry["dtype"]).itemsize
+        return stored, plain
+
+
+def load(path, device="cpu"):
+    """State dict of the file ``path``, decoded on ``device``."""
+    return dict(WeightFile(path, device))
+
+
+def is_weight_file(path):
+    """Whether ``path`` was written by :func:`save`."""
+    return os.path.exists(path + ".json") and os.path.exists(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert model weights to a packed weight file")
+    parser.add_argument("checkpoint", help="FP32 model.pt or a training checkpoint")
+    parser.add_argument("out")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--format", choices=NAMES, help="weight format of the model")
+    group.add_argument("--policy", metavar="JSON", help="per-layer policy of the model")
+    parser.add_argument("--model-index", type=int, default=0,
+                        help="model of a multi-format training checkpoint")
+    args = parser.parse_args()
+
+    state = torch.load(args.checkpoint, map_location="cpu", weights_only=False)
+    if "models" in state:
+        state = state["models"][args.model_index]
+    if args.policy:
+        numbers, name = LayerPolicy.load(args.policy), args.policy
+    else:
+        numbers, name = policy(args.format)["weight"], args.format
+    save(args.out, state, numbers, format=name)
+    weights = WeightFile(args.out)
+    stored, plain = weights.nbytes()
+    coded = sum("codec" in e for e in weights.entries.values())
+    print(f"{args.out}: {coded}/{len(state)} tensors coded, {stored} bytes ({plain / stored:.2f}x "
+          f"smaller than {plain})")
+
+
+if __name__ == "__main__":
+    main()
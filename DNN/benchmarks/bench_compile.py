@@ -0,0 +1,113 @@
+"""Time the quantized training step of the models eager and with torch.compile.
+
+The step is the forward and backward pass of a batch and the
+``LayerwiseOptimLP`` update, with the quantizers of the format as in
+training (:class:`annsim.layerpolicy.LayerPolicy`). ``compiled`` compiles
+the model, whose quantizers then call the custom operator
+``annsim::quantize``; ``inlined`` compiles it with the quantizers traced
+through their ``autograd.Function`` instead, as before the operators. The
+dynamo graphs, graph breaks and recompilations of every mode are counted
+and the logits of the first step compared with the eager ones; a mode
+that fails to compile is reported with its error.
+
+Run from the DNN/ directory::
+
+    python benchmarks/bench_compile.py --threads 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch._dynamo
+import torch.nn.functional as F
+from torch.optim import SGD
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from annsim.layerpolicy import LayerPolicy
+from annsim.models import LeNet, ResNet18Posit
+from annsim.optim import LayerwiseOptimLP
+from annsim.quant import Quantizer
+
+MODELS = {"LeNet": (LeNet, (1, 32, 32)), "ResNet18Posit": (ResNet18Posit, (3, 32, 32))}
+MODES = ("eager", "compiled", "inlined")
+
+
+def run(model_name, name, mode, batch_size, steps):
+    """Time per step in ms, the logits of the first step and dynamo's counts."""
+    model_cls, shape = MODELS[model_name]
+    layer_policy = LayerPolicy(name)
+    torch.manual_seed(0)
+    model = model_cls(layer_policy)
+    optimizer = LayerwiseOptimLP(SGD(model.parameters(), lr=0.05, momentum=0.9, weight_decay=5e-4),
+                                 layer_policy.param_quants(model), grad_scaling=1/1000)
+    if mode == "inlined":
+        for m in model.modules():
+            if isinstance(m, Quantizer):
+                m.quantize.op_args = None
+    torch._dynamo.reset()
+    counts = {}
+    if mode != "eager":
+        explained = torch._dynamo.explain(model)(torch.zeros(batch_size, *shape))
+        counts = {"graphs": explained.graph_count, "breaks": explained.graph_break_count}
+        torch._dynamo.reset()
+        torch._dynamo.utils.counters.clear()
+        forward = torch.compile(model)
+    else:
+        forward = model
+    data = torch.randn(batch_size, *shape)
+    target = torch.randint(0, 10, (batch_size,))
+    times, first = [], None
+    for _ in range(steps + 2):
+        start = time.perf_counter()
+        output = forward(data)
+        loss = F.cross_entropy(output, target) * 1000
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        times.append(time.perf_counter() - start)
+        if first is None:
+            first = output.detach()
+    if mode != "eager":
+        counts["recompiles"] = torch._dynamo.utils.counters["stats"]["unique_graphs"] - counts["graphs"]
+    # the first two steps compile and create the momentum buffers
+    return sum(times[2:]) / steps * 1e3, first, counts
+
+
+def bench_compile(models, formats, batch_size, steps):
+    print(f"training step, batch of {batch_size}, time per step in ms")
+    print(f"{'model':>14} {'format':>10} {'mode':>9} {'time':>9} {'speedup':>8} {'graphs':>7} "
+          f"{'breaks':>7} {'recompiles':>10} {'max diff':>9}")
+    for model_name in models:
+        for name in formats:
+            reference = None
+            for mode in MODES:
+                try:
+                    t, logits, counts = run(model_name, name, mode, batch_size, steps)
+                except Exception as e:
+                    print(f"{model_name:>14} {name:>10} {mode:>9} failed: {type(e).__name__}")
+                    continue
+                if reference is None:
+                    reference = t, logits
+                diff = (logits - reference[1]).abs().max().item()
+                print(f"{model_name:>14} {name:>10} {mode:>9} {t:>9.2f} {reference[0] / t:>7.2f}x "
+                      f"{counts.get('graphs', '-'):>7} {counts.get('breaks', '-'):>7} "
+                      f"{counts.get('recompiles', '-'):>10} {diff:>9.2g}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--models", nargs="+", default=list(MODELS), choices=list(MODELS))
+    parser.add_argument("--formats", nargs="+", default=["bit_8", "bfloat16", "IBM8"])
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=5)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    bench_compile(args.models, args.formats, args.batch_size, args.steps)
+
+
+if __name__ == "__main__":
+    main()
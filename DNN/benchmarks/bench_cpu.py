@@ -0,0 +1,95 @@
+"""Throughput of the quantized models on the CPU, to size format sweeps.
+
+Every model is trained for a few steps (forward, backward and the
+``LayerwiseOptimLP`` update, with the quantizers of the format as in
+training) and evaluated on random batches, with the threads and memory
+format of :mod:`annsim.backend`. The images per second of one run with
+``--threads`` threads give the cores per job of ``annsim.sweep``: a
+sweep of F formats over C cores runs C/threads jobs at once.
+
+Run from the DNN/ directory::
+
+    python benchmarks/bench_cpu.py --threads 1 4 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+from torch.optim import SGD
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from annsim.backend import cpu_cores, memory_format
+from annsim.costmodel import INPUT_SHAPES
+from annsim.layerpolicy import LayerPolicy
+from annsim.models import MODELS
+from annsim.optim import LayerwiseOptimLP
+
+
+def throughput(dataset, name, fmt, batch_size, steps):
+    """Training and eval images per second of the model of ``dataset`` in format ``name``."""
+    layer_policy = LayerPolicy(name)
+    torch.manual_seed(0)
+    model = MODELS[dataset](layer_policy).to(memory_format=fmt)
+    optimizer = LayerwiseOptimLP(SGD(model.parameters(), lr=0.05, momentum=0.9, weight_decay=5e-4),
+                                 layer_policy.param_quants(model), grad_scaling=1/1000)
+    data = torch.randn(batch_size, *INPUT_SHAPES[dataset])
+    target = torch.randint(0, 10, (batch_size,))
+
+    def train_step():
+        loss = F.cross_entropy(model(data), target) * 1000
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    def eval_step():
+        with torch.no_grad():
+            model(data)
+
+    rates = []
+    for step, mode in ((train_step, model.train), (eval_step, model.eval)):
+        mode()
+        step()  # creates the momentum buffers and warms the caches
+        start = time.perf_counter()
+        for _ in range(steps):
+            step()
+        rates.append(batch_size * steps / (time.perf_counter() - start))
+    return rates
+
+
+def bench_cpu(datasets, formats, threads, memory_formats, batch_size, steps):
+    print(f"images/s, batch of {batch_size}, {cpu_cores()} cores available")
+    print(f"{'model':>14} {'format':>10} {'threads':>7} {'memory':>13} {'train':>9} {'eval':>9}")
+    for dataset in datasets:
+        for name in formats:
+            for n in threads:
+                torch.set_num_threads(n)
+                # LeNet runs contiguous whatever the name
+                fmts = dict.fromkeys(memory_format(dataset, "cpu", f) for f in memory_formats)
+                for fmt in fmts:
+                    train, evaluation = throughput(dataset, name, fmt, batch_size, steps)
+                    shown = "channels_last" if fmt == torch.channels_last else "contiguous"
+                    print(f"{MODELS[dataset].__name__:>14} {name:>10} {n:>7} {shown:>13} "
+                          f"{train:>9.1f} {evaluation:>9.1f}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--datasets", nargs="+", default=["MNIST", "SVHN"], choices=list(MODELS))
+    parser.add_argument("--formats", nargs="+", default=["bit_8", "bit_16", "bfloat16", "IBM8"])
+    parser.add_argument("--threads", nargs="+", type=int, default=[cpu_cores()])
+    parser.add_argument("--memory-formats", nargs="+", default=["auto"],
+                        choices=["auto", "contiguous", "channels_last"])
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--steps", type=int, default=3)
+    args = parser.parse_args()
+    torch.set_num_interop_threads(1)
+    bench_cpu(args.datasets, args.formats, args.threads, args.memory_formats, args.batch_size,
+              args.steps)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Scaling of data-parallel CPU training over local processes.
+
+For every number of processes, the model is trained for a few steps by
+that many ``gloo`` processes on this node (:mod:`annsim.distributed`,
+each pinned to its share of the cores), on random batches of
+``--batch-size`` images split between them, with the gradients reduced
+as codes of the gradient format (``codes``) or in float32 (``float32``).
+It prints the time per step, the images per second and the speedup over
+one process, the bytes sent per step by every process, the training loss
+of the last step over all processes, whether the weights of all the
+replicas are identical and, for ``codes``, the relative error (L2 norm)
+of the mean gradients of one more step against the float32 reduction of
+the same gradients (``packed=False``), which grows with the processes as
+the partial sums are rounded at every hop of the ring.
+
+Run from the DNN/ directory::
+
+    python benchmarks/bench_ddp.py --datasets SVHN --processes 1 2 4 8 16
+"""
+
+import argparse
+import os
+import queue
+import socket
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from torch.optim import SGD
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from annsim import distributed
+from annsim.backend import cpu_cores, memory_format
+from annsim.costmodel import INPUT_SHAPES
+from annsim.layerpolicy import LayerPolicy
+from annsim.models import MODELS
+from annsim.optim import LayerwiseOptimLP
+from annsim.philox import CounterRNG
+
+MODES = ("codes", "float32")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, world, port, dataset, name, packed, batch_size, steps, results):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port), RANK=str(rank),
+                      WORLD_SIZE=str(world), LOCAL_RANK=str(rank), LOCAL_WORLD_SIZE=str(world))
+    distributed.init()
+    torch.set_num_threads(cpu_cores())
+    torch.set_num_interop_threads(1)
+    layer_policy = LayerPolicy(name)
+    # the replicas round alike only with counter-based random numbers
+    layer_policy.generator = CounterRNG(0)
+    torch.manual_seed(0)
+    model = MODELS[dataset](layer_policy).to(memory_format=memory_format(dataset, "cpu"))
+    optimizer = LayerwiseOptimLP(SGD(model.parameters(), lr=0.05, momentum=0.9, weight_decay=5e-4),
+                                 layer_policy.param_quants(model), grad_scaling=1/1000)
+    layer_policy.generator.attach(optimizer)
+    reducer = distributed.GradientReducer(optimizer, packed=packed) if world > 1 else None
+    # the batch of every step, of which each process takes its part
+    generator = torch.Generator().manual_seed(1)
+    data = torch.randn(batch_size, *INPUT_SHAPES[dataset], generator=generator)
+    target = torch.randint(0, 10, (batch_size,), generator=generator)
+    part = slice(rank * (batch_size // world), (rank + 1) * (batch_size // world))
+    data, target = data[part].contiguous(memory_format=memory_format(dataset, "cpu")), target[part]
+
+    def step():
+        loss = F.cross_entropy(model(data), target)
+        optimizer.zero_grad()
+        (loss * 1000).backward()
+        optimizer.step()
+        return loss.detach()
+
+    def gradient_error():
+        # the gradients of one more step, reduced as codes and in float32
+        reference = distributed.GradientReducer(optimizer, packed=False)
+        reference.handle.remove()
+        optimizer.zero_grad()
+        (F.cross_entropy(model(data), target) * 1000).backward()
+        params = [p for p in model.parameters() if p.grad is not None]
+        grads = [p.grad.clone() for p in params]
+        reference.reduce()
+        expected = torch.cat([p.grad.reshape(-1) for p in params])
+        for p, grad in zip(params, grads):
+            p.grad.copy_(grad)
+        reducer.reduce()
+        got = torch.cat([p.grad.reshape(-1) for p in params])
+        return ((got - expected).norm() / expected.norm()).item()
+
+    model.train()
+    step()  # creates the momentum buffers and warms the caches
+    if reducer is not None:
+        reducer.sent = reducer.float32_sent = 0
+        dist.barrier()
+    start = time.perf_counter()
+    for _ in range(steps):
+        loss = step()
+    elapsed = time.perf_counter() - start
+    sent = reducer.sent / steps if reducer else 0
+    float32_sent = reducer.float32_sent / steps if reducer else 0
+    weights = torch.cat([p.detach().reshape(-1) for p in model.parameters()])
+    same = True
+    if world > 1:
+        dist.all_reduce(loss)
+        loss /= world
+        replicas = [torch.empty_like(weights) for _ in range(world)]
+        dist.all_gather(replicas, weights)
+        same = all(torch.equal(replicas[0], w) for w in replicas[1:])
+        times = [None] * world
+        dist.all_gather_object(times, elapsed)
+        elapsed = max(times)
+    error = gradient_error() if reducer is not None and packed else None
+    if rank == 0:
+        results.put({"time": elapsed / steps, "loss": loss.item(), "same": same,
+                     "sent": sent, "float32_sent": float32_sent, "error": error})
+    if world > 1:
+        dist.destroy_process_group()
+
+
+def run(world, dataset, name, packed, batch_size, steps):
+    """Time per step and bytes sent per step of ``world`` processes."""
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    port = _free_port()
+    processes = [ctx.Process(target=_worker, args=(rank, world, port, dataset, name, packed,
+                                                   batch_size, steps, results))
+                 for rank in range(world)]
+    for p in processes:
+        p.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            # the others would wait for a crashed (e.g. out of memory) process
+            failed = [p.exitcode for p in processes if p.exitcode not in (None, 0)]
+            if failed:
+                for p in processes:
+                    p.terminate()
+                raise RuntimeError(f"a process exited with code {failed[0]}")
+    for p in processes:
+        p.join()
+    return result
+
+
+def bench_ddp(datasets, formats, processes, modes, batch_size, steps):
+    print(f"training step, batch of {batch_size} split between the processes, "
+          f"{cpu_cores()} cores available")
+    print(f"{'model':>14} {'format':>10} {'procs':>5} {'mode':>8} {'ms/step':>9} {'images/s':>9} "
+          f"{'speedup':>8} {'MB sent':>8} {'vs f32':>7} {'loss':>7} {'replicas':>9} "
+          f"{'grad err':>9}")
+    for dataset in datasets:
+        for name in formats:
+            for mode in modes:
+                base = None
+                for world in processes:
+                    try:
+                        r = run(world, dataset, name, mode == "codes", batch_size, steps)
+                    except RuntimeError as e:
+                        print(f"{MODELS[dataset].__name__:>14} {name:>10} {world:>5} {mode:>8} "
+                              f"failed: {e}", flush=True)
+                        continue
+                    base = base or r["time"]
+                    ratio = r["float32_sent"] / r["sent"] if r["sent"] else 1.0
+                    error = "-" if r["error"] is None else f"{r['error']:.2e}"
+                    print(f"{MODELS[dataset].__name__:>14} {name:>10} {world:>5} {mode:>8} "
+                          f"{r['time'] * 1e3:>9.1f} {batch_size / r['time']:>9.1f} "
+                          f"{base / r['time']:>7.2f}x {r['sent'] / 2**20:>8.2f} {ratio:>6.1f}x "
+                          f"{r['loss']:>7.4f} {'same' if r['same'] else 'DIFFER':>9} "
+                          f"{error:>9}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--datasets", nargs="+", default=["SVHN"], choices=list(MODELS))
+    parser.add_argument("--formats", nargs="+", default=["bit_8", "bit_16", "bfloat16"])
+    parser.add_argument("--processes", nargs="+", type=int, default=[1, 2, 4, 8, 16])
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--steps", type=int, default=3)
+    args = parser.parse_args()
+    bench_ddp(args.datasets, args.formats, args.processes, args.modes, args.batch_size,
+              args.steps)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Time the optimizer step of OptimLP against the optimizers of annsim on CPU.
+
+Every optimizer wraps ``SGD(lr=0.05, momentum=0.9, weight_decay=5e-4)``
+with the quantizers of the training scripts and steps the parameters of
+the models with fixed random gradients. The stochastic rounding draws
+from a :class:`annsim.philox.CounterRNG` of the same seed for every
+optimizer, as with ``--rounding-seed``, so the weights after the steps
+are compared with the ones of ``OptimLP`` whatever order the optimizers
+round the parameters in.
+
+Run from the DNN/ directory::
+
+    python benchmarks/bench_optim.py --threads 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from torch.optim import SGD
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from annsim.formats import policy
+from annsim.models import LeNet, ResNet18Posit
+from annsim.optim import FusedOptimLP, PackedOptimLP
+from annsim.philox import CounterRNG
+from annsim.quant import Quantizer, quantizer
+from qtorch_plus.optim import OptimLP
+
+MODELS = {"LeNet": LeNet, "ResNet18Posit": ResNet18Posit}
+OPTIMIZERS = {"OptimLP": OptimLP, "PackedOptimLP": PackedOptimLP, "FusedOptimLP": FusedOptimLP}
+
+
+def make_optimizer(cls, model, num_format, generator):
+    optimizer = SGD(model.parameters(), lr=0.05, momentum=0.9, weight_decay=5e-4)
+    optimizer = cls(optimizer,
+                    weight_quant=quantizer(forward_number=num_format["weight"],
+                                           forward_rounding="nearest"),
+                    grad_quant=quantizer(forward_number=num_format["grad"],
+                                         forward_rounding="nearest"),
+                    momentum_quant=quantizer(forward_number=num_format["momentum"],
+                                             forward_rounding="stochastic", generator=generator),
+                    acc_quant=quantizer(forward_number=num_format["acc"],
+                                        forward_rounding="stochastic", generator=generator),
+                    grad_scaling=1/1000)
+    generator.attach(optimizer)
+    return optimizer
+
+
+def run(cls, model_cls, name, steps):
+    """Time per step in ms and the weights after ``steps`` steps."""
+    num_format = policy(name)
+    torch.manual_seed(0)
+    model = model_cls(lambda site=None: Quantizer())
+    optimizer = make_optimizer(cls, model, num_format, CounterRNG(0))
+    grads = [torch.randn_like(p) * 1000 for p in model.parameters()]
+    times = []
+    for _ in range(steps + 1):
+        for p, g in zip(model.parameters(), grads):
+            p.grad = g.clone()
+        start = time.perf_counter()
+        optimizer.step()
+        times.append(time.perf_counter() - start)
+    # the first step creates the momentum buffers
+    return sum(times[1:]) / steps * 1e3, [p.detach().clone() for p in model.parameters()]
+
+
+def bench_optim(formats, steps):
+    print("optimizer step, time per step in ms")
+    print(f"{'model':>14} {'format':>10} {'optimizer':>14} {'time':>9} {'speedup':>8} "
+          f"{'identical':>9}")
+    for model_name, model_cls in MODELS.items():
+        for name in formats:
+            reference, weights = None, None
+            for opt_name, cls in OPTIMIZERS.items():
+                t, w = run(cls, model_cls, name, steps)
+                if reference is None:
+                    reference, weights = t, w
+                identical = all(torch.equal(a, b) for a, b in zip(weights, w))
+                print(f"{model_name:>14} {name:>10} {opt_name:>14} {t:>9.2f} "
+                      f"{reference / t:>7.2f}x {str(identical):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--formats", nargs="+", default=["Posit8", "bit_16", "bfloat16"])
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    bench_optim(args.formats, args.steps)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Time the quantizers of annsim against the qtorch_plus kernels on CPU.
+
+Run from the DNN/ directory::
+
+    python benchmarks/bench_quant.py --threads 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from annsim.floating import float_quantize
+from annsim.formats import FORMATS, IBM_8, IBM_half
+from annsim.philox import CounterRNG
+from annsim.posit import Posit, posit_quantize
+from annsim.quant import Quantizer, quant_function
+from annsim.telemetry import Telemetry
+from qtorch_plus import quant as qtorch_quant
+
+
+def timeit(fn, x, repeat):
+    fn(x)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(x)
+    return (time.perf_counter() - start) / repeat * 1e3
+
+
+def bench_posit(x, repeat):
+    print(f"posit(n, 2), tensor {tuple(x.shape)}, time per call in ms")
+    print(f"{'n':>3} {'rounding':>10} {'annsim':>9} {'qtorch+':>9} {'speedup':>8} {'mismatch':>9}")
+    for nsize in (8, 10, 12, 14, 16, 20, 24, 28, 32):
+        for rounding in ("nearest", "stochastic"):
+            ours = lambda t: posit_quantize(t, nsize, 2, rounding)
+            t_ours = timeit(ours, x, repeat)
+            if nsize > 16:
+                # qtorch_plus only implements posits up to 16 bits and exits
+                # the process for the others
+                print(f"{nsize:>3} {rounding:>10} {t_ours:>9.2f} {'-':>9} {'-':>8} {'-':>9}")
+                continue
+            theirs = lambda t: qtorch_quant.posit_quantize(t, nsize=nsize, es=2, rounding=rounding)
+            t_theirs = timeit(theirs, x, repeat)
+            mismatch = "-"
+            if rounding == "nearest":
+                mismatch = f"{(ours(x) != theirs(x)).float().mean().item():.2e}"
+            print(f"{nsize:>3} {rounding:>10} {t_ours:>9.2f} {t_theirs:>9.2f} "
+                  f"{t_theirs / t_ours:>7.2f}x {mismatch:>9}")
+
+
+# Activation tensors quantized by act_error_quant, batch size 128.
+ACTIVATIONS = {
+    "LeNet": [(128, 1, 32, 32), (128, 6, 14, 14), (128, 16, 5, 5), (128, 120), (128, 84)],
+    "ResNet18Posit": [(128, 64, 32, 32), (128, 128, 16, 16), (128, 256, 8, 8), (128, 512, 4, 4)],
+}
+
+
+def bench_float(repeat):
+    print("FloatingPoint nearest rounding, time per model forward (all activation sites) in ms")
+    print(f"{'model':>14} {'format':>10} {'annsim':>9} {'qtorch+':>9} {'speedup':>8} "
+          f"{'identical':>9}")
+    # stochastic rounding is left out: qtorch_plus draws from its own std::mt19937
+    formats = {"bfloat16": FORMATS["bfloat16"], "IEEE_Half": FORMATS["IEEE_Half"],
+               "IBM_8": IBM_8, "IBM_half": IBM_half}
+    for model, shapes in ACTIVATIONS.items():
+        xs = [torch.randn(*shape) * torch.exp(4 * torch.randn(*shape)) for shape in shapes]
+        for name, number in formats.items():
+            exp, man = number.exp, number.man
+            ours = lambda t: float_quantize(t, exp, man)
+            theirs = lambda t: qtorch_quant.float_quantize(t, exp=exp, man=man, rounding="nearest")
+            t_ours = sum(timeit(ours, x, repeat) for x in xs)
+            t_theirs = sum(timeit(theirs, x, repeat) for x in xs)
+            identical = all(torch.equal(ours(x).view(torch.int32), theirs(x).view(torch.int32))
+                            for x in xs)
+            print(f"{model:>14} {name:>10} {t_ours:>9.2f} {t_theirs:>9.2f} "
+                  f"{t_theirs / t_ours:>7.2f}x {str(identical):>9}")
+
+
+def bench_counter(x, repeat):
+    print(f"stochastic rounding, tensor {tuple(x.shape)}, global generator against "
+          "CounterRNG (Philox4x32-10), time per call in ms")
+    print(f"{'format':>10} {'global':>9} {'counter':>9} {'speedup':>8}")
+    t_words = timeit(lambda t: CounterRNG().words(0, t.shape, t.device), x, repeat)
+    print(f"{'words':>10} {'-':>9} {t_words:>9.2f} {'-':>8}")
+    formats = dict(FORMATS, IBM_8=IBM_8, IBM_half=IBM_half)
+    for name in ("bit_8", "bit_16", "bit_20", "bit_32", "bfloat16", "IEEE_Half", "IBM_8",
+                 "IBM_half"):
+        ours = quant_function(formats[name], "stochastic")
+        counter = quant_function(formats[name], "stochastic", CounterRNG().stream())
+        t_ours = timeit(ours, x, repeat)
+        t_counter = timeit(counter, x, repeat)
+        print(f"{name:>10} {t_ours:>9.2f} {t_counter:>9.2f} {t_ours / t_counter:>7.2f}x")
+
+
+class _Sites(nn.Module):
+    # One quantizer applied at every activation site, as in LeNet.
+    def __init__(self, number):
+        super().__init__()
+        self.quant = Quantizer(forward_number=number, backward_number=number)
+
+    def forward(self, xs):
+        return [self.quant(x) for x in xs]
+
+
+def bench_telemetry(repeat, every=(1, 10)):
+    print("telemetry overhead on the posit(8, 2) quantizer, forward and backward of all "
+          "activation sites, in ms")
+    print(f"{'model':>14} {'plain':>9} " + " ".join(f"{f'every={n}':>15}" for n in every))
+    for model, shapes in ACTIVATIONS.items():
+        xs = [torch.randn(*shape, requires_grad=True) for shape in shapes]
+        sites = _Sites(Posit(8, 2))
+        step = lambda _: sum(y.sum() for y in sites(xs)).backward()
+        t_plain = timeit(step, None, repeat)
+        cols = []
+        for n in every:
+            telemetry = Telemetry(sites, os.devnull, every=n)
+            t = timeit(step, None, repeat * n)
+            telemetry.flush(0)
+            telemetry.remove()
+            cols.append(f"{t:>7.2f} ({(t / t_plain - 1) * 100:+4.1f}%)")
+        print(f"{model:>14} {t_plain:>9.2f} " + " ".join(f"{c:>15}" for c in cols))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--shape", type=int, nargs="+", default=[128, 64, 32, 32],
+                        help="tensor shape, default is the first ResNet18 activation")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    x = torch.randn(*args.shape) * torch.exp(2 * torch.randn(*args.shape))
+    bench_posit(x, args.repeat)
+    print()
+    bench_float(args.repeat)
+    print()
+    bench_counter(x, args.repeat)
+    print()
+    bench_telemetry(args.repeat)
+
+
+if __name__ == "__main__":
+    main()
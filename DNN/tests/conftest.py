@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import annsim from the DNN/ directory, as the scripts do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,58 @@
+"""Round trips of the integer codes of annsim.codec."""
+
+import pytest
+import torch
+
+from annsim.codec import codec, from_spec
+from annsim.formats import FORMATS, bits
+from annsim.quant import quant_function
+
+CODED = [name for name, number in FORMATS.items() if codec(number) is not None]
+
+
+def _values(number, n=1 << 14):
+    # values of the format over its whole range, and the special values
+    g = torch.Generator().manual_seed(0)
+    scale = torch.exp2(torch.randint(-140, 130, (n,), generator=g).float())
+    x = torch.cat([torch.randn(n, generator=g) * scale,
+                   torch.tensor([0.0, -0.0, 1.0, -1.0, float("inf"), -float("inf"), float("nan")])])
+    return quant_function(number)(x)
+
+
+def _all_codes(c):
+    codes = torch.arange(1 << c.bits)
+    if c.bits > 8:
+        codes = torch.where(codes >= 1 << 15, codes - (1 << 16), codes)
+    return codes.to(c.dtype)
+
+
+@pytest.mark.parametrize("name", CODED)
+def test_round_trip(name):
+    number = FORMATS[name]
+    c = codec(number)
+    x = _values(number)
+    codes = c.encode(x)
+    assert codes.dtype == (torch.uint8 if bits(number) <= 8 else torch.int16)
+    assert c.exact(x, codes)
+
+
+@pytest.mark.parametrize("name", CODED)
+def test_every_code(name):
+    c = codec(FORMATS[name])
+    values = c.decode(_all_codes(c))
+    assert c.exact(values, c.encode(values))
+
+
+@pytest.mark.parametrize("name", CODED)
+def test_table_encoding(name):
+    # the table of the keys gives the codes of the computed encoding
+    c = codec(FORMATS[name])
+    x = _values(FORMATS[name])
+    assert c.key_shift is not None
+    assert torch.equal(c.encode(x), c._encode(x))
+
+
+@pytest.mark.parametrize("name", CODED)
+def test_spec(name):
+    c = codec(FORMATS[name])
+    assert from_spec(c.spec()).args() == c.args()
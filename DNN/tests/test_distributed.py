@@ -0,0 +1,75 @@
+"""The coded ring all-reduce of annsim.distributed against a plain sum."""
+
+import os
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from qtorch_plus.optim import OptimLP
+from torch.optim import SGD
+
+from annsim import distributed
+from annsim.codec import codec
+from annsim.formats import FORMATS
+from annsim.quant import quantizer
+
+WORLD = 2
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, port, name, packed, results):
+    os.environ.update(RANK=str(rank), WORLD_SIZE=str(WORLD), MASTER_ADDR="127.0.0.1",
+                      MASTER_PORT=str(port))
+    dist.init_process_group("gloo", rank=rank, world_size=WORLD)
+    try:
+        torch.set_num_threads(1)
+        number = FORMATS[name]
+        params = [torch.nn.Parameter(torch.zeros(shape)) for shape in ((3, 5), (1001,), (7,))]
+        optimizer = OptimLP(SGD(params, lr=0.1),
+                            grad_quant=quantizer(forward_number=number, forward_rounding="nearest"),
+                            grad_scaling=1/1000)
+        g = torch.Generator().manual_seed(rank)
+        for p in params:
+            p.grad = torch.randn(p.shape, generator=g) * 1000
+        # the plain sum of the rounded gradients of the ranks
+        quant = quantizer(forward_number=number, forward_rounding="nearest")
+        scaling = optimizer.grad_scaling
+        total = torch.cat([quant(p.grad * scaling).view(-1) for p in params])
+        dist.all_reduce(total)
+        expected = quant(total / WORLD) / scaling
+
+        reducer = distributed.GradientReducer(optimizer, packed=packed)
+        reducer.reduce()
+        reduced = torch.cat([p.grad.view(-1) for p in params])
+        if rank == 0:
+            results.put((torch.equal(reduced, expected), reducer.sent, reducer.float32_sent))
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("name,packed", [("bit_8", True), ("bit_16", True), ("bfloat16", True),
+                                         ("bit_8", False)])
+def test_ring_all_reduce(name, packed):
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    port = _free_port()
+    processes = [ctx.Process(target=_worker, args=(rank, port, name, packed, results))
+                 for rank in range(WORLD)]
+    for p in processes:
+        p.start()
+    same, sent, float32_sent = results.get(timeout=120)
+    for p in processes:
+        p.join(timeout=60)
+        assert p.exitcode == 0
+    # two ranks add the two halves once, without rounding in between
+    assert same
+    # every element sent once as a code, where float32 would send 4 bytes
+    itemsize = codec(FORMATS[name]).dtype.itemsize if packed else 4
+    assert sent == float32_sent * itemsize // 4
@@ -0,0 +1,54 @@
+"""Bit-mask float rounding of annsim.floating against qtorch_plus."""
+
+import pytest
+import torch
+from qtorch_plus import quant as qtorch_quant
+
+from annsim.floating import float_quantize
+
+FORMATS = [(8, 7), (5, 10), (5, 2), (6, 9), (4, 3)]
+
+
+def _inputs(n=1 << 16):
+    # random magnitudes over the float32 range, subnormals, ties of the
+    # narrow formats and the special values
+    g = torch.Generator().manual_seed(0)
+    scale = torch.exp2(torch.randint(-150, 128, (n,), generator=g).float())
+    ties = torch.arange(1, 1 << 10).float() / (1 << 4) + 1 / (1 << 5)
+    return torch.cat([torch.randn(n, generator=g) * scale, ties, -ties,
+                      torch.tensor([0.0, -0.0, 1e-45, -1e-40, 3.4e38, float("inf"),
+                                    -float("inf"), float("nan")])])
+
+
+def _same(a, b):
+    return torch.equal(a.view(torch.int32), b.view(torch.int32)) or \
+        bool(((a == b) | (a.isnan() & b.isnan())).all())
+
+
+@pytest.mark.parametrize("exp,man", FORMATS)
+def test_nearest_qtorch(exp, man):
+    x = _inputs()
+    expected = qtorch_quant.float_quantize(x, exp=exp, man=man, rounding="nearest")
+    assert _same(float_quantize(x, exp, man, "nearest"), expected)
+
+
+def test_float32_unchanged():
+    # qtorch_plus flips signs with man=23, float32 itself is kept
+    x = _inputs()
+    assert _same(float_quantize(x, 8, 23, "nearest"), x)
+    assert _same(float_quantize(x, 8, 23, "stochastic"), x)
+
+
+@pytest.mark.parametrize("exp,man", FORMATS)
+def test_stochastic_words(exp, man):
+    # the words of random() replace the global generator: all zeros
+    # truncate, all ones round every inexact value up
+    x = _inputs()
+    zeros = float_quantize(x, exp, man, "stochastic", lambda shape, device: torch.zeros(
+        shape, dtype=torch.int32, device=device))
+    ones = float_quantize(x, exp, man, "stochastic", lambda shape, device: torch.full(
+        shape, -1, dtype=torch.int32, device=device))
+    finite = zeros.isfinite() & ones.isfinite()
+    assert bool((zeros[finite].abs() <= ones[finite].abs()).all())
+    exact = float_quantize(x, exp, man, "nearest") == x
+    assert _same(zeros[exact], x[exact]) and _same(ones[exact], x[exact])
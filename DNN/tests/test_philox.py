@@ -0,0 +1,58 @@
+"""Philox4x32-10 known answers and the draws of annsim.philox.CounterRNG."""
+
+import pytest
+import torch
+
+from annsim.philox import CounterRNG, philox
+
+# The known-answer tests of Random123 (kat_vectors): counter, key, result.
+KAT = [
+    ((0, 0, 0, 0), (0, 0), (0x6627E8D5, 0xE169C58D, 0xBC57AC4C, 0x9B00DBD8)),
+    ((0xFFFFFFFF,) * 4, (0xFFFFFFFF,) * 2, (0x408F276D, 0x41C83B0E, 0xA20BC7C6, 0x6D5451FD)),
+    ((0x243F6A88, 0x85A308D3, 0x13198A2E, 0x03707344), (0xA4093822, 0x299F31D0),
+     (0xD16CFE09, 0x94FDCCEB, 0x5001E420, 0x24126EA1)),
+]
+
+
+@pytest.mark.parametrize("counter,key,expected", KAT)
+def test_known_answers(counter, key, expected):
+    c0, c1, c2, c3 = counter
+    words = philox(torch.tensor([c0]), c1, c2, c3, (key[1] << 32) | key[0])
+    assert tuple(w.item() for w in words) == expected
+
+
+def test_words():
+    # the words of element i are word i % 4 of the block i // 4, as int32
+    rng = CounterRNG(seed=5)
+    words = rng.stream()((3, 7), "cpu")
+    assert words.dtype == torch.int32 and words.shape == (3, 7)
+    blocks = torch.stack(philox(torch.arange(6), 0, 0, 0, 5), dim=1).view(-1)[:21]
+    assert torch.equal(words.view(-1).long() & 0xFFFFFFFF, blocks)
+
+
+def test_draws():
+    # a draw depends on the stream, the draw number and the step only
+    a, b = CounterRNG(seed=1), CounterRNG(seed=1)
+    sa, sb, other = a.stream(), b.stream(), b.stream()
+    first = sa((100,), "cpu").clone()
+    assert not torch.equal(other((100,), "cpu"), first)
+    assert torch.equal(sb((100,), "cpu"), first)
+    assert not torch.equal(sb((100,), "cpu"), first)
+    a.advance()
+    assert not torch.equal(sa((100,), "cpu"), first)
+    b.load_state_dict({"seed": 1, "step": 0})
+    assert torch.equal(sb((100,), "cpu"), first)
+
+
+def test_pieces():
+    # pieces of the next draws give the words of the whole draws
+    a, b = CounterRNG(seed=3), CounterRNG(seed=3)
+    sa, sb = a.stream(), b.stream()
+    whole = torch.cat([sa((n,), "cpu").clone() for n in (5, 13, 2, 7)])
+    parts = []
+    for pieces, draws in [([(0, 0, 5), (1, 0, 6)], 1), ([(0, 6, 7), (1, 0, 2), (2, 0, 3)], 2),
+                          ([(0, 3, 4)], 1)]:
+        with b.pieces(pieces, draws):
+            parts.append(sb((sum(n for _, _, n in pieces),), "cpu").clone())
+    assert torch.equal(torch.cat(parts), whole)
+    assert torch.equal(sb((3,), "cpu"), sa((3,), "cpu"))
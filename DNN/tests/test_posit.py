@@ -0,0 +1,61 @@
+"""Posit rounding of annsim.posit against qtorch_plus and its own values."""
+
+import pytest
+import torch
+from qtorch_plus import quant as qtorch_quant
+
+from annsim.posit import Posit, _tables, posit_quantize
+
+# qtorch_plus only implements posits up to 16 bits
+FORMATS = [(n, es) for n in (4, 6, 8, 10, 12, 16) for es in (0, 1, 2, 3)
+           if (n - 2) << es <= 126]
+
+
+def _inputs(nsize, es, n=1 << 15):
+    # random magnitudes over the range, the values, the ties between them
+    # and the special values
+    g = torch.Generator().manual_seed(0)
+    scale = torch.exp2(torch.randint(-130, 128, (n,), generator=g).float())
+    values = _tables(nsize, es, "cpu")[0]
+    ties = (values[1:] + values[:-1]) / 2
+    x = torch.cat([torch.randn(n, generator=g) * scale, values, -values, ties, -ties,
+                   torch.tensor([0.0, -0.0, float("inf"), -float("inf"), float("nan")])])
+    return x
+
+
+def _same(a, b):
+    return bool(((a == b) | (a.isnan() & b.isnan())).all())
+
+
+@pytest.mark.parametrize("nsize,es", FORMATS)
+def test_nearest_qtorch(nsize, es):
+    # qtorch_plus returns -inf for NaR, annsim NaN
+    x = _inputs(nsize, es)
+    x = x[x.isfinite()]
+    expected = qtorch_quant.posit_quantize(x, nsize=nsize, es=es, rounding="nearest")
+    assert _same(posit_quantize(x, nsize, es, "nearest"), expected)
+
+
+@pytest.mark.parametrize("nsize,es", [(8, 2), (16, 2), (20, 2), (32, 2)])
+def test_values_kept(nsize, es):
+    # the values of the format round to themselves, the others saturate
+    number = Posit(nsize, es)
+    x = _inputs(min(nsize, 16), es)
+    q = posit_quantize(x, nsize, es, "nearest")
+    assert _same(posit_quantize(q, nsize, es, "nearest"), q)
+    finite = q[q.isfinite() & (q != 0)].abs()
+    assert finite.min() >= number.minpos and finite.max() <= number.maxpos
+    assert bool(q[x.isinf()].isnan().all())
+
+
+@pytest.mark.parametrize("nsize,es", [(8, 2), (16, 2), (24, 2)])
+def test_stochastic_neighbours(nsize, es):
+    # between 1 and 2 the values are multiples of 2**-(nsize - 3 - es):
+    # stochastic rounding picks one of the two around x, unbiased
+    x = torch.full((1 << 16,), 1.3)
+    ulp = 2.0 ** -(nsize - 3 - es)
+    lo = x[0].item() // ulp * ulp
+    torch.manual_seed(0)
+    q = posit_quantize(x, nsize, es, "stochastic")
+    assert set(q.unique().tolist()) <= {lo, lo + ulp}
+    assert abs(q.double().mean().item() - x[0].item()) < 4 * ulp / 2 ** 8
@@ -0,0 +1,40 @@
+"""Weights written as codes by annsim.weightfile and read back."""
+
+import pytest
+import torch
+
+from annsim import weightfile
+from annsim.formats import bits, policy
+from annsim.quant import quant_function
+
+
+def _state(number):
+    g = torch.Generator().manual_seed(0)
+    state = {"conv.weight": torch.randn(8, 3, 5, 5, generator=g),
+             "fc.bias": torch.randn(10, generator=g) * 1e-3,
+             "bn.num_batches_tracked": torch.tensor(7)}
+    state = {k: quant_function(number)(v) if v.is_floating_point() else v
+             for k, v in state.items()}
+    # not rounded to the format, kept as float32
+    state["bn.running_var"] = torch.rand(8, generator=g) + 1e-3
+    return state
+
+
+@pytest.mark.parametrize("name", ["bit_8", "bit_16", "bit_32", "bfloat16", "IEEE_Half", "IBM8"])
+def test_save_load(tmp_path, name):
+    number = policy(name)["weight"]
+    state = _state(number)
+    path = str(tmp_path / "weights.bin")
+    weightfile.save(path, state, number, format=name)
+    assert weightfile.is_weight_file(path)
+
+    loaded = weightfile.WeightFile(path)
+    assert loaded.meta["format"] == name
+    for key, tensor in state.items():
+        assert loaded[key].dtype == tensor.dtype
+        assert torch.equal(loaded[key], tensor)
+    coded = bits(number) <= 16
+    assert ("codec" in loaded.entries["conv.weight"]) == coded
+    assert "codec" not in loaded.entries["bn.running_var"]
+    stored, plain = loaded.nbytes()
+    assert (stored < plain) == coded